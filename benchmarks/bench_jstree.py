@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Time building the jsTree data of the landing page for many metrics.
+
+Usage::
+
+   python benchmarks/bench_jstree.py [N ...]
+
+N is the number of metric names, 100,000 and 250,000 by default. Names are
+dotted paths up to 5 levels deep, like the hierarchies of real servers.
+"""
+import random
+import sys
+import time
+
+from trendlines import orm
+from trendlines import utils
+
+
+def make_metrics(n, seed=0):
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < n:
+        depth = rng.randint(1, 5)
+        # Few choices near the root and more near the leaves, so that
+        # parents are shared.
+        parts = ["n%d" % rng.randrange(4 ** (level + 1))
+                 for level in range(depth)]
+        names.add(".".join(parts))
+    return [orm.Metric(metric_id=i, name=name)
+            for i, name in enumerate(sorted(names), 1)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(sizes):
+    for n in sizes:
+        metrics = make_metrics(n)
+        elapsed, data = timed(utils.build_jstree_data, metrics)
+        print("%8d metrics -> %8d nodes: build_jstree_data %.3f s"
+              % (n, len(data), elapsed))
+
+        tree = utils.JsTree(metrics)
+        sample = random.Random(1).sample(metrics, 1000)
+        elapsed, _ = timed(lambda: [tree.remove(m.name) for m in sample])
+        print("%27s JsTree.remove   %.1f us each"
+              % ("", elapsed / len(sample) * 1e6))
+        elapsed, _ = timed(lambda: [tree.add(m) for m in sample])
+        print("%27s JsTree.add      %.1f us each"
+              % ("", elapsed / len(sample) * 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100000, 250000])
@@ -0,0 +1,17 @@
+"""
+add_index_datapoint_metric_id_timestamp
+date created: 2026-10-18 09:12:44.183510
+"""
+# Time-range queries filter on both "metric_id" and "timestamp". The new
+# index also covers everything that the old "metric_id" index did, so the
+# old one is dropped rather than slowing down every insert.
+
+
+def upgrade(migrator):
+    migrator.add_index("datapoint", ["metric_id", "timestamp"])
+    migrator.drop_index("datapoint", "datapoint_metric_id")
+
+
+def downgrade(migrator):
+    migrator.add_index("datapoint", ["metric_id"])
+    migrator.drop_index("datapoint", "datapoint_metric_id_timestamp")
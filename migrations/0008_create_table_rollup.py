@@ -0,0 +1,72 @@
+"""
+create_table_rollup
+date created: 2026-10-18 10:02:17.548113
+"""
+# Rollups are kept for 1 minute, 1 hour and 1 day buckets. The table is
+# filled from any existing data. Buckets are floored, even for timestamps
+# before 1970, to match `db._bucket`.
+
+RESOLUTIONS = (60, 3600, 86400)
+
+CREATE = """
+CREATE TABLE IF NOT EXISTS "rollup" (
+  "metric_id"  INTEGER NOT NULL,
+  "resolution"  INTEGER NOT NULL,
+  "bucket"  INTEGER NOT NULL,
+  "count"  INTEGER NOT NULL,
+  "sum"  REAL NOT NULL,
+  "min"  REAL NOT NULL,
+  "max"  REAL NOT NULL,
+  "first_timestamp"  INTEGER NOT NULL,
+  "first"  REAL NOT NULL,
+  "last_timestamp"  INTEGER NOT NULL,
+  "last"  REAL NOT NULL,
+  PRIMARY KEY ("metric_id", "resolution", "bucket"),
+  FOREIGN KEY("metric_id") REFERENCES "metric" ( "metric_id" ) ON DELETE CASCADE
+);
+"""
+
+# `first` and `last` use the same tie-breaking as `db._aggregate`: the
+# lowest and highest datapoint_id among datapoints with the same timestamp.
+BACKFILL = """
+INSERT INTO "rollup"
+SELECT
+  "g"."metric_id",
+  :res,
+  "g"."bucket",
+  COUNT(*),
+  SUM("g"."value"),
+  MIN("g"."value"),
+  MAX("g"."value"),
+  MIN("g"."timestamp"),
+  (SELECT "d"."value" FROM "datapoint" AS "d"
+   WHERE "d"."metric_id" = "g"."metric_id"
+     AND "d"."timestamp" >= "g"."bucket"
+     AND "d"."timestamp" < "g"."bucket" + :res
+   ORDER BY "d"."timestamp", "d"."datapoint_id" LIMIT 1),
+  MAX("g"."timestamp"),
+  (SELECT "d"."value" FROM "datapoint" AS "d"
+   WHERE "d"."metric_id" = "g"."metric_id"
+     AND "d"."timestamp" >= "g"."bucket"
+     AND "d"."timestamp" < "g"."bucket" + :res
+   ORDER BY "d"."timestamp" DESC, "d"."datapoint_id" DESC LIMIT 1)
+FROM (
+  SELECT
+    "metric_id",
+    "timestamp" - (("timestamp" % :res) + :res) % :res AS "bucket",
+    "timestamp",
+    "value"
+  FROM "datapoint"
+) AS "g"
+GROUP BY "g"."metric_id", "g"."bucket";
+"""
+
+
+def upgrade(migrator):
+    migrator.execute_sql(CREATE)
+    for res in RESOLUTIONS:
+        migrator.execute_sql(BACKFILL, {"res": res})
+
+
+def downgrade(migrator):
+    migrator.drop_table('rollup')
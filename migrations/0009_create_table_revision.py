@@ -0,0 +1,30 @@
+"""
+create_table_revision
+date created: 2026-10-18 11:40:05.201377
+"""
+# Every existing metric starts at revision 1, as does the metric list
+# itself (key 0).
+
+CREATE = """
+CREATE TABLE IF NOT EXISTS "revision" (
+  "key"  INTEGER NOT NULL PRIMARY KEY,
+  "revision"  INTEGER NOT NULL,
+  "modified"  INTEGER NOT NULL
+);
+"""
+
+SEED = """
+INSERT INTO "revision" ("key", "revision", "modified")
+SELECT "metric_id", 1, CAST(strftime('%s', 'now') AS INTEGER) FROM "metric"
+UNION ALL
+SELECT 0, 1, CAST(strftime('%s', 'now') AS INTEGER);
+"""
+
+
+def upgrade(migrator):
+    migrator.execute_sql(CREATE)
+    migrator.execute_sql(SEED)
+
+
+def downgrade(migrator):
+    migrator.drop_table('revision')
@@ -0,0 +1,15 @@
+"""
+add_index_datapoint_metric_id_datapoint_id
+date created: 2026-10-18 14:02:31.640192
+"""
+# Polling with "since_id" filters on both "metric_id" and "datapoint_id".
+# The "metric_id, timestamp" index can't be used for a range on
+# "datapoint_id", so every poll read all of the metric's index entries.
+
+
+def upgrade(migrator):
+    migrator.add_index("datapoint", ["metric_id", "datapoint_id"])
+
+
+def downgrade(migrator):
+    migrator.drop_index("datapoint", "datapoint_metric_id_datapoint_id")
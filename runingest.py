@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Run the asyncio plaintext protocol server.
+"""
+import os
+from pathlib import Path
+
+import click
+
+from trendlines import ingest_server
+
+
+def runingest():
+    # See runworker.py for why we're using pathlib and `.resolve()`.
+    cfg_file = Path('./config/localhost.cfg')
+    os.environ['TRENDLINES_CONFIG_FILE'] = str(cfg_file.resolve())
+
+    ingest_server.main()
+
+
+@click.command()
+def main():
+    runingest()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ requires = [
     "peewee>=3.8",
     "marshmallow>=2.19,<3.0",
     "apispec>=3,<4",
+    "numpy>=1.15",
     "pip>=18",
 ]
 
@@ -38,4 +39,10 @@ setup(
 
     python_requires=">=3.6",
     install_requires=requires,
+    extras_require={
+        "brotli": ["brotli"],
+        "zstd": ["zstandard"],
+        "arrow": ["pyarrow"],
+        "msgpack": ["msgpack"],
+    },
 )
@@ -7,6 +7,8 @@ from flask import g
 from peewee import OperationalError
 
 from trendlines import _logging
+from trendlines import compress
+from trendlines import db
 from trendlines import logger
 from trendlines import routes
 from trendlines import orm
@@ -47,9 +49,23 @@ def create_app():
     routes.api_class.register_blueprint(routes.api_datapoint)
     routes.api_class.register_blueprint(routes.api_metric)
 
+    # Any buffered writes belong to the previous database, if any.
+    db.stop_write_buffer()
+
     # Create the database file and populate initial tables if needed.
     orm.create_db(app.config['DATABASE'])
 
+    # Any cached metric IDs may belong to a different database.
+    db.metric_cache.maxsize = app.config['METRIC_CACHE_SIZE']
+    db.invalidate_metric()
+
+    if app.config['WRITE_BUFFER']:
+        db.start_write_buffer(
+            max_size=app.config['WRITE_BUFFER_SIZE'],
+            max_delay=app.config['WRITE_BUFFER_DELAY'],
+            durability=app.config['WRITE_BUFFER_DURABILITY'],
+        )
+
     # If I redesign the architecture a bit, then these could be moved so
     # that they only act on the `api` blueprint instead of the entire app.
     #
@@ -78,7 +94,15 @@ def create_app():
 
     @app.after_request
     def after_request(response):
-        g.db.close()
+        if app.config['COMPRESS']:
+            response = compress.compress_response(response, app.config)
+
+        if response.is_streamed:
+            # Streamed responses read from the database after this runs, so
+            # wait until the response has been sent.
+            response.call_on_close(g.db.close)
+        else:
+            g.db.close()
         return response
 
     return app
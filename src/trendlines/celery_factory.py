@@ -5,15 +5,15 @@ Celery factory and related functions.
 import errno
 import os
 import socketserver
+import threading
 import types
 from pathlib import Path
 from traceback import format_exc
 
-import requests
 from celery import Celery
 from celery.exceptions import ImproperlyConfigured
 
-from trendlines import utils
+from trendlines import ingest
 from trendlines import logger
 
 # TODO: queueing?
@@ -115,39 +115,76 @@ def create_celery():
 
     UDP_PORT = celery.conf['UDP_PORT']
     TCP_PORT = celery.conf['TCP_PORT']
+    PICKLE_PORT = celery.conf['PICKLE_PORT']
     HOST = celery.conf['TARGET_HOST']
-    URL = celery.conf['TRENDLINES_API_URL']
+    BATCH_SIZE = celery.conf['SOCKET_BATCH_SIZE']
+    BATCH_DELAY = celery.conf['SOCKET_BATCH_DELAY']
     celery.finalize()
     logger.debug("Celery has been finalized.")
 
+    write = ingest.make_writer(celery.conf)
 
-    class TCPHandler(socketserver.BaseRequestHandler):
+
+    class TCPHandler(socketserver.StreamRequestHandler):
         def handle(self):
-            data = self.request.recv(1024).strip()
-            try:
-                parsed = utils.parse_socket_data(data)
-                logger.debug("TCP: {}".format(parsed))
-            except ValueError:
-                logger.warn("TCP: Failed to parse `%s`." % data)
-                return
+            # Read every line until the client closes the connection,
+            # writing them in batches.
+            batcher = ingest.Batcher(write, BATCH_SIZE, BATCH_DELAY)
+            accepted, rejected = ingest.read_lines(self.rfile, batcher, "TCP")
+            batcher.flush()
+            logger.debug("TCP: accepted %s lines, rejected %s."
+                         % (accepted, rejected))
 
             try:
-                r = requests.post(URL, json=parsed)
-                logger.info(r.status_code)
-            except Exception:
-                raise
-            self.request.sendall(b"accepted")
+                self.wfile.write(b"accepted")
+            except OSError:
+                # The client didn't wait around for a response.
+                pass
+
+    class PickleHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # Relays keep their connection open, sending many messages.
+            accepted, rejected = ingest.read_pickle(self.rfile, write)
+            logger.debug("Pickle: accepted %s datapoints, rejected %s."
+                         % (accepted, rejected))
+
+    def listen_to_udp():
+        hp = (HOST, UDP_PORT)
+        logger.info("listening for UDP on %s:%s" % hp)
+        with ingest.bind_udp(*hp) as sock:
+            batcher = ingest.Batcher(write, BATCH_SIZE, BATCH_DELAY)
+            ingest.serve_udp(sock, batcher)
 
-    @celery.task
     def listen_to_tcp():
         hp = (HOST, TCP_PORT)
         logger.info("listening for TCP on %s:%s" % hp)
         with socketserver.TCPServer(hp, TCPHandler) as server:
             server.serve_forever()
 
+    def listen_to_pickle():
+        hp = (HOST, PICKLE_PORT)
+        logger.info("listening for pickle protocol on %s:%s" % hp)
+        # Threaded, since each relay holds a connection open indefinitely.
+        with socketserver.ThreadingTCPServer(hp, PickleHandler) as server:
+            server.daemon_threads = True
+            server.serve_forever()
+
+    @celery.task
+    def listen():
+        # None of the listeners ever return, so run them all as threads of
+        # a single task. Otherwise a worker with fewer pool processes than
+        # listeners never starts some of them.
+        threads = [
+            threading.Thread(target=func, name=func.__name__, daemon=True)
+            for func in (listen_to_udp, listen_to_tcp, listen_to_pickle)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
     # Start our tasks
     logger.debug("Starting tasks")
-    #  listen_to_udp.delay()
-    listen_to_tcp.delay()
+    listen.delay()
 
     return celery
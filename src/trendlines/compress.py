@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Compress responses for clients that accept it.
+
+The encoding is negotiated from the request's ``Accept-Encoding`` header.
+``gzip`` is always available. ``br`` needs the ``brotli`` package and
+``zstd`` needs the ``zstandard`` package; they are skipped if the package
+is not installed.
+
+Streamed responses are compressed chunk by chunk, and each chunk is flushed
+so that the client gets data as soon as it's generated.
+"""
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:                 # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:                 # pragma: no cover
+    zstandard = None
+
+
+def _gzip(level):
+    obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return obj.compress, lambda: obj.flush(zlib.Z_SYNC_FLUSH), obj.flush
+
+
+def _brotli(level):
+    obj = brotli.Compressor(quality=level)
+    return obj.process, obj.flush, obj.finish
+
+
+def _zstd(level):
+    obj = zstandard.ZstdCompressor(level=level).compressobj()
+    flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    return obj.compress, lambda: obj.flush(flush_block), obj.flush
+
+
+# Each maps a compression level to a ``(compress, flush, finish)`` tuple of
+# callables.
+COMPRESSORS = {"gzip": _gzip}
+if brotli is not None:
+    COMPRESSORS["br"] = _brotli
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd
+
+
+def available(encodings):
+    """
+    Return the encodings that can be used, keeping their order.
+
+    Parameters
+    ----------
+    encodings : iterable of str
+
+    Returns
+    -------
+    encodings : list of str
+    """
+    return [enc for enc in encodings if enc in COMPRESSORS]
+
+
+def compress(data, encoding, level):
+    """
+    Compress bytes in one go.
+
+    Parameters
+    ----------
+    data : bytes
+    encoding : str
+        One of :data:`COMPRESSORS`.
+    level : int
+
+    Returns
+    -------
+    compressed : bytes
+    """
+    compress_, _, finish = COMPRESSORS[encoding](level)
+    return compress_(data) + finish()
+
+
+def compress_iter(chunks, encoding, level):
+    """
+    Compress an iterable of bytes, flushing after every chunk.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+    encoding : str
+        One of :data:`COMPRESSORS`.
+    level : int
+
+    Yields
+    ------
+    compressed : bytes
+    """
+    compress_, flush, finish = COMPRESSORS[encoding](level)
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            data = compress_(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # Things like `stream_with_context` clean up when closed.
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response, config):
+    """
+    Compress a response if the client accepts it and it's worth it.
+
+    Must be run within a request context.
+
+    Parameters
+    ----------
+    response : :class:`flask.Response`
+    config : :class:`flask.Config`
+        Uses the ``COMPRESS_*`` settings.
+
+    Returns
+    -------
+    response : :class:`flask.Response`
+        The same response object, modified in-place.
+    """
+    if (response.status_code != 200
+            or request.method == "HEAD"
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+
+    # Caches must keep a copy per encoding, even of uncompressed responses.
+    response.vary.add("Accept-Encoding")
+
+    length = response.content_length
+    if length is not None and length < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encodings = available(config['COMPRESS_ENCODINGS'])
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+    level = config['COMPRESS_LEVEL'][encoding]
+
+    if response.is_streamed or response.direct_passthrough:
+        # The length isn't known, so it's always compressed.
+        chunks = response.iter_encoded()
+        response.response = compress_iter(chunks, encoding, level)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compress(response.get_data(), encoding, level))
+
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body is different, but means the same thing.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -9,14 +9,169 @@ we need that information to determine things like which ErrorResponse
 to send.
 """
 
+import atexit
+import threading
+import time
+from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
 from datetime import timezone
 
+import numpy as np
+from peewee import chunked
+from peewee import fn
+from peewee import IntegrityError
+from peewee import JOIN
+from peewee import NodeList
+from peewee import SQL
+
+from trendlines import live
 from trendlines import logger
 from .orm import Metric
 from .orm import DataPoint
+from .orm import Revision
+from .orm import Rollup
 from .orm import db as _db
 
+# SQLite's default value for SQLITE_MAX_VARIABLE_NUMBER. Bulk queries are
+# chunked so that they never bind more parameters than this.
+_MAX_SQL_VARIABLES = 999
+
+# Valid durability modes for :class:`WriteBuffer`.
+DURABILITY_MODES = ("commit", "enqueue")
+
+# The bucket sizes, in seconds, of the rollup table: 1 minute, 1 hour and
+# 1 day. Changing these requires a migration to rebuild the table.
+ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+
+# The `orm.Revision` key that tracks changes to the list of metrics.
+METRIC_LIST = 0
+
+# The columns of the rollup table, in the order used by `_aggregate`.
+_ROLLUP_FIELDS = [Rollup.metric, Rollup.resolution, Rollup.bucket,
+                  Rollup.count, Rollup.sum, Rollup.min, Rollup.max,
+                  Rollup.first_timestamp, Rollup.first,
+                  Rollup.last_timestamp, Rollup.last]
+
+
+class MetricCache(object):
+    """
+    A thread-safe, bounded mapping of metric name to ``metric_id``.
+
+    Used by the write path so that ingesting data for a known metric
+    doesn't need to query the ``metric`` table. When full, the least
+    recently used names are evicted.
+
+    Other processes can rename or delete metrics, so the cache is tied to
+    a revision of the list of metrics (see :func:`get_revision`) and is
+    cleared when that changes.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of metric names to keep.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        # The revision of the list of metrics that the cached IDs are for.
+        self.revision = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, names):
+        """
+        Return a dict of ``{name: metric_id}`` for the cached ``names``.
+        """
+        found = {}
+        with self._lock:
+            for name in names:
+                try:
+                    found[name] = self._data[name]
+                except KeyError:
+                    continue
+                self._data.move_to_end(name)
+        return found
+
+    def validate(self, revision):
+        """
+        Clear the cache if the list of metrics has changed.
+
+        Parameters
+        ----------
+        revision : int
+            The current revision of the list of metrics.
+        """
+        with self._lock:
+            if revision != self.revision:
+                self._data.clear()
+                self.revision = revision
+
+    def update(self, metric_ids, revision=None, new_revision=None):
+        """
+        Add a dict of ``{name: metric_id}`` to the cache.
+
+        Parameters
+        ----------
+        metric_ids : dict
+        revision : int, optional
+            The revision of the list of metrics that the IDs were read at.
+            If the cache has been validated against a different revision
+            since, nothing is added.
+        new_revision : int, optional
+            The revision after the caller's own changes, such as creating
+            these metrics. The cache moves to it.
+        """
+        with self._lock:
+            if revision is not None:
+                if revision != self.revision:
+                    return
+                if new_revision is not None:
+                    self.revision = new_revision
+            for name, metric_id in metric_ids.items():
+                self._data[name] = metric_id
+                self._data.move_to_end(name)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, name):
+        """
+        Remove a metric name from the cache, if it's there.
+        """
+        with self._lock:
+            self._data.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.revision = None
+
+
+metric_cache = MetricCache()
+
+
+def invalidate_metric(name=None):
+    """
+    Remove a metric from the metric cache.
+
+    Must be called whenever a metric is renamed or deleted.
+
+    Parameters
+    ----------
+    name : str, optional
+        The full metric name (the *old* name, for renames). If ``None``,
+        the entire cache is cleared.
+    """
+    if name is None:
+        logger.debug("Clearing the metric cache.")
+        metric_cache.clear()
+    else:
+        logger.debug("Removing '%s' from the metric cache." % name)
+        metric_cache.discard(name)
+
 
 def add_metric(name, units=None, lower_limit=None, upper_limit=None):
     """
@@ -63,16 +218,22 @@ def add_metric(name, units=None, lower_limit=None, upper_limit=None):
             logger.error("upper_limit not greater than lower_limit.")
             raise ValueError("upper_limit must be greater than lower_limit")
 
-    metric, created = Metric.get_or_create(
-        name=name,
-        units=units,
-        lower_limit=lower_limit,
-        upper_limit=upper_limit,
-    )
-    if created:
-        logger.info("Metric '%s' created." % name)
-    else:
-        logger.debug("Found existing metric '%s'." % name)
+    with _db.atomic():
+        revision = _validate_metric_cache()
+        metric, created = Metric.get_or_create(
+            name=name,
+            units=units,
+            lower_limit=lower_limit,
+            upper_limit=upper_limit,
+        )
+        if created:
+            logger.info("Metric '%s' created." % name)
+            touch([metric.metric_id, METRIC_LIST])
+        else:
+            logger.debug("Found existing metric '%s'." % name)
+        new_revision = get_revision()[1]
+    metric_cache.update({metric.name: metric.metric_id}, revision,
+                        new_revision)
     return metric
 
 
@@ -96,40 +257,1061 @@ def insert_datapoint(metric, value, timestamp=None):
         An instance of the newly-created model object.
     """
     logger.debug("Adding data point %s to metric '%s'" % (value, metric))
-    metric = Metric.get(Metric.name == metric)
+    metric_id = _get_metric_id(metric)
 
     if timestamp is None:
         logger.debug("Timestamp not given, using current time.")
         timestamp = datetime.now(timezone.utc).timestamp()
 
-    new = DataPoint.create(
-        metric=metric,
-        value=value,
-        timestamp=timestamp,
-    )
+    with _db.atomic():
+        new = DataPoint.create(
+            metric=metric_id,
+            value=value,
+            timestamp=timestamp,
+        )
+        _update_rollups([(metric_id, value, timestamp)])
+        touch([metric_id])
+
+    if len(live.hub):
+        live.hub.publish([(metric, new.datapoint_id,
+                           DataPoint.timestamp.db_value(timestamp), value)])
     return new
 
 
-def get_data(metric):
+def insert_datapoints(points):
+    """
+    Add many datapoints, possibly for many metrics, in a single transaction.
+
+    Metrics that do not exist yet are created automatically. All metric
+    names are resolved with a single query (or none at all, if they are
+    all in the metric cache) and all datapoints are written with bulk
+    ``INSERT`` statements.
+
+    Parameters
+    ----------
+    points : iterable of ``(metric, value, timestamp)`` tuples
+        ``metric`` is the full metric name and ``timestamp`` is the POSIX
+        timestamp of the data point. If ``timestamp`` is ``None`` then the
+        current time is used.
+
+    Returns
+    -------
+    count : int
+        The number of datapoints that were inserted.
+    """
+    points = list(points)
+    if not points:
+        return 0
+
+    logger.debug("Adding %s data points." % len(points))
+    try:
+        return _insert_datapoints(points)
+    except IntegrityError:
+        # Most likely a cached metric was deleted out from under us, such as
+        # by another process. Try again with a cold cache.
+        logger.warning("Failed to add data points. Retrying with an empty"
+                       " metric cache.")
+        metric_cache.clear()
+        return _insert_datapoints(points)
+
+
+def _insert_datapoints(points):
+    """
+    Implementation of :func:`insert_datapoints`.
+    """
+    now = datetime.now(timezone.utc).timestamp()
+
+    with _db.atomic():
+        revision = _validate_metric_cache()
+        metric_ids = _get_or_create_metric_ids({p[0] for p in points})
+
+        rows = [(metric_ids[metric], value, now if ts is None else ts)
+                for metric, value, ts in points]
+        fields = [DataPoint.metric, DataPoint.value, DataPoint.timestamp]
+        last_ids = []
+        for batch in chunked(rows, _MAX_SQL_VARIABLES // len(fields)):
+            last_id = DataPoint.insert_many(batch, fields=fields).execute()
+            last_ids.append((last_id, len(batch)))
+        _update_rollups(rows)
+        touch(set(metric_ids.values()))
+        # Creating metrics changes the revision.
+        new_revision = get_revision()[1]
+
+    # Only cache the IDs once we know they've been committed.
+    metric_cache.update(metric_ids, revision, new_revision)
+
+    if len(live.hub):
+        _publish(points, rows, last_ids)
+    return len(rows)
+
+
+def _publish(points, rows, last_ids):
+    """
+    Publish datapoints written by :func:`_insert_datapoints` to the hub.
+
+    ``last_ids`` are the ``(last_insert_rowid, count)`` of each
+    ``INSERT``. The IDs of a multi-row ``INSERT`` are consecutive, since
+    ``datapoint_id`` is ``AUTOINCREMENT`` and nobody else can write during
+    our transaction.
+    """
+    ids = [datapoint_id
+           for last_id, count in last_ids
+           for datapoint_id in range(last_id - count + 1, last_id + 1)]
+    db_value = DataPoint.timestamp.db_value
+    live.hub.publish(
+        (point[0], datapoint_id, db_value(row[2]), row[1])
+        for point, row, datapoint_id in zip(points, rows, ids)
+    )
+
+
+def _get_or_create_metric_ids(names):
+    """
+    Return a dict of ``{name: metric_id}``, creating missing metrics.
+
+    Should be called from within a transaction.
+
+    Parameters
+    ----------
+    names : set of str
+        The full metric names to look up.
+
+    Returns
+    -------
+    metric_ids : dict
+    """
+    metric_ids = _get_metric_ids(names)
+
+    missing = [name for name in names if name not in metric_ids]
+    if missing:
+        for batch in chunked(missing, _MAX_SQL_VARIABLES):
+            rows = [(name, ) for name in batch]
+            Metric.insert_many(rows, fields=[Metric.name]).execute()
+        metric_ids.update(_get_metric_ids(missing))
+        touch([METRIC_LIST])
+        logger.info("Metrics created: %s" % ", ".join(sorted(missing)))
+
+    return metric_ids
+
+
+def _validate_metric_cache():
+    """
+    Clear the metric cache if the list of metrics has changed, such as by
+    another process renaming or deleting a metric.
+
+    A primary key lookup of the list's revision.
+
+    Returns
+    -------
+    revision : int
+        The current revision of the list of metrics.
+    """
+    revision = get_revision()[1]
+    metric_cache.validate(revision)
+    return revision
+
+
+def _get_metric_ids(names):
+    """
+    Return a dict of ``{name: metric_id}`` for the metrics that exist.
+
+    Names found in the metric cache are not queried. Names that are
+    queried are *not* added to the cache: that's up to the caller, once
+    it knows that the transaction has been committed.
+    """
+    metric_ids = metric_cache.get_many(names)
+
+    missing = [name for name in names if name not in metric_ids]
+    for batch in chunked(missing, _MAX_SQL_VARIABLES):
+        query = (Metric.select(Metric.name, Metric.metric_id)
+                 .where(Metric.name.in_(batch))
+                 .tuples())
+        metric_ids.update(query)
+
+    return metric_ids
+
+
+def _get_metric_id(name):
+    """
+    Return the ``metric_id`` of an existing metric.
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found.
+    """
+    revision = _validate_metric_cache()
+    try:
+        metric_id = _get_metric_ids([name])[name]
+    except KeyError:
+        raise Metric.DoesNotExist("Metric '%s' does not exist." % name)
+
+    metric_cache.update({name: metric_id}, revision)
+    return metric_id
+
+
+def touch(keys):
+    """
+    Record that metrics, or the list of metrics, have changed.
+
+    Must be called whenever a metric or its data is changed. Changes made
+    through the functions in this module already do so.
+
+    Parameters
+    ----------
+    keys : iterable of int
+        ``metric_id`` values, or :data:`METRIC_LIST` for changes to which
+        metrics exist (such as creating, renaming or deleting one).
+    """
+    keys = list(set(keys))
+    now = int(datetime.now(timezone.utc).timestamp())
+    for batch in chunked(keys, _MAX_SQL_VARIABLES - 2):
+        updated = (Revision
+                   .update(revision=Revision.revision + 1, modified=now)
+                   .where(Revision.key.in_(batch))
+                   .execute())
+        if updated < len(batch):
+            rows = [(key, 1, now) for key in batch]
+            fields = [Revision.key, Revision.revision, Revision.modified]
+            (Revision.insert_many(rows, fields=fields)
+             .on_conflict_ignore()
+             .execute())
+
+
+def get_revision(metric=None):
+    """
+    Return the revision of a metric or of the list of metrics.
+
+    Parameters
+    ----------
+    metric : str, optional
+        The full metric name. If ``None``, return the revision of the
+        list of metrics.
+
+    Returns
+    -------
+    (key, revision, modified) : (int, int, int or None)
+        ``key`` is the ``metric_id`` or :data:`METRIC_LIST`. ``modified``
+        is the POSIX timestamp of the last change, if known.
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found.
+    """
+    if metric is None:
+        query = (Revision.select(Revision.key, Revision.revision,
+                                 Revision.modified)
+                 .where(Revision.key == METRIC_LIST)
+                 .tuples())
+        return query.first() or (METRIC_LIST, 0, None)
+
+    key, revision, modified = (
+        Metric.select(Metric.metric_id, Revision.revision, Revision.modified)
+        .join(Revision, JOIN.LEFT_OUTER,
+              on=(Revision.key == Metric.metric_id))
+        .where(Metric.name == metric)
+        .tuples()
+        .get()
+    )
+    return key, revision or 0, modified
+
+
+def get_revisions(metric_ids):
+    """
+    Return the revisions of many metrics in a single query.
+
+    Parameters
+    ----------
+    metric_ids : list of int
+
+    Returns
+    -------
+    revisions : list of ``(key, revision, modified)`` tuples
+        Like :func:`get_revision`, ordered by ``key``. Metrics that have
+        never changed are not included.
+    """
+    query = (Revision.select(Revision.key, Revision.revision,
+                             Revision.modified)
+             .where(Revision.key.in_(metric_ids))
+             .order_by(Revision.key)
+             .tuples())
+    return list(query)
+
+
+def _bucket(timestamp, resolution):
+    """
+    Return the start of the rollup bucket that a timestamp falls in.
     """
-    Return all of the data for a given metric.
+    return timestamp - timestamp % resolution
+
+
+def _aggregate(rows):
+    """
+    Aggregate datapoints into rollup buckets.
+
+    Parameters
+    ----------
+    rows : iterable of ``(metric_id, value, timestamp)`` tuples
+        In insertion order, so that ties in ``timestamp`` are broken the
+        same way as ``ORDER BY timestamp, datapoint_id``.
+
+    Returns
+    -------
+    aggregates : dict
+        ``{(metric_id, resolution, bucket): [count, sum, min, max,
+        first_timestamp, first, last_timestamp, last]}``
+    """
+    aggregates = {}
+    for metric_id, value, timestamp in rows:
+        value = float(value)
+        timestamp = DataPoint.timestamp.db_value(timestamp)
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (metric_id, resolution, _bucket(timestamp, resolution))
+            agg = aggregates.get(key)
+            if agg is None:
+                aggregates[key] = [1, value, value, value,
+                                   timestamp, value, timestamp, value]
+                continue
+            agg[0] += 1
+            agg[1] += value
+            agg[2] = min(agg[2], value)
+            agg[3] = max(agg[3], value)
+            if timestamp < agg[4]:
+                agg[4], agg[5] = timestamp, value
+            if timestamp >= agg[6]:
+                agg[6], agg[7] = timestamp, value
+    return aggregates
+
+
+def _update_rollups(rows):
+    """
+    Add newly-inserted datapoints to the rollup table.
+
+    Should be called from within the transaction that inserted them.
+
+    Parameters
+    ----------
+    rows : iterable of ``(metric_id, value, timestamp)`` tuples
+        See :func:`_aggregate`.
+    """
+    _merge_rollups(_aggregate(rows))
+
+
+def _merge_rollups(aggregates):
+    """
+    Merge the output of :func:`_aggregate` into the rollup table.
+
+    Existing rows are read in bulk, merged in Python and written back with
+    bulk ``REPLACE`` statements. Nothing else can write in between, since
+    the caller's transaction has already written to the database.
+    """
+    for where in _rollup_key_filters(aggregates):
+        existing = Rollup.select(*_ROLLUP_FIELDS).where(where).tuples()
+        for row in existing:
+            _combine(aggregates[row[:3]], row[3:])
+
+    rows = [key + tuple(agg) for key, agg in aggregates.items()]
+    for batch in chunked(rows, _MAX_SQL_VARIABLES // len(_ROLLUP_FIELDS)):
+        Rollup.replace_many(batch, fields=_ROLLUP_FIELDS).execute()
+
+
+def _rollup_key_filters(keys):
+    """
+    Yield ``WHERE`` clauses that together select the given rollup rows.
+
+    Keys are grouped by metric and resolution into
+    ``metric_id = ? AND resolution = ? AND bucket IN (...)`` terms, which
+    are OR'ed together up to :data:`_MAX_SQL_VARIABLES` parameters per
+    clause. Each term is a search on the primary key. Unlike a row-value
+    ``IN``, this works on SQLite versions older than 3.15.
+
+    Parameters
+    ----------
+    keys : iterable of ``(metric_id, resolution, bucket)`` tuples
+    """
+    groups = defaultdict(list)
+    for metric_id, resolution, bucket in keys:
+        groups[(metric_id, resolution)].append(bucket)
+
+    terms = []
+    size = 0
+    for (metric_id, resolution), buckets in groups.items():
+        for batch in chunked(buckets, _MAX_SQL_VARIABLES - 2):
+            params = len(batch) + 2
+            if terms and size + params > _MAX_SQL_VARIABLES:
+                yield _or(terms)
+                terms = []
+                size = 0
+            terms.append((Rollup.metric == metric_id)
+                         & (Rollup.resolution == resolution)
+                         & Rollup.bucket.in_(batch))
+            size += params
+    if terms:
+        yield _or(terms)
+
+
+def _or(terms):
+    """
+    OR many expressions together without nesting them.
+
+    Chaining with ``|`` nests a level of parentheses per term, which
+    overflows SQLite's parser stack after a few hundred terms.
+    """
+    return NodeList(terms, glue=" OR ", parens=True)
+
+
+def _combine(agg, old):
+    """
+    Merge an existing rollup row into a new aggregate, in place.
+
+    The existing row holds the older datapoints, so it wins ties for
+    ``first`` and loses them for ``last``.
+    """
+    count, total, lo, hi, first_ts, first, last_ts, last = old
+    agg[0] += count
+    agg[1] += total
+    agg[2] = min(agg[2], lo)
+    agg[3] = max(agg[3], hi)
+    if first_ts <= agg[4]:
+        agg[4], agg[5] = first_ts, first
+    if last_ts > agg[6]:
+        agg[6], agg[7] = last_ts, last
+
+
+def _rebuild_rollups(metric_id, timestamp):
+    """
+    Recompute the rollups that contain a timestamp from the raw data.
+
+    Needed after a datapoint is changed or deleted, since a minimum or
+    maximum can't be "un-added". Should be called from within the
+    transaction that made the change.
+    """
+    keys = {(metric_id, res, _bucket(timestamp, res))
+            for res in ROLLUP_RESOLUTIONS}
+    for _, resolution, bucket in keys:
+        (Rollup.delete()
+         .where((Rollup.metric == metric_id)
+                & (Rollup.resolution == resolution)
+                & (Rollup.bucket == bucket))
+         .execute())
+
+    # The largest bucket contains all of the smaller ones.
+    largest = max(ROLLUP_RESOLUTIONS)
+    start = _bucket(timestamp, largest)
+    rows = (DataPoint.select(DataPoint.metric,
+                             DataPoint.value,
+                             DataPoint.timestamp.cast("INTEGER"))
+            .where(_data_filter(metric_id, start, start + largest))
+            .order_by(DataPoint.timestamp, DataPoint.datapoint_id)
+            .tuples())
+    aggregates = _aggregate(rows.iterator())
+    _merge_rollups({k: v for k, v in aggregates.items() if k in keys})
+
+
+def _rollup_key(datapoint_id):
+    """
+    Return the ``(metric_id, timestamp)`` of a datapoint, straight from
+    the database.
+    """
+    return (DataPoint.select(DataPoint.metric,
+                             DataPoint.timestamp.cast("INTEGER"))
+            .where(DataPoint.datapoint_id == datapoint_id)
+            .tuples()
+            .get())
+
+
+class WriteBuffer(object):
+    """
+    Collect datapoints from many threads and commit them together.
+
+    SQLite can only commit so many transactions per second, no matter how
+    small they are. Rather than have every request commit its own
+    transaction, a single background thread commits everything that was
+    submitted in the last ``max_delay`` seconds (or as soon as
+    ``max_size`` datapoints are waiting) with one call to
+    :func:`insert_datapoints`.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Commit as soon as this many datapoints are waiting.
+    max_delay : float, optional
+        The maximum number of seconds that a datapoint waits before being
+        committed.
+    durability : str, optional
+        One of :data:`DURABILITY_MODES`. In ``"commit"`` mode,
+        :meth:`submit` blocks until the datapoints have been committed and
+        raises any error from the write. In ``"enqueue"`` mode it returns
+        right away; write errors are only logged and buffered data is lost
+        if the process dies.
+    """
+    def __init__(self, max_size=1000, max_delay=0.01, durability="commit"):
+        if durability not in DURABILITY_MODES:
+            msg = "Invalid durability '{}'. Must be one of {}."
+            raise ValueError(msg.format(durability, DURABILITY_MODES))
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.durability = durability
+
+        # Submitters wait if this many datapoints are already waiting, so
+        # that "enqueue" mode can't use unbounded memory.
+        self.max_pending = max_size * 10
+
+        self._entries = []
+        self._count = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background commit thread.
+        """
+        self._thread = threading.Thread(target=self._run,
+                                        name="trendlines-write-buffer",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Commit anything that's waiting and stop the background thread.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, points):
+        """
+        Add datapoints to the buffer.
+
+        Parameters
+        ----------
+        points : list of ``(metric, value, timestamp)`` tuples
+            See :func:`insert_datapoints`. Timestamps should already be
+            filled in, otherwise the commit time is used.
+
+        Returns
+        -------
+        count : int
+            The number of datapoints that were written (``"commit"``
+            mode) or buffered (``"enqueue"`` mode).
+
+        Raises
+        ------
+        RuntimeError
+            The buffer has been stopped.
+        """
+        future = Future() if self.durability == "commit" else None
+        with self._cond:
+            while self._count >= self.max_pending and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                raise RuntimeError("The write buffer has been stopped.")
+
+            self._entries.append((points, future))
+            self._count += len(points)
+            if len(self._entries) == 1 or self._count >= self.max_size:
+                self._cond.notify_all()
+
+        if future is None:
+            return len(points)
+        return future.result()
+
+    def _run(self):
+        """
+        Commit batches until stopped.
+        """
+        try:
+            while True:
+                with self._cond:
+                    while not self._entries and not self._stopping:
+                        self._cond.wait()
+                    if not self._entries:
+                        break
+
+                    deadline = time.monotonic() + self.max_delay
+                    while self._count < self.max_size and not self._stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                    entries, self._entries = self._entries, []
+                    self._count = 0
+                    # Let any blocked submitters in.
+                    self._cond.notify_all()
+
+                self._commit(entries)
+        finally:
+            # Connections are per-thread. Don't leave ours open.
+            _db.close()
+
+    def _commit(self, entries):
+        """
+        Write a batch of submissions in a single transaction.
+
+        If that fails, each submission is retried on its own so that one
+        bad submission doesn't fail everyone else's.
+        """
+        points = [point for batch, _ in entries for point in batch]
+        try:
+            insert_datapoints(points)
+        except Exception as err:
+            if len(entries) == 1:
+                self._fail(entries[0], err)
+                return
+            logger.warning("Failed to commit %s buffered datapoints. Retrying"
+                           " each write separately." % len(points))
+        else:
+            for batch, future in entries:
+                if future is not None:
+                    future.set_result(len(batch))
+            return
+
+        for entry in entries:
+            batch, future = entry
+            try:
+                count = insert_datapoints(batch)
+            except Exception as err:
+                self._fail(entry, err)
+            else:
+                if future is not None:
+                    future.set_result(count)
+
+    @staticmethod
+    def _fail(entry, err):
+        batch, future = entry
+        if future is None:
+            msg = "Failed to write %s buffered datapoints: %s"
+            logger.error(msg % (len(batch), err))
+        else:
+            future.set_exception(err)
+
+
+write_buffer = None
+
+
+def start_write_buffer(max_size=1000, max_delay=0.01, durability="commit"):
+    """
+    Start buffering the writes made by :func:`write_datapoints`.
+
+    Any existing write buffer is stopped first. See :class:`WriteBuffer`
+    for the parameters.
+    """
+    global write_buffer
+    stop_write_buffer()
+    logger.info("Starting the write buffer in '%s' mode." % durability)
+    write_buffer = WriteBuffer(max_size, max_delay, durability)
+    write_buffer.start()
+
+
+def stop_write_buffer():
+    """
+    Commit any buffered datapoints and stop buffering writes.
+    """
+    global write_buffer
+    if write_buffer is not None:
+        logger.info("Stopping the write buffer.")
+        write_buffer.stop()
+        write_buffer = None
+
+
+# Don't lose buffered data when the interpreter exits normally.
+atexit.register(stop_write_buffer)
+
+
+def write_datapoints(points):
+    """
+    Add many datapoints, using the write buffer if it's running.
+
+    If :func:`start_write_buffer` has not been called, this is the same as
+    :func:`insert_datapoints`.
+
+    Parameters
+    ----------
+    points : iterable of ``(metric, value, timestamp)`` tuples
+        See :func:`insert_datapoints`.
+
+    Returns
+    -------
+    count : int
+        The number of datapoints that were written or, in ``"enqueue"``
+        mode, buffered.
+    """
+    buffer = write_buffer
+    if buffer is None:
+        return insert_datapoints(points)
+
+    # Stamp the time now rather than when the buffer gets committed.
+    now = datetime.now(timezone.utc).timestamp()
+    points = [(metric, value, now if ts is None else ts)
+              for metric, value, ts in points]
+    if not points:
+        return 0
+    return buffer.submit(points)
+
+
+def get_data(metric, start=None, end=None):
+    """
+    Return the data for a given metric, optionally within a time range.
 
     Parameters
     ----------
     metric : str
         The full metric name.
+    start : int, optional
+        Only return data at or after this POSIX timestamp.
+    end : int, optional
+        Only return data before this POSIX timestamp.
 
     Returns
     -------
     data : :class:`peewee.ModelSelect`
-        The returned data. Acts like an iterable of
+        The returned data, ordered by timestamp. Acts like an iterable of
         :class:`orm.DataPoint` objects
     """
     logger.debug("Querying data for '%s'" % metric)
     metric = Metric.get(Metric.name == metric)
-    data = DataPoint.select().where(DataPoint.metric == metric.metric_id)
+    data = (DataPoint.select()
+            .where(_data_filter(metric.metric_id, start, end))
+            .order_by(DataPoint.timestamp, DataPoint.datapoint_id))
     return data
 
+
+def get_raw_data(metric, start=None, end=None, since=None, since_id=None):
+    """
+    Return the data for a given metric as plain tuples.
+
+    This is much faster than :func:`get_data` for large amounts of data,
+    since no model objects or :class:`datetime.datetime` objects are made.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    start, end : int, optional
+        See :func:`get_data`.
+    since : int, optional
+        Only return data after this POSIX timestamp (exclusive).
+    since_id : int, optional
+        Only return datapoints with a ``datapoint_id`` greater than this.
+        Datapoint IDs are never reused, so this returns exactly the
+        datapoints that were added after ``since_id``.
+
+    Returns
+    -------
+    data : :class:`peewee.ModelSelect`
+        An iterable of ``(datapoint_id, timestamp, value)`` tuples, where
+        ``timestamp`` is the POSIX timestamp. Ordered by timestamp.
+    """
+    logger.debug("Querying raw data for '%s'" % metric)
+    metric = Metric.get(Metric.name == metric)
+    where = _raw_data_filter(DataPoint.metric == metric.metric_id,
+                             start, end, since, since_id)
+    data = (DataPoint.select(DataPoint.datapoint_id,
+                             DataPoint.timestamp.cast("INTEGER"),
+                             DataPoint.value)
+            .where(where)
+            .order_by(DataPoint.timestamp, DataPoint.datapoint_id)
+            .tuples())
+    return data
+
+
+def get_raw_data_many(metric_ids, start=None, end=None, since=None,
+                      since_id=None):
+    """
+    Return the data of many metrics as plain tuples, in a single query.
+
+    Parameters
+    ----------
+    metric_ids : list of int
+    start, end, since, since_id : int, optional
+        See :func:`get_raw_data`.
+
+    Returns
+    -------
+    data : :class:`peewee.ModelSelect`
+        An iterable of ``(metric_id, datapoint_id, timestamp, value)``
+        tuples, ordered by ``metric_id`` and then by timestamp, so that
+        each metric's data is contiguous. The
+        ``datapoint_metric_id_timestamp`` index covers this order.
+    """
+    logger.debug("Querying raw data for %s metrics" % len(metric_ids))
+    where = _raw_data_filter(DataPoint.metric.in_(metric_ids),
+                             start, end, since, since_id)
+    data = (DataPoint.select(DataPoint.metric,
+                             DataPoint.datapoint_id,
+                             DataPoint.timestamp.cast("INTEGER"),
+                             DataPoint.value)
+            .where(where)
+            .order_by(DataPoint.metric, DataPoint.timestamp,
+                      DataPoint.datapoint_id)
+            .tuples())
+    return data
+
+
+def _raw_data_filter(where, start=None, end=None, since=None,
+                     since_id=None):
+    """
+    Add the time range and ``since`` filters of :func:`get_raw_data` to a
+    ``WHERE`` clause.
+
+    With ``since_id``, the ``datapoint_metric_id_datapoint_id`` index is
+    used to read only the datapoints after it, and the timestamp filters are
+    checked on each of those. Otherwise SQLite may pick the
+    ``datapoint_metric_id_timestamp`` index and read every datapoint in the
+    time range just to find the few new ones.
+    """
+    timestamp = DataPoint.timestamp
+    if since_id is not None:
+        where &= DataPoint.datapoint_id > since_id
+        # A unary "+" stops SQLite from using an index for the column.
+        timestamp = NodeList((SQL("+"), DataPoint.timestamp), glue="")
+    if start is not None:
+        where &= timestamp >= start
+    if end is not None:
+        where &= timestamp < end
+    if since is not None:
+        where &= timestamp > since
+    return where
+
+
+def get_new_datapoints(metric=None, prefix=None, since=None, since_id=None,
+                       limit=None):
+    """
+    Return the datapoints of a metric, or of a metric prefix, by ID.
+
+    This is the database equivalent of a :class:`live.Subscription`, used
+    to catch up on missed datapoints.
+
+    Parameters
+    ----------
+    metric, prefix : str, optional
+        See :func:`live.matches`. Exactly one must be given.
+    since : int, optional
+        Only return data after this POSIX timestamp (exclusive).
+    since_id : int, optional
+        Only return datapoints with a ``datapoint_id`` greater than this.
+    limit : int, optional
+        Return at most this many datapoints: those with the smallest IDs.
+
+    Returns
+    -------
+    data : :class:`peewee.ModelSelect`
+        An iterable of ``(metric, datapoint_id, timestamp, value)`` tuples,
+        like those published to :data:`live.hub`. Ordered by
+        ``datapoint_id``.
+    """
+    if metric is not None:
+        where = Metric.name == metric
+    elif prefix:
+        # Not LIKE, since metric names may contain "_".
+        where = ((Metric.name == prefix)
+                 | (fn.substr(Metric.name, 1, len(prefix) + 1)
+                    == prefix + "."))
+    else:
+        where = SQL("1")
+    if since is not None:
+        where &= DataPoint.timestamp > since
+    if since_id is not None:
+        where &= DataPoint.datapoint_id > since_id
+
+    data = (DataPoint.select(Metric.name,
+                             DataPoint.datapoint_id,
+                             DataPoint.timestamp.cast("INTEGER"),
+                             DataPoint.value)
+            .join(Metric)
+            .where(where)
+            .order_by(DataPoint.datapoint_id)
+            .limit(limit)
+            .tuples())
+    return data
+
+
+def get_stats(metric, start=None, end=None, percentiles=()):
+    """
+    Return summary statistics for a given metric.
+
+    Everything but the percentiles is computed by SQLite. For the
+    percentiles, only the ``value`` column is read, straight into an
+    array.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    start, end : int, optional
+        See :func:`get_data`.
+    percentiles : sequence of float, optional
+        The percentiles to compute, from 0 to 100.
+
+    Returns
+    -------
+    stats : dict
+        With ``count``, ``min``, ``max``, ``mean``, ``stddev`` (the
+        population standard deviation), ``first_timestamp`` and
+        ``last_timestamp`` (POSIX timestamps) and ``percentiles`` (a list
+        in the same order as the ``percentiles`` argument) keys. Everything
+        but ``count`` is ``None`` if there's no data.
+    """
+    logger.debug("Querying stats for '%s'" % metric)
+    metric = Metric.get(Metric.name == metric)
+
+    # One transaction, so that every query sees the same data.
+    with _db.atomic():
+        where = _data_filter(metric.metric_id, start, end)
+
+        timestamp = DataPoint.timestamp.cast("INTEGER")
+        count, lo, hi, mean, first, last = (
+            DataPoint.select(fn.COUNT(DataPoint.value),
+                             fn.MIN(DataPoint.value),
+                             fn.MAX(DataPoint.value),
+                             fn.AVG(DataPoint.value),
+                             fn.MIN(timestamp).coerce(False),
+                             fn.MAX(timestamp).coerce(False))
+            .where(where)
+            .tuples()
+            .get()
+        )
+        stats = {"count": count, "min": lo, "max": hi, "mean": mean,
+                 "stddev": None, "first_timestamp": first,
+                 "last_timestamp": last,
+                 "percentiles": [None] * len(percentiles)}
+        if not count:
+            return stats
+
+        # A second pass is much more accurate than using the sum of squares.
+        deviation = DataPoint.value - mean
+        variance = (DataPoint.select(fn.AVG(deviation * deviation))
+                    .where(where)
+                    .scalar())
+        stats["stddev"] = variance ** 0.5
+
+        if percentiles:
+            query = DataPoint.select(DataPoint.value).where(where).tuples()
+            values = np.fromiter((v for v, in query.iterator()),
+                                 dtype=np.float64, count=count)
+            stats["percentiles"] = np.percentile(values, percentiles).tolist()
+        return stats
+
+
+def choose_rollup(metric, points, start=None, end=None):
+    """
+    Pick the rollup resolution to use for a plot of ``points`` points.
+
+    This is the coarsest resolution that still has at least ``points``
+    buckets between the first and last datapoints in the time range.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    points : int
+        The number of points that will be plotted.
+    start, end : int, optional
+        See :func:`get_data`.
+
+    Returns
+    -------
+    resolution : int or None
+        One of :data:`ROLLUP_RESOLUTIONS`, or ``None`` if the raw data
+        should be used instead. That's the case when there are only
+        ``points`` datapoints or fewer, or when even the finest rollup has
+        too few buckets.
+    """
+    metric_id = Metric.get(Metric.name == metric).metric_id
+    where = _data_filter(metric_id, start, end)
+    extent = []
+    for order in (DataPoint.timestamp, DataPoint.timestamp.desc()):
+        query = (DataPoint.select(DataPoint.timestamp.cast("INTEGER"))
+                 .where(where)
+                 .order_by(order)
+                 .limit(1)
+                 .tuples())
+        extent.extend(ts for ts, in query)
+    if not extent:
+        return None
+    span = extent[1] - extent[0]
+
+    # Counting with the coarsest rollup only reads a row per day.
+    largest = max(ROLLUP_RESOLUTIONS)
+    count = (Rollup.select(fn.SUM(Rollup.count))
+             .where(_rollup_filter(metric_id, largest, start, end))
+             .scalar())
+    if not count or count <= points:
+        return None
+
+    for resolution in sorted(ROLLUP_RESOLUTIONS, reverse=True):
+        if span // resolution >= points:
+            logger.debug("Using %ss rollups for '%s'" % (resolution, metric))
+            return resolution
+    return None
+
+
+def get_rollups(metric, resolution, start=None, end=None):
+    """
+    Return the rollups for a given metric as plain tuples.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    resolution : int
+        One of :data:`ROLLUP_RESOLUTIONS`.
+    start, end : int, optional
+        Only return buckets that overlap this time range. See
+        :func:`get_data`.
+
+    Returns
+    -------
+    rollups : :class:`peewee.ModelSelect`
+        An iterable of ``(bucket, count, sum, min, max, first_timestamp,
+        first, last_timestamp, last)`` tuples, ordered by bucket.
+    """
+    logger.debug("Querying %ss rollups for '%s'" % (resolution, metric))
+    metric = Metric.get(Metric.name == metric)
+    rollups = (Rollup.select(Rollup.bucket, Rollup.count, Rollup.sum,
+                             Rollup.min, Rollup.max,
+                             Rollup.first_timestamp, Rollup.first,
+                             Rollup.last_timestamp, Rollup.last)
+               .where(_rollup_filter(metric.metric_id, resolution, start,
+                                     end))
+               .order_by(Rollup.bucket)
+               .tuples())
+    return rollups
+
+
+def _rollup_filter(metric_id, resolution, start=None, end=None):
+    """
+    Return the ``WHERE`` clause for a metric's rollups that overlap a
+    time range.
+    """
+    where = ((Rollup.metric == metric_id)
+             & (Rollup.resolution == resolution))
+    if start is not None:
+        where &= Rollup.bucket > start - resolution
+    if end is not None:
+        where &= Rollup.bucket < end
+    return where
+
+
+def _data_filter(metric_id, start=None, end=None):
+    """
+    Return the ``WHERE`` clause for a metric's data within a time range.
+
+    The ``datapoint_metric_id_timestamp`` index covers both the filter and
+    the ordering by timestamp.
+    """
+    where = DataPoint.metric == metric_id
+    if start is not None:
+        where &= DataPoint.timestamp >= start
+    if end is not None:
+        where &= DataPoint.timestamp < end
+    return where
+
+
 def get_recent_data(metric, age):
     """
     Return all data that is less than `age` seconds old.
@@ -157,16 +1339,29 @@ def get_recent_data(metric, age):
     return data
 
 
-def get_metrics():
+def get_metrics(names=None, metric_ids=None):
     """
-    Return a list of all metrics.
+    Return a list of all metrics, or of the given metrics.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Full metric names.
+    metric_ids : list of int, optional
+        If either ``names`` or ``metric_ids`` is given, only return the
+        metrics that match one of them. They are looked up in a single
+        query.
 
     Returns
     -------
     metrics : iterable of :class:`orm.Metric` objects
     """
     logger.debug("Querying list of metrics.")
-    return Metric.select()
+    query = Metric.select()
+    if names is None and metric_ids is None:
+        return query
+    return query.where(Metric.name.in_(names or [])
+                       | Metric.metric_id.in_(metric_ids or []))
 
 
 def get_units(metric):
@@ -196,7 +1391,68 @@ def get_datapoints():
     """
     logger.debug("Querying list of datapoints.")
     # TODO: Should I raise DoesNotExist if there's no data?
-    return DataPoint.select()
+    # Select the metric in the same query so that serializing a datapoint
+    # doesn't run another query per row.
+    return DataPoint.select(DataPoint, Metric).join(Metric)
+
+
+def paginate(query, key, limit, after=None, before=None):
+    """
+    Return one page of a query, using keyset pagination on ``key``.
+
+    Pages are found with a ``WHERE key > after`` (or ``key < before``)
+    clause rather than ``OFFSET``, so every page is equally fast no matter
+    how deep into the table it is.
+
+    Parameters
+    ----------
+    query : :class:`peewee.ModelSelect`
+    key : :class:`peewee.Field`
+        A unique field to order by. Typically the primary key.
+    limit : int
+        The maximum number of rows in the page.
+    after : optional
+        Return the rows just after this key value.
+    before : optional
+        Return the rows just before this key value. Ignored if ``after``
+        is given.
+
+    Returns
+    -------
+    (rows, has_prev, has_next) : (list, bool, bool)
+        The rows of the page, ordered by ``key``, and whether there are
+        any rows before and after the page. If a cursor is past the end
+        of the data then the page is empty, and ``has_prev`` (or
+        ``has_next``, for ``before``) says whether there are any rows on
+        the other side of the cursor.
+    """
+    if after is None and before is not None:
+        rows = list(query.where(key < before)
+                    .order_by(key.desc())
+                    .limit(limit + 1))
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        if rows:
+            has_next = query.where(key > _key(rows[-1], key)).exists()
+        else:
+            has_next = query.where(key >= before).exists()
+        return rows, has_prev, has_next
+
+    page = query
+    if after is not None:
+        page = page.where(key > after)
+    rows = list(page.order_by(key).limit(limit + 1))
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        has_prev = query.where(key < _key(rows[0], key)).exists()
+    else:
+        has_prev = after is not None and query.where(key <= after).exists()
+    return rows, has_prev, has_next
+
+
+def _key(row, key):
+    return getattr(row, key.name)
 
 
 def get_datapoint(datapoint_id):
@@ -291,7 +1547,14 @@ def update_datapoint(datapoint, metric=None, value=None, timestamp=None):
     # will not end up creating a row.
     # We want people to either (a) use the PK or (b) query the DataPoint
     # object before running this function.
-    datapoint.save()
+    with _db.atomic():
+        old = _rollup_key(datapoint.datapoint_id)
+        datapoint.save()
+        new = _rollup_key(datapoint.datapoint_id)
+        _rebuild_rollups(*old)
+        if new != old:
+            _rebuild_rollups(*new)
+        touch({old[0], new[0]})
 
     return datapoint
 
@@ -315,4 +1578,8 @@ def delete_datapoint(datapoint):
     if isinstance(datapoint, int):
         datapoint = get_datapoint(datapoint)
 
-    datapoint.delete_instance()
+    with _db.atomic():
+        key = _rollup_key(datapoint.datapoint_id)
+        datapoint.delete_instance()
+        _rebuild_rollups(*key)
+        touch([key[0]])
@@ -16,6 +16,69 @@ DB_TYPE = "sqlite"
 # The database file to use. Ignored if DB_TYPE is not "sqlite"
 DATABASE = "./internal.db"
 
+# The maximum number of metric names whose IDs are cached in memory by the
+# write path.
+METRIC_CACHE_SIZE = 10000
+
+# Group datapoints that are POSTed to /api/v1/data by many concurrent requests
+# into a single transaction. A transaction is committed every
+# WRITE_BUFFER_SIZE datapoints or every WRITE_BUFFER_DELAY seconds, whichever
+# comes first.
+# WRITE_BUFFER_DURABILITY is one of:
+#   "commit": requests wait until their data has been committed.
+#   "enqueue": requests return as soon as their data is buffered. Faster, but
+#              buffered data is lost if the server dies and write errors are
+#              only logged.
+WRITE_BUFFER = False
+WRITE_BUFFER_SIZE = 1000
+WRITE_BUFFER_DELAY = 0.01
+WRITE_BUFFER_DURABILITY = "commit"
+
+# The number of results returned by /api/v1/datapoint and /api/v1/metric when
+# no `limit` is given, and the largest `limit` that can be requested.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The largest number of metrics that can be requested at once from
+# GET /api/v1/data.
+DATA_MAX_METRICS = 100
+
+# Compress responses for clients that send a matching Accept-Encoding header.
+# COMPRESS_ENCODINGS are in order of preference. "br" needs the `brotli`
+# package and "zstd" the `zstandard` package, otherwise they're skipped.
+# COMPRESS_LEVEL is the compression level of each encoding. Responses smaller
+# than COMPRESS_MIN_SIZE bytes are not compressed. Streamed responses always
+# are.
+COMPRESS = True
+COMPRESS_ENCODINGS = ["zstd", "br", "gzip"]
+COMPRESS_LEVEL = {"gzip": 6, "br": 4, "zstd": 3}
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = [
+    "application/problem+json",
+    "application/json",
+    "application/javascript",
+    "text/css",
+    "text/html",
+    "text/plain",
+    "image/svg+xml",
+]
+
+# Server-sent events (/api/v1/stream). Off by default: each open stream holds a
+# server thread and a database connection for as long as the page is open, so
+# only enable SSE with a threaded or async server that has plenty of threads
+# (e.g. mod_wsgi's `threads=` option). Only datapoints written by the web
+# server process itself are streamed; data from the socket listeners or from
+# other web server processes is not. When SSE is off, the plots poll
+# GET /api/v1/data with `since_id` instead. New datapoints are collected for
+# SSE_COALESCE_DELAY seconds and sent together. A comment is sent after
+# SSE_HEARTBEAT idle seconds so that closed connections are noticed. A stream
+# that falls SSE_QUEUE_SIZE datapoints behind is closed; the browser then
+# reconnects and catches up from the database.
+SSE = False
+SSE_COALESCE_DELAY = 0.25
+SSE_HEARTBEAT = 15
+SSE_QUEUE_SIZE = 10000
+
 # Set this value to insert a prefix into any generaged URLs. Mainly used when
 # running behind a proxy that is adjusting URLs.
 #URL_PREFIX = "/trendlines"
@@ -26,9 +89,31 @@ broker_url = "redis://redis"
 
 # Socket stuff.
 TARGET_HOST = "0.0.0.0"
+# How the socket listeners store data. "direct" writes straight to DATABASE.
+# "forward" sends data to TRENDLINES_API_URL instead, for deployments where
+# the listener can't access the database file.
+SOCKET_INGEST_MODE = "direct"
 TRENDLINES_API_URL = "http://trendlines/api/v1/data"
+# In "forward" mode: the maximum number of concurrent connections to
+# TRENDLINES_API_URL, how many times to retry a request that couldn't connect
+# or got a 502/503/504, the backoff factor between retries and the request
+# timeout. Times are in seconds.
+FORWARD_POOL_SIZE = 4
+FORWARD_RETRIES = 3
+FORWARD_BACKOFF = 0.5
+FORWARD_TIMEOUT = 10
+# Data received by the socket listeners is written in batches of at most
+# SOCKET_BATCH_SIZE datapoints. A datapoint waits at most SOCKET_BATCH_DELAY
+# seconds before being written.
+SOCKET_BATCH_SIZE = 1000
+SOCKET_BATCH_DELAY = 1.0
+# The maximum number of datapoints that the asyncio ingest server will hold in
+# memory while waiting to write them.
+SOCKET_QUEUE_SIZE = 100000
 TCP_PORT = 2003
 UDP_PORT = 2003
+# Port for Graphite's pickle protocol, as sent by carbon-relay.
+PICKLE_PORT = 2004
 
 # Flask Builtins ################################
 DEBUG = False
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce a series to a smaller number of representative points.
+
+All methods split the series into buckets of (nearly) equal size and keep the
+first and last points as-is. The series is bucketed by position rather than
+by time, which matches the default "sequential" x-axis of the plot.
+
+``lttb``
+    Largest-Triangle-Three-Buckets. Keeps the one point from each bucket
+    that forms the largest triangle with the point kept from the previous
+    bucket and the average of the next bucket. Generally the best-looking
+    method.
+``minmax``
+    Keeps the minimum and the maximum of each bucket. Every spike is kept.
+``avg``
+    Replaces each bucket with its average. Smooths out noise, but also
+    spikes.
+
+``lttb`` and ``minmax`` return a subset of the original points. ``avg``
+returns new points.
+
+Long time ranges are reduced from the pre-aggregated rollups (see
+:func:`db.choose_rollup`) rather than from the raw data. See
+:func:`downsample_rollups`.
+"""
+import numpy as np
+
+from trendlines import utils
+
+METHODS = ("lttb", "minmax", "avg")
+
+# The smallest number of points that can be requested. LTTB needs at least
+# one bucket in addition to the first and last points.
+MIN_POINTS = 3
+
+
+def _buckets(length, n_buckets):
+    """
+    Split ``range(1, length - 1)`` into ``n_buckets`` nearly-equal buckets.
+
+    Returns
+    -------
+    (index, mask) : (2D array of int, 2D array of bool)
+        Row ``i`` of ``index`` holds the indices of bucket ``i``, padded
+        to the length of the largest bucket. ``mask`` is ``False`` for the
+        padding.
+    """
+    edges = np.linspace(1, length - 1, n_buckets + 1)
+    edges = edges.round().astype(np.int64)
+    starts, stops = edges[:-1], edges[1:]
+    width = int((stops - starts).max())
+    index = starts[:, None] + np.arange(width)[None, :]
+    mask = index < stops[:, None]
+    return np.minimum(index, length - 2), mask
+
+
+def _masked_argextreme(values, index, mask):
+    """
+    Return the indices of the min and max of each bucket.
+    """
+    v = values[index]
+    lo = np.where(mask, v, np.inf).argmin(axis=1)
+    hi = np.where(mask, v, -np.inf).argmax(axis=1)
+    rows = np.arange(index.shape[0])
+    return index[rows, lo], index[rows, hi]
+
+
+def lttb(values, n):
+    """
+    Select ``n`` points using Largest-Triangle-Three-Buckets.
+
+    Parameters
+    ----------
+    values : 1D array of float
+    n : int
+        The number of points to keep. Must be at least :data:`MIN_POINTS`.
+
+    Returns
+    -------
+    index : 1D array of int
+        The sorted indices of the points to keep.
+    """
+    length = len(values)
+    if n >= length:
+        return np.arange(length)
+
+    index, mask = _buckets(length, n - 2)
+    x = index.astype(np.float64)
+    y = values[index]
+
+    # The average of each bucket, plus the last point which acts as the
+    # "next bucket" of the last bucket.
+    counts = mask.sum(axis=1)
+    avg_x = np.append(np.where(mask, x, 0).sum(axis=1) / counts, length - 1)
+    avg_y = np.append(np.where(mask, y, 0).sum(axis=1) / counts,
+                      values[-1])
+
+    selected = np.empty(n, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    prev_x, prev_y = 0.0, values[0]
+    for i in range(n - 2):
+        # Twice the triangle area; the factor of 2 doesn't change the max.
+        area = np.abs((prev_x - avg_x[i + 1]) * (y[i] - prev_y)
+                      - (prev_x - x[i]) * (avg_y[i + 1] - prev_y))
+        area[~mask[i]] = -1
+        best = area.argmax()
+        selected[i + 1] = index[i, best]
+        prev_x, prev_y = x[i, best], y[i, best]
+
+    return selected
+
+
+def minmax(values, n):
+    """
+    Select about ``n`` points by keeping the min and max of each bucket.
+
+    Parameters
+    ----------
+    values : 1D array of float
+    n : int
+        The number of points to keep. Must be at least :data:`MIN_POINTS`.
+
+    Returns
+    -------
+    index : 1D array of int
+        The sorted, unique indices of the points to keep.
+    """
+    length = len(values)
+    if n >= length:
+        return np.arange(length)
+
+    index, mask = _buckets(length, max(1, (n - 2) // 2))
+    lo, hi = _masked_argextreme(values, index, mask)
+    return np.unique(np.concatenate(([0, length - 1], lo, hi)))
+
+
+def avg(values, timestamps, n, position=None):
+    """
+    Replace buckets of points with their average.
+
+    Parameters
+    ----------
+    values : 1D array of float
+    timestamps : 1D array of float
+    n : int
+        The number of points to return. Must be at least :data:`MIN_POINTS`.
+    position : 1D array of float, optional
+        The position of each point in the full series. Defaults to
+        ``0, 1, 2, ...``.
+
+    Returns
+    -------
+    (position, timestamps, values) : tuple of 1D arrays of float
+        The average position, timestamp and value of each bucket.
+    """
+    length = len(values)
+    if position is None:
+        position = np.arange(length, dtype=np.float64)
+    if n >= length:
+        return position, timestamps, values
+
+    index, mask = _buckets(length, n - 2)
+    counts = mask.sum(axis=1)
+
+    def _mean(a):
+        inner = np.where(mask, a[index], 0).sum(axis=1) / counts
+        return np.concatenate(([a[0]], inner, [a[-1]]))
+
+    return _mean(position), _mean(timestamps), _mean(values)
+
+
+def keep_violations(values, selected, lower_limit=None, upper_limit=None,
+                    n=None):
+    """
+    Add the most extreme out-of-limit point of each bucket to a selection.
+
+    Methods like LTTB can skip over a point that is outside of a metric's
+    limits. This makes sure that every violation is still visible.
+
+    Parameters
+    ----------
+    values : 1D array of float
+    selected : 1D array of int
+        The indices selected by :func:`lttb` or :func:`minmax`.
+    lower_limit, upper_limit : float, optional
+    n : int, optional
+        The number of buckets to check. Defaults to ``len(selected)``.
+
+    Returns
+    -------
+    index : 1D array of int
+        The sorted, unique indices of the points to keep.
+    """
+    length = len(values)
+    if n is None:
+        n = len(selected)
+    if (lower_limit is None and upper_limit is None) or length <= 2 or n < 1:
+        return selected
+
+    index, mask = _buckets(length, min(n, length - 2))
+    lo, hi = _masked_argextreme(values, index, mask)
+    extra = [selected]
+    if lower_limit is not None:
+        extra.append(lo[values[lo] < lower_limit])
+    if upper_limit is not None:
+        extra.append(hi[values[hi] > upper_limit])
+    return np.unique(np.concatenate(extra))
+
+
+def downsample_rows(rows, n, method="lttb", lower_limit=None,
+                    upper_limit=None, columnar=False):
+    """
+    Downsample a metric's data and format it like :func:`utils.format_data`.
+
+    For ``lttb`` and ``minmax``, points outside of the metric's limits are
+    always kept. See :func:`keep_violations`.
+
+    Parameters
+    ----------
+    rows : iterable of ``(datapoint_id, timestamp, value)`` tuples
+        As returned by :func:`db.get_raw_data`.
+    n : int
+        The approximate number of points to return.
+    method : str, optional
+        One of :data:`METHODS`.
+    lower_limit, upper_limit : float, optional
+        The metric's limits.
+    columnar : bool, optional
+        Return columns instead of rows.
+
+    Returns
+    -------
+    rows : list of dict
+        Each has ``timestamp``, ``value``, ``id`` and ``n`` keys, like
+        the rows of :func:`utils.format_data`. ``n`` is the position of the
+        point in the full series. ``id`` is ``None`` for the ``avg``
+        method.
+
+        If ``columnar`` is true, a dict of lists with ``timestamps``,
+        ``values``, ``ids`` and ``n`` keys instead. ``timestamps`` are
+        integer POSIX timestamps.
+
+    Raises
+    ------
+    ValueError
+        ``method`` is not one of :data:`METHODS`.
+    """
+    _check_method(method)
+    data = np.array(list(rows), dtype=np.float64).reshape(-1, 3)
+    ids, timestamps, values = data.T
+    return _downsample(ids, timestamps, values, None, n, method,
+                       lower_limit, upper_limit, columnar)
+
+
+def downsample_rollups(rollups, n, method="lttb", lower_limit=None,
+                       upper_limit=None, columnar=False):
+    """
+    Downsample a metric's rollups and format them like
+    :func:`downsample_rows`.
+
+    For ``avg``, each bucket is its mean. For ``lttb`` and ``minmax``, each
+    bucket is its minimum and maximum, placed at the times of the first
+    and last datapoints of the bucket, in whichever order runs from the
+    bucket's first value towards its last. Every spike is therefore kept
+    as long as the buckets are smaller than the plot's pixels.
+
+    Parameters
+    ----------
+    rollups : iterable of tuples
+        As returned by :func:`db.get_rollups`.
+    n, method, lower_limit, upper_limit, columnar :
+        See :func:`downsample_rows`.
+
+    Returns
+    -------
+    (rows, total) : (list of dict or dict of list, int)
+        ``rows`` is like the output of :func:`downsample_rows`, except
+        that ``id`` is always ``None``. ``n`` is the approximate position
+        of the point in the full series. ``total`` is the number of raw
+        datapoints that the rollups cover.
+
+    Raises
+    ------
+    ValueError
+        ``method`` is not one of :data:`METHODS`.
+    """
+    _check_method(method)
+    data = np.array(list(rollups), dtype=np.float64).reshape(-1, 9)
+    (_, count, total, lo, hi,
+     first_ts, first, last_ts, last) = data.T
+    # The position of the first datapoint of each bucket.
+    start = np.cumsum(count) - count
+
+    if method == "avg":
+        values = total / count
+        timestamps = (first_ts + last_ts) / 2
+        position = start + (count - 1) / 2
+    else:
+        rising = first <= last
+        values = np.column_stack((np.where(rising, lo, hi),
+                                  np.where(rising, hi, lo))).ravel()
+        timestamps = np.column_stack((first_ts, last_ts)).ravel()
+        position = np.column_stack((start, start + count - 1)).ravel()
+        # A bucket with a single datapoint is a single point.
+        keep = np.ones(len(values), dtype=bool)
+        keep[1::2] = count > 1
+        values = values[keep]
+        timestamps = timestamps[keep]
+        position = position[keep]
+
+    rows = _downsample(None, timestamps, values, position, n, method,
+                       lower_limit, upper_limit, columnar)
+    return rows, int(count.sum())
+
+
+def _check_method(method):
+    if method not in METHODS:
+        msg = "Invalid method '{}'. Must be one of {}."
+        raise ValueError(msg.format(method, METHODS))
+
+
+def _downsample(ids, timestamps, values, position, n, method, lower_limit,
+                upper_limit, columnar=False):
+    """
+    Implementation of :func:`downsample_rows` and
+    :func:`downsample_rollups`.
+
+    ``ids`` and ``position`` may be ``None``, meaning "no IDs" and
+    ``0, 1, 2, ...`` respectively.
+    """
+    if method == "avg":
+        position, timestamps, values = avg(values, timestamps, n, position)
+        ids = None
+    else:
+        if method == "lttb":
+            selected = lttb(values, n)
+        else:
+            selected = minmax(values, n)
+        selected = keep_violations(values, selected, lower_limit,
+                                   upper_limit, n)
+        position = selected if position is None else position[selected]
+        if ids is not None:
+            ids = ids[selected].astype(np.int64).tolist()
+        timestamps = timestamps[selected]
+        values = values[selected]
+
+    if ids is None:
+        ids = [None] * len(values)
+    timestamps = timestamps.round()
+    position = np.round(position).astype(np.int64).tolist()
+
+    if columnar:
+        return {"timestamps": timestamps.astype(np.int64).tolist(),
+                "values": values.tolist(),
+                "ids": ids,
+                "n": position}
+
+    return [
+        {"timestamp": utils.format_timestamp(ts), "value": value,
+         "id": id_, "n": i}
+        for ts, value, id_, i
+        in zip(timestamps.tolist(), values.tolist(), ids, position)
+    ]
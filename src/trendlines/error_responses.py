@@ -15,6 +15,7 @@ class ErrorResponseType(Enum):
     INVALID_REQUEST = 3
     ALREADY_EXISTS = 4
     INTEGRITY_ERROR = 5
+    NOT_ACCEPTABLE = 6
 
     def __str__(self):
         return self.name.lower().replace("_", "-")
@@ -68,6 +69,24 @@ class ErrorResponse(object):
             detail = "Missing required key '{}'".format(key)
         return error_response(400, ErrorResponseType.INVALID_REQUEST, detail)
 
+    @classmethod
+    def invalid_query_parameter(cls, name, value, reason):
+        detail = "Invalid value '{}' for query parameter '{}': {}"
+        detail = detail.format(value, name, reason)
+        return error_response(400, ErrorResponseType.INVALID_REQUEST, detail)
+
+    @classmethod
+    def streaming_disabled(cls):
+        detail = ("Server-sent events are not enabled on this server. Poll"
+                  " /api/v1/data with 'since_id' instead.")
+        return error_response(404, ErrorResponseType.NOT_FOUND, detail)
+
+    @classmethod
+    def format_not_available(cls, name):
+        detail = ("The '{}' format is not available on this server. Its"
+                  " optional dependency is not installed.").format(name)
+        return error_response(406, ErrorResponseType.NOT_ACCEPTABLE, detail)
+
 
 class Rfc7807ErrorResponse(object):
     """
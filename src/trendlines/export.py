@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Binary formats for exporting data.
+
+Data is given as columns: 1D numpy arrays of the same length, such as
+``timestamp`` (integer POSIX timestamps), ``value`` and ``id``. Each column
+is written as a single contiguous, typed array, so that it can be loaded
+without any parsing.
+
+``arrow``
+    An `Arrow IPC stream`_ with a single record batch. ``timestamp`` is an
+    Arrow ``timestamp[s, tz=UTC]``. Any metadata is JSON in the schema's
+    ``trendlines`` metadata key. Needs the ``pyarrow`` package.
+``npy``
+    A NumPy structured array with a field per column. Metadata is not
+    included.
+``npz``
+    An (uncompressed) NumPy ``.npz`` file with an array per column.
+    Metadata is not included.
+``msgpack``
+    A MessagePack map with the metadata and a binary value per column,
+    holding the raw array. The ``dtypes`` key maps each column to its
+    NumPy dtype string. Needs the ``msgpack`` package.
+
+.. _`Arrow IPC stream`:
+   https://arrow.apache.org/docs/format/Columnar.html#ipc-streaming-format
+"""
+import io
+import json
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:                 # pragma: no cover
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:                 # pragma: no cover
+    pyarrow = None
+
+MIMETYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "npy": "application/x-npy",
+    "npz": "application/x-npz",
+    "msgpack": "application/msgpack",
+}
+
+# Columns that hold POSIX timestamps.
+_TIMESTAMP_COLUMNS = ("timestamp", )
+
+
+def _arrow(columns, metadata):
+    arrays = []
+    for name, column in columns.items():
+        type_ = None
+        if name in _TIMESTAMP_COLUMNS:
+            type_ = pyarrow.timestamp("s", tz="UTC")
+        arrays.append(pyarrow.array(column, type=type_))
+    table = pyarrow.Table.from_arrays(arrays, list(columns))
+    table = table.replace_schema_metadata(
+        {"trendlines": json.dumps(metadata)}
+    )
+
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def _npy(columns, metadata):
+    dtype = [(name, column.dtype) for name, column in columns.items()]
+    length = len(next(iter(columns.values()), []))
+    data = np.empty(length, dtype=dtype)
+    for name, column in columns.items():
+        data[name] = column
+    buf = io.BytesIO()
+    np.save(buf, data, allow_pickle=False)
+    return buf.getvalue()
+
+
+def _npz(columns, metadata):
+    buf = io.BytesIO()
+    np.savez(buf, **columns)
+    return buf.getvalue()
+
+
+def _msgpack(columns, metadata):
+    data = dict(metadata)
+    data["dtypes"] = {name: column.dtype.str
+                      for name, column in columns.items()}
+    for name, column in columns.items():
+        data[name] = np.ascontiguousarray(column).tobytes()
+    return msgpack.packb(data, use_bin_type=True)
+
+
+# Each takes ``(columns, metadata)`` and returns bytes.
+WRITERS = {"npy": _npy, "npz": _npz}
+if pyarrow is not None:
+    WRITERS["arrow"] = _arrow
+if msgpack is not None:
+    WRITERS["msgpack"] = _msgpack
+
+
+def write(name, columns, metadata=None):
+    """
+    Write columns of data in a binary format.
+
+    Parameters
+    ----------
+    name : str
+        One of :data:`WRITERS`.
+    columns : dict of str: 1D array
+        The columns, in order.
+    metadata : dict, optional
+        JSON-serializable data about the columns, such as the units.
+
+    Returns
+    -------
+    data : bytes
+
+    Raises
+    ------
+    KeyError
+        ``name`` is not available.
+    """
+    return WRITERS[name](columns, metadata or {})
@@ -0,0 +1,698 @@
+# -*- coding: utf-8 -*-
+"""
+Write data that was received by the plaintext socket listeners.
+
+Data can be written in one of two ways, selected by the
+``SOCKET_INGEST_MODE`` config value:
+
+``direct``
+    Write straight to the database via :func:`db.insert_datapoints`. This
+    is the same code path that ``POST /api/v1/data`` uses.
+``forward``
+    Send the data to the web tier's ``/api/v1/data`` route
+    (``TRENDLINES_API_URL``) using a :class:`Forwarder`. Useful for split
+    deployments where the listener can't access the database file.
+"""
+import math
+import pickle
+import select
+import socket
+import struct
+import threading
+import time
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from trendlines import db
+from trendlines import logger
+from trendlines import orm
+from trendlines import utils
+
+INGEST_MODES = ("direct", "forward")
+
+# Lines longer than this are not valid plaintext protocol data. This keeps a
+# misbehaving client from making us buffer an unbounded amount of data.
+MAX_LINE_LENGTH = 4096
+
+# How much TCP data is read, and parsed, at once.
+READ_SIZE = 65536
+
+# The largest possible UDP payload.
+MAX_DATAGRAM_SIZE = 65535
+
+# The maximum number of datagrams read from the socket before checking if
+# the current batch is due to be written.
+MAX_DATAGRAMS_PER_LOOP = 1000
+
+# The largest pickle protocol message that we'll accept. This is the same as
+# carbon's limit.
+MAX_PICKLE_LENGTH = 2 ** 20
+
+# Size of the kernel's receive buffer for the UDP socket. A large buffer lets
+# us absorb bursts without the kernel dropping datagrams.
+UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+
+
+class Batcher(object):
+    """
+    Collect parsed socket data and write it in batches.
+
+    Items are ``(metric, value, timestamp)`` rows, as accepted by
+    :func:`db.insert_datapoints`.
+
+    A batch is written when it has ``max_size`` items or when its oldest
+    item is ``max_delay`` seconds old, whichever happens first. Call
+    :meth:`flush` to write any remaining items.
+
+    Parameters
+    ----------
+    write : callable
+        Accepts a list of rows. See :func:`make_writer`.
+    max_size : int, optional
+        The maximum number of items per batch.
+    max_delay : float, optional
+        The maximum number of seconds that an item will wait before being
+        written. This is only checked when items are added; see
+        :meth:`flush_if_due` for a way to check it at other times.
+    """
+    def __init__(self, write, max_size=1000, max_delay=1.0):
+        self.write = write
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._items = []
+        self._started = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        """
+        Add an item, writing the batch if it's full or old enough.
+        """
+        if not self._items:
+            self._started = time.monotonic()
+        self._items.append(item)
+        if len(self._items) >= self.max_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def extend(self, items):
+        """
+        Add many items, writing every batch that gets filled.
+        """
+        if not items:
+            return
+        if not self._items:
+            self._started = time.monotonic()
+        self._items.extend(items)
+        while len(self._items) >= self.max_size:
+            batch = self._items[:self.max_size]
+            self._items = self._items[self.max_size:]
+            self._write(batch)
+        self.flush_if_due()
+
+    def time_remaining(self):
+        """
+        Return the number of seconds until the batch must be written.
+
+        Returns ``None`` if the batch is empty.
+        """
+        if not self._items:
+            return None
+        elapsed = time.monotonic() - self._started
+        return max(0, self.max_delay - elapsed)
+
+    def flush_if_due(self):
+        """
+        Write the batch if its oldest item is at least ``max_delay`` old.
+        """
+        if self._items and self.time_remaining() == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all collected items.
+
+        A batch that fails to be written is logged and dropped, so that one
+        bad batch doesn't close the connection that it came from.
+
+        Returns
+        -------
+        count : int
+            The number of datapoints written.
+        """
+        if not self._items:
+            return 0
+        items, self._items = self._items, []
+        return self._write(items)
+
+    def _write(self, items):
+        try:
+            return self.write(items)
+        except Exception:
+            logger.exception("Failed to write batch of %s datapoints."
+                             % len(items))
+            return 0
+
+
+class LineBuffer(object):
+    """
+    Split a stream of plaintext protocol data into complete lines.
+
+    Data is fed in arbitrary chunks, such as those read from a socket. Only
+    the unfinished line at the end of each chunk is buffered. An unfinished
+    line longer than :data:`MAX_LINE_LENGTH` is discarded, along with the
+    rest of it as it arrives.
+
+    Parameters
+    ----------
+    source : str, optional
+        A label used in log messages.
+    """
+    def __init__(self, source="TCP"):
+        self.source = source
+        self.discarded = 0
+        self._partial = b""
+        self._discarding = False
+
+    def feed(self, data):
+        """
+        Add a chunk of data.
+
+        Parameters
+        ----------
+        data : bytes
+
+        Returns
+        -------
+        lines : bytes
+            All of the lines that were completed by ``data``. May be empty.
+        """
+        if self._discarding:
+            end = data.find(b"\n")
+            if end == -1:
+                return b""
+            data = data[end + 1:]
+            self._discarding = False
+
+        end = data.rfind(b"\n")
+        if end == -1:
+            lines = b""
+            self._partial += data
+        else:
+            lines = self._partial + data[:end + 1]
+            self._partial = data[end + 1:]
+
+        if len(self._partial) > MAX_LINE_LENGTH:
+            logger.warning("%s: Discarded a line longer than %s bytes."
+                           % (self.source, MAX_LINE_LENGTH))
+            self.discarded += 1
+            self._partial = b""
+            self._discarding = True
+        return lines
+
+    def close(self):
+        """
+        Return the last line, which may not end with a newline.
+        """
+        lines, self._partial = self._partial, b""
+        if self._discarding:
+            return b""
+        return lines
+
+
+def parse_lines(lines, source="TCP"):
+    """
+    Parse plaintext protocol lines, logging any that are invalid.
+
+    Parameters
+    ----------
+    lines : bytes
+        Any number of newline-separated lines.
+    source : str, optional
+        A label used in log messages.
+
+    Returns
+    -------
+    (rows, rejected) : (list of tuple, int)
+        The ``(metric, value, timestamp)`` rows that were parsed and the
+        number of lines that failed to parse.
+    """
+    if not lines:
+        return [], 0
+    parsed = utils.parse_socket_buffer(lines)
+    for _, line in parsed.errors:
+        logger.warning("%s: Failed to parse `%s`." % (source, line))
+    return parsed.rows(), len(parsed.errors)
+
+
+def read_lines(stream, batcher, source="TCP"):
+    """
+    Parse plaintext protocol lines from a stream until EOF.
+
+    The stream is read :data:`READ_SIZE` bytes at a time and each chunk of
+    complete ``metric value [timestamp]`` lines is parsed with
+    :func:`utils.parse_socket_buffer` and added to ``batcher``. Lines that
+    can't be parsed are logged and skipped. Blank lines are ignored.
+
+    Parameters
+    ----------
+    stream : binary file-like object
+        Such as the ``rfile`` of a :class:`socketserver.StreamRequestHandler`.
+        Must support ``read1``.
+    batcher : :class:`Batcher`
+    source : str, optional
+        A label used in log messages.
+
+    Returns
+    -------
+    (accepted, rejected) : (int, int)
+        The number of lines that were parsed and that failed to parse.
+    """
+    buffer = LineBuffer(source)
+    accepted = rejected = 0
+    while True:
+        data = stream.read1(READ_SIZE)
+        lines = buffer.feed(data) if data else buffer.close()
+        rows, bad = parse_lines(lines, source)
+        batcher.extend(rows)
+        accepted += len(rows)
+        rejected += bad
+        if not data:
+            break
+
+    return accepted, rejected + buffer.discarded
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """
+    An unpickler that refuses to load any classes or functions.
+
+    Graphite's pickle protocol only uses lists, tuples, strings and numbers,
+    none of which need :meth:`find_class`. Refusing everything else means
+    that a malicious pickle can't run arbitrary code.
+    """
+    def find_class(self, module, name):
+        msg = "Refusing to unpickle '%s.%s'." % (module, name)
+        raise pickle.UnpicklingError(msg)
+
+
+def parse_pickle_data(data):
+    """
+    Parse a single Graphite pickle protocol message.
+
+    Parameters
+    ----------
+    data : bytes
+        A pickled list of ``(metric, (timestamp, value))`` tuples, without
+        the length header.
+
+    Returns
+    -------
+    (points, rejected) : (list of tuple, int)
+        The parsed ``(metric, value, timestamp)`` rows and the number of
+        items that were not valid.
+
+    Raises
+    ------
+    pickle.UnpicklingError
+        The message could not be unpickled or is not a list.
+    """
+    try:
+        items = SafeUnpickler(BytesIO(data)).load()
+    except pickle.UnpicklingError:
+        raise
+    except Exception as err:
+        raise pickle.UnpicklingError(str(err))
+
+    if not isinstance(items, (list, tuple)):
+        raise pickle.UnpicklingError("Expected a list, got %s."
+                                     % type(items).__name__)
+
+    points = []
+    rejected = 0
+    for item in items:
+        try:
+            metric, (time_, value) = item
+            if isinstance(metric, bytes):
+                metric = metric.decode("utf-8")
+            if not isinstance(metric, str) or not metric:
+                raise ValueError
+            value = float(value)
+            if not math.isfinite(value):
+                # NaN and +/-Infinity can't be stored.
+                raise ValueError
+            time_ = int(float(time_))
+            if not utils.is_valid_timestamp(time_):
+                # It would overflow when written or read back.
+                raise ValueError
+            point = (metric, value, time_)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning("Pickle: Invalid item `%r`." % (item, ))
+            rejected += 1
+            continue
+        points.append(point)
+
+    return points, rejected
+
+
+def read_pickle(stream, write):
+    """
+    Read Graphite pickle protocol messages from a stream until EOF.
+
+    Each message is a 4-byte, big-endian length followed by that many
+    bytes of pickled data. See :func:`parse_pickle_data`. Each message
+    is written with a single call to ``write``.
+
+    Parameters
+    ----------
+    stream : binary file-like object
+        Such as the ``rfile`` of a :class:`socketserver.StreamRequestHandler`.
+    write : callable
+        Accepts a list of rows. See :func:`make_writer`.
+
+    Returns
+    -------
+    (accepted, rejected) : (int, int)
+        The number of datapoints that were parsed and that failed to parse.
+    """
+    header = struct.Struct("!L")
+    accepted = rejected = 0
+    while True:
+        data = stream.read(header.size)
+        if len(data) < header.size:
+            break
+
+        length, = header.unpack(data)
+        if length > MAX_PICKLE_LENGTH:
+            # We can't find the start of the next message, so give up.
+            logger.warning("Pickle: Message of %s bytes is longer than %s"
+                           " bytes. Closing the connection."
+                           % (length, MAX_PICKLE_LENGTH))
+            break
+
+        data = stream.read(length)
+        if len(data) < length:
+            logger.warning("Pickle: Connection closed mid-message.")
+            break
+
+        try:
+            points, bad = parse_pickle_data(data)
+        except pickle.UnpicklingError as err:
+            logger.warning("Pickle: Failed to unpickle message: %s" % err)
+            continue
+
+        rejected += bad
+        if not points:
+            continue
+        try:
+            write(points)
+        except Exception:
+            # Don't let one bad message close the connection. The message
+            # is dropped.
+            logger.exception("Pickle: Failed to write %s datapoints."
+                             % len(points))
+            continue
+        accepted += len(points)
+
+    return accepted, rejected
+
+
+def write_direct(points):
+    """
+    Write parsed socket data directly to the database.
+
+    Parameters
+    ----------
+    points : list of tuple
+        ``(metric, value, timestamp)`` rows. These are passed straight to
+        :func:`db.insert_datapoints`.
+
+    Returns
+    -------
+    count : int
+        The number of datapoints written.
+    """
+    count = db.insert_datapoints(points)
+    logger.debug("Wrote %s datapoints to the database." % count)
+    return count
+
+
+class DirectWriter(object):
+    """
+    Write parsed socket data directly to the database, opening it lazily.
+
+    The database is initialized (and migrated) by the first write rather
+    than when the writer is created. The celery worker creates its writer
+    in the parent process, before the pool is forked, so opening the
+    database there would both share it with the children and race the web
+    app's migrations.
+
+    Parameters
+    ----------
+    database : str
+        The name/path of the database, as given by ``config['DATABASE']``.
+    """
+    def __init__(self, database):
+        self.database = database
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def __call__(self, points):
+        """
+        Write a batch of parsed socket data. See :func:`write_direct`.
+        """
+        with self._lock:
+            if not self._ready:
+                orm.create_db(self.database)
+                self._ready = True
+        return write_direct(points)
+
+
+class Forwarder(object):
+    """
+    Forward parsed socket data to the ``/api/v1/data`` route.
+
+    Each batch is sent as a single JSON array POST. Connections are kept
+    alive and reused, so a burst of data doesn't open (and leave in
+    ``TIME_WAIT``) a new connection per batch.
+
+    Parameters
+    ----------
+    url : str
+        The full URL of the ``/api/v1/data`` route.
+    pool_size : int, optional
+        The maximum number of concurrent connections. Any more requests
+        wait for a connection to be free.
+    retries : int, optional
+        How many times to retry a request that failed to connect or that
+        got a ``502``, ``503`` or ``504`` response. Requests that fail
+        after being sent are not retried, since the data may have been
+        added.
+    backoff : float, optional
+        The backoff factor between retries, in seconds. See
+        :class:`urllib3.util.retry.Retry`.
+    timeout : float, optional
+        Seconds to wait to connect and for the response.
+    """
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, url, pool_size=4, retries=3, backoff=0.5, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=self.RETRY_STATUSES,
+            backoff_factor=backoff,
+            # Retry POSTs too. Otherwise only idempotent methods are retried.
+            method_whitelist=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, points):
+        """
+        Send a batch of parsed socket data.
+
+        Parameters
+        ----------
+        points : list of tuple
+            ``(metric, value, timestamp)`` rows.
+
+        Returns
+        -------
+        count : int
+            The number of datapoints that were added.
+        """
+        if not points:
+            return 0
+
+        data = [{"metric": metric, "value": value, "time": time_}
+                for metric, value, time_ in points]
+        try:
+            r = self.session.post(self.url, json=data, timeout=self.timeout)
+        except requests.RequestException as err:
+            logger.error("Failed to forward %s datapoints: %s"
+                         % (len(points), err))
+            return 0
+
+        if r.status_code not in (201, 207):
+            logger.error("Failed to forward %s datapoints: HTTP %s"
+                         % (len(points), r.status_code))
+            return 0
+
+        count = r.json()['added']
+        if count != len(points):
+            logger.warning("Only %s of %s forwarded datapoints were added."
+                           % (count, len(points)))
+        logger.debug("Forwarded %s datapoints." % count)
+        return count
+
+    def close(self):
+        self.session.close()
+
+
+def bind_udp(host, port):
+    """
+    Create a non-blocking UDP socket for the plaintext protocol.
+
+    Parameters
+    ----------
+    host : str
+    port : int
+
+    Returns
+    -------
+    sock : :class:`socket.socket`
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        UDP_RECEIVE_BUFFER)
+    except OSError:
+        logger.warning("Unable to set the UDP receive buffer size.")
+    sock.setblocking(False)
+    sock.bind((host, port))
+    return sock
+
+
+def read_datagrams(sock, batcher):
+    """
+    Read all of the datagrams waiting on a non-blocking socket.
+
+    At most :data:`MAX_DATAGRAMS_PER_LOOP` datagrams are read. Each datagram
+    may contain many newline-separated lines.
+
+    Parameters
+    ----------
+    sock : :class:`socket.socket`
+        A non-blocking UDP socket.
+    batcher : :class:`Batcher`
+
+    Returns
+    -------
+    (accepted, rejected) : (int, int)
+        The number of lines that were parsed and that failed to parse.
+    """
+    accepted = rejected = 0
+    for _ in range(MAX_DATAGRAMS_PER_LOOP):
+        try:
+            data = sock.recv(MAX_DATAGRAM_SIZE)
+        except (BlockingIOError, InterruptedError):
+            break
+        rows, bad = parse_lines(data, "UDP")
+        batcher.extend(rows)
+        accepted += len(rows)
+        rejected += bad
+    return accepted, rejected
+
+
+def serve_udp(sock, batcher, stop=None, poll_interval=0.5):
+    """
+    Receive plaintext protocol datagrams forever.
+
+    Parsed data is written in batches by ``batcher``: whenever a batch is
+    full or its oldest item is ``batcher.max_delay`` seconds old.
+
+    Parameters
+    ----------
+    sock : :class:`socket.socket`
+        A non-blocking UDP socket, such as one made by :func:`bind_udp`.
+    batcher : :class:`Batcher`
+    stop : :class:`threading.Event`, optional
+        If given, stop serving once this is set. Any remaining data is
+        written before returning.
+    poll_interval : float, optional
+        How often, in seconds, to check ``stop``.
+    """
+    while stop is None or not stop.is_set():
+        timeout = batcher.time_remaining()
+        if stop is not None and (timeout is None or timeout > poll_interval):
+            timeout = poll_interval
+
+        readable, _, _ = select.select([sock], [], [], timeout)
+        try:
+            if readable:
+                read_datagrams(sock, batcher)
+            batcher.flush_if_due()
+        except Exception:
+            # Don't let one bad batch kill the listener. UDP is
+            # fire-and-forget anyway, so the batch is dropped.
+            logger.exception("UDP: Failed to write batch.")
+
+    batcher.flush()
+
+
+def make_writer(config):
+    """
+    Create the function that the socket listeners use to write data.
+
+    In ``direct`` mode the database is initialized by the first write. See
+    :class:`DirectWriter`.
+
+    Parameters
+    ----------
+    config : dict-like
+        The Flask or Celery configuration. ``SOCKET_INGEST_MODE``,
+        ``DATABASE``, ``TRENDLINES_API_URL`` and the ``FORWARD_*`` values
+        are used.
+
+    Returns
+    -------
+    writer : callable
+        A function that accepts a list of ``(metric, value, timestamp)``
+        rows and returns the number of datapoints written.
+
+    Raises
+    ------
+    ValueError
+        ``SOCKET_INGEST_MODE`` is not one of :data:`INGEST_MODES`.
+    """
+    mode = config['SOCKET_INGEST_MODE']
+    if mode not in INGEST_MODES:
+        msg = "Invalid SOCKET_INGEST_MODE '{}'. Must be one of {}."
+        raise ValueError(msg.format(mode, INGEST_MODES))
+
+    logger.info("Socket data will be written using '%s' mode." % mode)
+    if mode == "direct":
+        return DirectWriter(config['DATABASE'])
+
+    return Forwarder(
+        config['TRENDLINES_API_URL'],
+        pool_size=config['FORWARD_POOL_SIZE'],
+        retries=config['FORWARD_RETRIES'],
+        backoff=config['FORWARD_BACKOFF'],
+        timeout=config['FORWARD_TIMEOUT'],
+    )
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio server for the plaintext protocol.
+
+This is an alternative to the Celery-based socket listeners in
+:mod:`trendlines.celery_factory`. A single process handles any number of
+concurrent TCP connections as well as UDP datagrams. Parsed data is put onto
+a shared in-memory queue which is drained by a single batch writer.
+
+Run it with::
+
+    python -m trendlines.ingest_server
+"""
+import asyncio
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from flask import Config
+
+from trendlines import _logging
+from trendlines import ingest
+from trendlines import logger
+
+CFG_VAR = "TRENDLINES_CONFIG_FILE"
+
+
+def load_config():
+    """
+    Load the default config and then the user's config file, if any.
+
+    This is the same configuration that the Flask app uses, but without
+    needing to create the app.
+
+    Returns
+    -------
+    config : :class:`flask.Config`
+    """
+    config = Config(str(Path.cwd()))
+    config.from_object('trendlines.default_config')
+    if config.from_envvar(CFG_VAR, silent=True):
+        logger.info("Loaded config file '%s'" % os.environ[CFG_VAR])
+    else:
+        logger.warning("No config file loaded. Set %s to load one." % CFG_VAR)
+    return config
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.add_datagram(data)
+
+
+class IngestServer(object):
+    """
+    Receive plaintext protocol data over TCP and UDP.
+
+    Parameters
+    ----------
+    write : callable
+        Accepts a list of ``(metric, value, timestamp)`` rows. See
+        :func:`ingest.make_writer`. This is run in a separate thread so
+        that it doesn't block the event loop.
+    host : str
+    tcp_port : int or None
+        If ``None``, don't listen for TCP.
+    udp_port : int or None
+        If ``None``, don't listen for UDP.
+    batch_size : int, optional
+        The maximum number of datapoints written at once.
+    batch_delay : float, optional
+        The maximum number of seconds that a datapoint waits before being
+        written.
+    queue_size : int, optional
+        The maximum number of datapoints waiting to be written. When the
+        queue is full, TCP clients are made to wait and UDP data is dropped.
+    """
+    def __init__(self, write, host, tcp_port, udp_port, batch_size=1000,
+                 batch_delay=1.0, queue_size=100000):
+        self.write = write
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue_size = queue_size
+
+        self.queue = None
+        self.dropped = 0
+        self._pending = []
+        self._tcp_server = None
+        self._udp_transport = None
+        self._writer_task = None
+        # A single thread does all of the writing, so the database only ever
+        # sees one connection from us.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def tcp_address(self):
+        """The ``(host, port)`` that the TCP server is listening on."""
+        return self._tcp_server.sockets[0].getsockname()[:2]
+
+    @property
+    def udp_address(self):
+        """The ``(host, port)`` that the UDP server is listening on."""
+        return self._udp_transport.get_extra_info('sockname')[:2]
+
+    async def start(self):
+        """
+        Start listening and start the batch writer.
+        """
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._writer_task = loop.create_task(self._write_batches())
+
+        if self.tcp_port is not None:
+            self._tcp_server = await asyncio.start_server(
+                self._handle_tcp, self.host, self.tcp_port,
+            )
+            logger.info("listening for TCP on %s:%s" % self.tcp_address)
+
+        if self.udp_port is not None:
+            self._udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self),
+                local_addr=(self.host, self.udp_port),
+            )
+            logger.info("listening for UDP on %s:%s" % self.udp_address)
+
+    async def stop(self):
+        """
+        Stop listening and write any queued data.
+        """
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+
+        # Write whatever the batch writer hadn't gotten to yet.
+        remaining, self._pending = self._pending, []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        if remaining:
+            await self._write(remaining)
+
+        self._executor.shutdown()
+        logger.info("Ingest server stopped.")
+
+    async def serve_forever(self):
+        """
+        Run until SIGINT or SIGTERM is received.
+        """
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await self.start()
+        await stop.wait()
+        await self.stop()
+
+    def add_datagram(self, data):
+        """
+        Parse a UDP datagram and queue its data. Drops data if the queue
+        is full.
+        """
+        rows, _ = ingest.parse_lines(data, "UDP")
+        for row in rows:
+            try:
+                self.queue.put_nowait(row)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning("UDP: Queue full. %s datapoints dropped."
+                                   % self.dropped)
+
+    async def _handle_tcp(self, reader, writer):
+        """
+        Read lines from a TCP connection until EOF.
+        """
+        buffer = ingest.LineBuffer("TCP")
+        try:
+            while True:
+                data = await reader.read(ingest.READ_SIZE)
+                lines = buffer.feed(data) if data else buffer.close()
+                rows, _ = ingest.parse_lines(lines, "TCP")
+                for row in rows:
+                    # Waits if the queue is full, applying back-pressure.
+                    await self.queue.put(row)
+                if not data:
+                    break
+
+            writer.write(b"accepted")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _write_batches(self):
+        """
+        Drain the queue forever, writing data in batches.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            # The batch is kept on the instance so that `stop` can write it
+            # if we get cancelled.
+            self._pending.append(await self.queue.get())
+            deadline = loop.time() + self.batch_delay
+
+            while len(self._pending) < self.batch_size:
+                try:
+                    self._pending.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._pending.append(item)
+
+            batch, self._pending = self._pending, []
+            await self._write(batch)
+
+    async def _write(self, batch):
+        """
+        Write a batch in the writer thread.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, self._write_sync, batch)
+        # If we get cancelled, the batch must still be written.
+        await asyncio.shield(future)
+
+    def _write_sync(self, batch):
+        """
+        Write a batch, logging any errors. Runs in the writer thread.
+        """
+        try:
+            self.write(batch)
+        except Exception:
+            logger.exception("Failed to write batch of %s datapoints."
+                             % len(batch))
+
+
+def main():
+    _logging.setup_logging(logger)
+    config = load_config()
+    write = ingest.make_writer(config)
+
+    server = IngestServer(
+        write,
+        config['TARGET_HOST'],
+        config['TCP_PORT'],
+        config['UDP_PORT'],
+        batch_size=config['SOCKET_BATCH_SIZE'],
+        batch_delay=config['SOCKET_BATCH_DELAY'],
+        queue_size=config['SOCKET_QUEUE_SIZE'],
+    )
+    # Not `asyncio.run`, which needs Python 3.7.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(server.serve_forever())
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
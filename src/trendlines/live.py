@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process publish/subscribe hub for new datapoints.
+
+The insert functions of :mod:`trendlines.db` publish every datapoint that
+they commit to :data:`hub`. The ``/api/v1/stream`` routes subscribe to it
+and send the datapoints to browsers as `server-sent events`_, so that
+watching a metric doesn't need any database queries at all.
+
+Only datapoints written by the same process are seen. Data written by
+other processes, such as the socket listeners or other WSGI worker
+processes, is not published.
+
+.. _`server-sent events`: https://html.spec.whatwg.org/multipage/server-sent-events.html
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+
+
+def matches(name, metric=None, prefix=None):
+    """
+    Return True if a metric name matches a subscription.
+
+    Parameters
+    ----------
+    name : str
+        The full metric name.
+    metric : str, optional
+        Match only this metric.
+    prefix : str, optional
+        Match this metric and all of its children, such as ``foo`` and
+        ``foo.bar`` for the prefix ``foo``. The empty string matches all
+        metrics.
+    """
+    if metric is not None:
+        return name == metric
+    return not prefix or name == prefix or name.startswith(prefix + ".")
+
+
+class Subscription(object):
+    """
+    The datapoints published for one metric or prefix, waiting to be sent.
+
+    Use :meth:`Hub.subscribe` to create one.
+
+    Parameters
+    ----------
+    hub : :class:`Hub`
+    metric, prefix : str, optional
+        See :func:`matches`. Exactly one must be given.
+    max_size : int, optional
+        The maximum number of waiting datapoints. If more are published,
+        :attr:`overflowed` is set and the subscription should be closed.
+    """
+    def __init__(self, hub, metric=None, prefix=None, max_size=10000):
+        if (metric is None) == (prefix is None):
+            raise ValueError("Exactly one of metric and prefix is required.")
+        self.hub = hub
+        self.metric = metric
+        self.prefix = prefix
+        self.max_size = max_size
+        self.overflowed = False
+        self._rows = deque()
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop receiving datapoints.
+        """
+        self.hub.unsubscribe(self)
+
+    def put(self, rows):
+        """
+        Add published datapoints. Called by :meth:`Hub.publish`.
+        """
+        with self._cond:
+            if len(self._rows) + len(rows) > self.max_size:
+                self.overflowed = True
+            else:
+                self._rows.extend(rows)
+            self._cond.notify_all()
+
+    def get(self, timeout, delay=0):
+        """
+        Wait for datapoints and return them.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait for the first datapoint.
+        delay : float, optional
+            Once there is a datapoint, wait this many more seconds for
+            others, so that bursts are returned together.
+
+        Returns
+        -------
+        rows : list of ``(metric, datapoint_id, timestamp, value)`` tuples
+            Empty if there were none before the timeout, or if the
+            subscription overflowed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(self._ready, timeout):
+                return []
+        if delay > 0 and not self.overflowed:
+            time.sleep(delay)
+        with self._cond:
+            rows = list(self._rows)
+            self._rows.clear()
+        return rows
+
+    def _ready(self):
+        return bool(self._rows) or self.overflowed
+
+
+class Hub(object):
+    """
+    Pass published datapoints to the matching subscriptions.
+
+    Thread safe.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_metric = defaultdict(set)
+        self._by_prefix = set()
+
+    def __len__(self):
+        """The number of subscriptions."""
+        with self._lock:
+            return (sum(len(s) for s in self._by_metric.values())
+                    + len(self._by_prefix))
+
+    def subscribe(self, metric=None, prefix=None, max_size=10000):
+        """
+        Start receiving the datapoints of a metric or prefix.
+
+        Returns
+        -------
+        subscription : :class:`Subscription`
+            Close it, or use it as a context manager, when done.
+        """
+        sub = Subscription(self, metric, prefix, max_size)
+        with self._lock:
+            if metric is not None:
+                self._by_metric[metric].add(sub)
+            else:
+                self._by_prefix.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub.metric is not None:
+                subs = self._by_metric.get(sub.metric, set())
+                subs.discard(sub)
+                if not subs:
+                    self._by_metric.pop(sub.metric, None)
+            else:
+                self._by_prefix.discard(sub)
+
+    def publish(self, rows):
+        """
+        Send datapoints to the matching subscriptions.
+
+        Parameters
+        ----------
+        rows : iterable of ``(metric, datapoint_id, timestamp, value)``
+            ``metric`` is the full metric name and ``timestamp`` the POSIX
+            timestamp as stored in the database.
+        """
+        by_name = defaultdict(list)
+        for row in rows:
+            by_name[row[0]].append(row)
+
+        with self._lock:
+            targets = []
+            for name, named_rows in by_name.items():
+                subs = set(self._by_metric.get(name, ()))
+                subs.update(sub for sub in self._by_prefix
+                            if matches(name, prefix=sub.prefix))
+                targets.extend((sub, named_rows) for sub in subs)
+
+        # Combine the rows of each subscription, so that it's only woken up
+        # once.
+        combined = defaultdict(list)
+        for sub, named_rows in targets:
+            combined[sub].extend(named_rows)
+        for sub, sub_rows in combined.items():
+            sub.put(sorted(sub_rows, key=lambda row: row[1]))
+
+
+# The hub of this process.
+hub = Hub()
+
+
+def format_event(rows):
+    """
+    Format datapoints as a server-sent event.
+
+    Parameters
+    ----------
+    rows : list of ``(metric, datapoint_id, timestamp, value)`` tuples
+
+    Returns
+    -------
+    event : str
+        The event's ``id`` is the largest ``datapoint_id``, so that a
+        reconnecting browser can catch up from it. Its ``data`` is a JSON
+        list with an object per metric, each like the columnar format of
+        ``GET /api/v1/data/<metric>`` plus a ``metric`` key.
+    """
+    columns = {}
+    for name, datapoint_id, timestamp, value in rows:
+        if name not in columns:
+            columns[name] = {"metric": name, "timestamps": [], "values": [],
+                             "ids": []}
+        column = columns[name]
+        column["timestamps"].append(timestamp)
+        column["values"].append(value)
+        column["ids"].append(datapoint_id)
+
+    last_id = max(row[1] for row in rows)
+    data = json.dumps(list(columns.values()))
+    return "id: {}\ndata: {}\n\n".format(last_id, data)
+
+
+def stream_events(sub, backfill=(), heartbeat=15, delay=0.25):
+    """
+    Yield server-sent events for a subscription until it overflows.
+
+    The subscription is closed when the generator is closed, such as when
+    the client disconnects.
+
+    Parameters
+    ----------
+    sub : :class:`Subscription`
+        Created *before* ``backfill`` was read, so that nothing is missed.
+    backfill : list of ``(metric, datapoint_id, timestamp, value)``
+        Datapoints to send first, such as those that a reconnecting client
+        missed. Published datapoints that are also in here are skipped.
+    heartbeat : float, optional
+        Send a comment after this many idle seconds, so that the server
+        notices closed connections.
+    delay : float, optional
+        Collect datapoints for this many seconds before sending them, so
+        that bursts are sent as a single event.
+
+    Yields
+    ------
+    event : str
+    """
+    with sub:
+        yield "retry: 1000\n\n"
+        sent = {row[1] for row in backfill}
+        if backfill:
+            yield format_event(backfill)
+
+        while not sub.overflowed:
+            rows = sub.get(heartbeat, delay)
+            if sub.overflowed:
+                # The client reconnects and catches up from the database.
+                break
+            rows = [row for row in rows if row[1] not in sent]
+            if rows:
+                yield format_event(rows)
+            else:
+                yield ": keepalive\n\n"
@@ -10,6 +10,7 @@ from peewee import FloatField
 from peewee import TimestampField
 from peewee import ForeignKeyField
 from peewee import CharField
+from peewee import CompositeKey
 from peewee import OperationalError
 from peewee_moves import DatabaseManager
 from playhouse.sqlite_ext import AutoIncrementField
@@ -100,6 +101,67 @@ class DataPoint(DataModel):
         return repr(self)
 
 
+class Rollup(DataModel):
+    """
+    Table holding pre-aggregated data for each metric.
+
+    There is one row per metric for every ``resolution``-second bucket that
+    has any data. ``bucket`` is the POSIX timestamp of the start of the
+    bucket. ``first`` and ``last`` are the values of the earliest and latest
+    datapoints in the bucket.
+
+    Rows are maintained by the functions in :mod:`trendlines.db`.
+    """
+
+    metric = ForeignKeyField(Metric, backref="rollups", on_delete="CASCADE")
+    resolution = IntegerField()
+    bucket = IntegerField()
+    count = IntegerField()
+    sum = FloatField()
+    min = FloatField()
+    max = FloatField()
+    first_timestamp = IntegerField()
+    first = FloatField()
+    last_timestamp = IntegerField()
+    last = FloatField()
+
+    class Meta(object):
+        primary_key = CompositeKey("metric", "resolution", "bucket")
+
+    def __repr__(self):
+        s = "<Rollup: {metric}, {resolution}s, {bucket}, count={count}>"
+        return s.format(metric=self.metric_id,
+                        resolution=self.resolution,
+                        bucket=self.bucket,
+                        count=self.count)
+
+    def __str__(self):
+        return repr(self)
+
+
+class Revision(InternalModel):
+    """
+    Table holding a change counter for each metric.
+
+    ``revision`` is incremented, and ``modified`` set to the current POSIX
+    timestamp, whenever a metric or its data changes. This makes for a
+    cheap HTTP validator. The row with ``key`` 0 tracks changes to the list
+    of metrics itself. Other keys are ``metric_id`` values.
+    """
+
+    key = IntegerField(primary_key=True)
+    revision = IntegerField()
+    modified = IntegerField()
+
+    def __repr__(self):
+        s = "<Revision: {key}, {revision}, modified={modified}>"
+        return s.format(key=self.key, revision=self.revision,
+                        modified=self.modified)
+
+    def __str__(self):
+        return repr(self)
+
+
 def create_db(name):
     """
     Create the database and the tables.
@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import itertools
 import json
+import math
+import threading
 from datetime import datetime
 from datetime import timezone
 from functools import partial
 
+import numpy as np
 from marshmallow_peewee import ModelSchema
 from flask import Blueprint as FlaskBlueprint
+from flask import current_app
 from flask import jsonify
+from flask import make_response
 from flask import render_template as _render_template
 from flask import request
+from flask import Response
+from flask import stream_with_context
+from flask import url_for
+from flask.json import htmlsafe_dumps
 from flask.views import MethodView
 
 from flask_smorest import Api as _Api
 from flask_smorest import Blueprint
+from werkzeug.http import is_resource_modified
 from werkzeug.routing import RoutingException
 
 # peewee
@@ -25,6 +37,9 @@ from playhouse.shortcuts import update_model_from_dict
 from trendlines import logger
 from trendlines.__about__ import __version__
 from . import db
+from . import downsample
+from . import export
+from . import live
 from . import orm
 from .error_responses import ErrorResponse
 from . import utils
@@ -50,6 +65,16 @@ api_metric = Blueprint("Metrics", __name__,
                        description="CRUD metric(s)")
 
 
+# The JSON values of the `format` query parameter of
+# `GET /api/v1/data/<metric>`. Any of `export.MIMETYPES` can also be given.
+DATA_FORMATS = ("rows", "columnar")
+
+# The percentiles returned by /api/v1/stats/<metric> by default.
+DEFAULT_PERCENTILES = "50,90,95,99"
+
+# Content-Types that are treated as newline-delimited JSON by POST /api/v1/data
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl")
+
 # Make sure all pages show our version.
 render_template = partial(_render_template, version=__version__)
 
@@ -64,6 +89,596 @@ class DataPointSchema(ModelSchema):
         model = orm.DataPoint
 
 
+def _parse_ndjson(raw):
+    """
+    Parse a newline-delimited JSON body.
+
+    Blank lines are skipped. Lines that are not valid JSON are returned as
+    ``None`` so that they are reported as failed items.
+    """
+    items = []
+    for line in raw.decode("utf-8", errors="replace").splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+def _parse_data_item(item):
+    """
+    Validate a single ``{metric, value, time}`` item of a batch POST.
+
+    Returns
+    -------
+    (metric, value, time) : tuple
+        Suitable for :func:`db.insert_datapoints`.
+
+    Raises
+    ------
+    ValueError
+        The item is malformed. The message describes why.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Item is not a JSON object.")
+
+    try:
+        metric = item['metric']
+        value = item['value']
+    except KeyError:
+        raise ValueError("Missing required key. Required keys are: "
+                         "metric, value")
+
+    time = item.get('time', None)
+
+    if not isinstance(metric, str) or not metric:
+        raise ValueError("'metric' must be a non-empty string.")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("'value' must be numeric.")
+    if not _is_finite(value):
+        raise ValueError("'value' must be finite, not NaN or Infinity.")
+    if time is not None and (isinstance(time, bool)
+                             or not isinstance(time, (int, float))):
+        raise ValueError("'time' must be a POSIX timestamp.")
+    if time is not None and not utils.is_valid_timestamp(time):
+        raise ValueError("'time' must be a POSIX timestamp from the year 1"
+                         " to 9999.")
+
+    return metric, value, time
+
+
+def _is_finite(number):
+    """
+    Return True if a number is not NaN or +/-Infinity, which can't be
+    stored.
+    """
+    try:
+        return math.isfinite(number)
+    except OverflowError:
+        # An int too large for a float.
+        return False
+
+
+def _paginate(query, key, columns=None):
+    """
+    Return one page of ``query`` as a JSON response.
+
+    The page is selected by the ``limit``, ``after`` and ``before`` query
+    parameters. The total number of rows is only counted if ``count=true``
+    is given, since that requires a scan of the whole table.
+
+    Parameters
+    ----------
+    query : :class:`peewee.ModelSelect`
+    key : :class:`peewee.Field`
+        The unique, ordered field to paginate by.
+    columns : callable, optional
+        If given, the page can also be returned in the binary formats of
+        :mod:`trendlines.export`. Takes the rows of the page and returns
+        a dict of columns for :func:`export.write`.
+
+    Returns
+    -------
+    response : :class:`flask.Response`
+        JSON with ``count``, ``prev``, ``next`` and ``results`` keys.
+        ``prev`` and ``next`` are the URLs of the neighboring pages, or
+        ``None`` if there is no such page. Binary formats have ``count``,
+        ``prev`` and ``next`` as metadata and in the ``Link`` header.
+    """
+    args = request.args
+    max_limit = current_app.config['MAX_PAGE_SIZE']
+
+    data_format = "json"
+    if columns is not None:
+        try:
+            data_format = _negotiate_format(("json", ))
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+        except LookupError as err:
+            return ErrorResponse.format_not_available(*err.args)
+
+    limit = args.get("limit", current_app.config['PAGE_SIZE'])
+    try:
+        limit = int(limit)
+        if not 1 <= limit <= max_limit:
+            raise ValueError
+    except ValueError:
+        reason = "must be an integer from 1 to {}".format(max_limit)
+        return ErrorResponse.invalid_query_parameter("limit", limit, reason)
+
+    cursors = {}
+    for name in ("after", "before"):
+        value = args.get(name)
+        if value is None:
+            continue
+        try:
+            cursors[name] = int(value)
+        except ValueError:
+            reason = "must be an integer"
+            return ErrorResponse.invalid_query_parameter(name, value, reason)
+    if len(cursors) > 1:
+        reason = "cannot be combined with 'after'"
+        return ErrorResponse.invalid_query_parameter("before",
+                                                     cursors['before'],
+                                                     reason)
+
+    rows, has_prev, has_next = db.paginate(query, key, limit, **cursors)
+    if not rows and not cursors:
+        return ErrorResponse.no_data()
+
+    want_count = args.get("count", "").lower() in ("1", "true")
+    count = query.count() if want_count else None
+
+    def page_url(**cursor):
+        params = dict(cursor, limit=limit)
+        if want_count:
+            params['count'] = "true"
+        if "format" in args:
+            params['format'] = args['format']
+        return url_for(request.endpoint, **request.view_args, **params)
+
+    prev_url = next_url = None
+    if rows:
+        if has_prev:
+            prev_url = page_url(before=getattr(rows[0], key.name))
+        if has_next:
+            next_url = page_url(after=getattr(rows[-1], key.name))
+    elif has_prev:
+        # The cursor is past the end of the data: link to the last page.
+        prev_url = page_url(before=cursors['after'] + 1)
+    elif has_next:
+        # Or before the start: link to the first page.
+        next_url = page_url(after=cursors['before'] - 1)
+
+    if data_format != "json":
+        metadata = {"count": count, "prev": prev_url, "next": next_url}
+        response = _export_response(data_format, columns(rows), metadata)
+        links = ['<{}>; rel="{}"'.format(url, rel)
+                 for rel, url in (("prev", prev_url), ("next", next_url))
+                 if url is not None]
+        if links:
+            response.headers["Link"] = ", ".join(links)
+        return response
+
+    response = jsonify({"count": count,
+                        "prev": prev_url,
+                        "next": next_url,
+                        "results": [model_to_dict(m) for m in rows]})
+    if columns is not None:
+        response.vary.add("Accept")
+    return response
+
+
+def _negotiate_format(json_formats):
+    """
+    Return the format requested by the ``format`` query parameter or, if
+    that isn't given, by the ``Accept`` header.
+
+    Parameters
+    ----------
+    json_formats : tuple of str
+        The JSON formats of the route. The first is the default.
+
+    Returns
+    -------
+    name : str
+        One of ``json_formats`` or of :data:`export.MIMETYPES`.
+
+    Raises
+    ------
+    ValueError
+        If the ``format`` query parameter is invalid. The args are the
+        name of the parameter, its value and the reason.
+    LookupError
+        If the requested binary format is not available. The arg is its
+        name.
+    """
+    name = request.args.get("format")
+    if name is not None:
+        valid = json_formats + tuple(export.MIMETYPES)
+        if name not in valid:
+            reason = "must be one of {}".format(valid)
+            raise ValueError("format", name, reason)
+        if name in export.MIMETYPES and name not in export.WRITERS:
+            raise LookupError(name)
+        return name
+
+    # JSON comes first so that it's used for `*/*`.
+    offered = [current_app.config['JSONIFY_MIMETYPE']]
+    offered += [export.MIMETYPES[name] for name in export.WRITERS]
+    best = request.accept_mimetypes.best_match(offered)
+    for name, mimetype in export.MIMETYPES.items():
+        if best == mimetype:
+            return name
+        if best is None and mimetype in request.accept_mimetypes:
+            raise LookupError(name)
+    return json_formats[0]
+
+
+def _export_response(name, columns, metadata):
+    """
+    Return a response with columns of data in a binary format.
+    """
+    data = export.write(name, columns, metadata)
+    response = Response(data, mimetype=export.MIMETYPES[name])
+    response.vary.add("Accept")
+    return response
+
+
+def _datapoint_columns(rows):
+    """
+    Return the columns of a page of :func:`db.get_datapoints`.
+    """
+    timestamp = orm.DataPoint.timestamp
+    return {
+        "datapoint_id": np.array([r.datapoint_id for r in rows],
+                                 dtype=np.int64),
+        "metric_id": np.array([r.metric_id for r in rows], dtype=np.int64),
+        # A timestamp of 0 is read back as None.
+        "timestamp": np.array([timestamp.db_value(r.timestamp) or 0
+                               for r in rows], dtype=np.int64),
+        "value": np.array([r.value for r in rows], dtype=np.float64),
+    }
+
+
+def _validators(key, revision, modified, variant=None):
+    """
+    Return the HTTP validators for a revision.
+
+    Parameters
+    ----------
+    key, revision, modified :
+        As returned by :func:`db.get_revision`.
+    variant : str, optional
+        Distinguishes representations of the same data, such as formats.
+
+    Returns
+    -------
+    (etag, last_modified) : (str, :class:`datetime.datetime` or None)
+    """
+    # Include the version so that upgrades don't serve stale pages.
+    etag = "{}-{}-{}".format(__version__, key, revision)
+    if variant is not None:
+        etag += "-" + variant
+    last_modified = None
+    if modified is not None:
+        # Werkzeug compares naive UTC datetimes.
+        last_modified = datetime.utcfromtimestamp(modified)
+    return etag, last_modified
+
+
+def _validators_many(revisions):
+    """
+    Return the HTTP validators for the data of many metrics.
+
+    Parameters
+    ----------
+    revisions : list of ``(key, revision, modified)`` tuples
+        As returned by :func:`db.get_revisions`.
+
+    Returns
+    -------
+    (etag, last_modified) : (str, :class:`datetime.datetime` or None)
+    """
+    digest = hashlib.sha1(json.dumps(revisions).encode()).hexdigest()
+    modified = [row[2] for row in revisions if row[2] is not None]
+    return _validators("many", digest[:16], max(modified, default=None))
+
+
+def _not_modified(validators):
+    """
+    Return a ``304 Not Modified`` response if the client's copy is current.
+
+    Handles both ``If-None-Match`` and ``If-Modified-Since``.
+
+    Returns
+    -------
+    response : :class:`flask.Response` or None
+        ``None`` if the full response should be sent.
+    """
+    etag, last_modified = validators
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        return None
+    logger.debug("Not modified: %s" % request.path)
+    return _add_validators(current_app.response_class(status=304),
+                           validators)
+
+
+def _add_validators(response, validators):
+    """
+    Add ``ETag`` and ``Last-Modified`` headers to a response.
+    """
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Caches may keep the response, but must check that it's current first.
+    response.cache_control.no_cache = True
+    return response
+
+
+def _parse_time_range():
+    """
+    Parse the ``start`` and ``end`` query parameters.
+
+    Returns
+    -------
+    time_range : dict
+        Keyword arguments for :func:`db.get_data` and friends.
+
+    Raises
+    ------
+    ValueError
+        A parameter is invalid. ``args`` are the arguments for
+        :meth:`ErrorResponse.invalid_query_parameter`.
+    """
+    time_range = {}
+    for key in ("start", "end"):
+        value = request.args.get(key)
+        if value is None:
+            continue
+        try:
+            time_range[key] = utils.parse_timestamp(value)
+        except ValueError:
+            reason = "must be a POSIX timestamp or ISO 8601 string"
+            raise ValueError(key, value, reason)
+    return time_range
+
+
+def _parse_since():
+    """
+    Parse the ``since`` and ``since_id`` query parameters.
+
+    Returns
+    -------
+    since : dict
+        Keyword arguments for :func:`db.get_raw_data`.
+
+    Raises
+    ------
+    ValueError
+        A parameter is invalid. ``args`` are the arguments for
+        :meth:`ErrorResponse.invalid_query_parameter`.
+    """
+    since = {}
+    value = request.args.get("since")
+    if value is not None:
+        try:
+            since["since"] = utils.parse_timestamp(value)
+        except ValueError:
+            reason = "must be a POSIX timestamp or ISO 8601 string"
+            raise ValueError("since", value, reason)
+    value = request.args.get("since_id")
+    if value is not None:
+        try:
+            since["since_id"] = int(value)
+        except ValueError:
+            raise ValueError("since_id", value, "must be an integer")
+    return since
+
+
+def _parse_points(since):
+    """
+    Parse the ``points`` and ``method`` query parameters.
+
+    Parameters
+    ----------
+    since : dict
+        As returned by :func:`_parse_since`. It can't be combined with
+        ``points``.
+
+    Returns
+    -------
+    (points, method) : (int or None, str)
+
+    Raises
+    ------
+    ValueError
+        A parameter is invalid. ``args`` are the arguments for
+        :meth:`ErrorResponse.invalid_query_parameter`.
+    """
+    points = request.args.get("points")
+    method = request.args.get("method", "lttb")
+    if points is None:
+        return None, method
+
+    try:
+        points = int(points)
+        if points < downsample.MIN_POINTS:
+            raise ValueError
+    except ValueError:
+        reason = "must be an integer >= {}".format(downsample.MIN_POINTS)
+        raise ValueError("points", request.args["points"], reason)
+    if method not in downsample.METHODS:
+        reason = "must be one of {}".format(downsample.METHODS)
+        raise ValueError("method", method, reason)
+    for key in since:
+        # The continuation token is a datapoint, which downsampled data
+        # doesn't have.
+        reason = "cannot be combined with 'points'"
+        raise ValueError(key, request.args[key], reason)
+    return points, method
+
+
+def _reduce(metric, resolution, raw_data, points, method, columnar,
+            time_range):
+    """
+    Downsample the data of a metric.
+
+    Parameters
+    ----------
+    metric : :class:`orm.Metric`
+    resolution : int or None
+        As returned by :func:`db.choose_rollup`.
+    raw_data : iterable of ``(datapoint_id, timestamp, value)`` tuples
+        The metric's data. Only used if ``resolution`` is ``None``.
+    points, method : int, str
+        See :func:`_parse_points`.
+    columnar : bool
+    time_range : dict
+        See :func:`_parse_time_range`.
+
+    Returns
+    -------
+    data : dict
+        The points in the ``rows`` key or, if ``columnar``, as columns, plus
+        the ``units`` and ``downsampled`` metadata.
+    """
+    limits = {"lower_limit": metric.lower_limit,
+              "upper_limit": metric.upper_limit}
+    if resolution is None:
+        raw_data = list(raw_data)
+        total = len(raw_data)
+        rows = downsample.downsample_rows(raw_data, points, method,
+                                          columnar=columnar, **limits)
+    else:
+        rollups = db.get_rollups(metric.name, resolution, **time_range)
+        rows, total = downsample.downsample_rollups(
+            rollups, points, method, columnar=columnar, **limits)
+
+    if columnar:
+        data = rows
+        n_points = len(rows["values"])
+    else:
+        data = {"rows": rows}
+        n_points = len(rows)
+    logger.debug("Downsampled %s points to %s using '%s'"
+                 % (total, n_points, method))
+    data["units"] = metric.units
+    data["downsampled"] = {"method": method,
+                           "points": n_points,
+                           "total": total,
+                           "resolution": resolution}
+    return data
+
+
+def _event_stream(metric=None, prefix=None):
+    """
+    Return a response that streams new datapoints as server-sent events.
+
+    Datapoints after ``since`` or ``since_id`` (or the ``Last-Event-ID``
+    header, which browsers send when reconnecting) are read from the
+    database and sent first. See :func:`live.stream_events`.
+    """
+    config = current_app.config
+    if not config['SSE']:
+        return ErrorResponse.streaming_disabled()
+    try:
+        since = _parse_since()
+    except ValueError as err:
+        return ErrorResponse.invalid_query_parameter(*err.args)
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    if last_event_id.isdigit():
+        since = {"since_id": int(last_event_id)}
+
+    # Subscribe before catching up, so that nothing is missed in between.
+    max_size = config['SSE_QUEUE_SIZE']
+    sub = live.hub.subscribe(metric, prefix, max_size=max_size)
+    try:
+        backfill = []
+        if since:
+            backfill = list(db.get_new_datapoints(metric, prefix,
+                                                  limit=max_size, **since))
+    except Exception:
+        sub.close()
+        raise
+
+    if len(backfill) >= max_size:
+        # There may be more to catch up on. Send what we have; the browser
+        # reconnects for the rest.
+        sub.close()
+        events = ["retry: 1000\n\n", live.format_event(backfill)]
+    else:
+        events = live.stream_events(sub, backfill,
+                                    heartbeat=config['SSE_HEARTBEAT'],
+                                    delay=config['SSE_COALESCE_DELAY'])
+
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Don't let a reverse proxy buffer the events.
+    response.headers["X-Accel-Buffering"] = "no"
+    # In case the generator is never started.
+    response.call_on_close(sub.close)
+    return response
+
+
+# The landing page's jsTree data as HTML-safe JSON, and the metric names by
+# metric_id, for the revision of the list of metrics that they were built
+# from. See `_metric_tree`.
+_tree_cache = {"key": None, "json": None, "names": None}
+_tree_lock = threading.Lock()
+
+
+def _metric_tree(revision):
+    """
+    Return the jsTree data of every metric.
+
+    The data is only rebuilt when the list of metrics has changed, so that
+    serving the landing page doesn't need to read every metric.
+
+    Parameters
+    ----------
+    revision : tuple
+        The revision of the list of metrics, as returned by
+        :func:`db.get_revision`.
+
+    Returns
+    -------
+    (tree_json, names) : (str, dict of int: str)
+        The output of :func:`utils.build_jstree_data` as JSON that is safe
+        to put in a ``<script>`` tag, and the name of each metric by its
+        ``metric_id``.
+    """
+    # Each test, and each config, may use a different database.
+    key = (orm.db.database, revision)
+    with _tree_lock:
+        if _tree_cache["key"] != key:
+            logger.debug("Building the metric tree.")
+            metrics = list(db.get_metrics().namedtuples())
+            tree_data = utils.build_jstree_data(metrics)
+            _tree_cache.update(
+                key=key,
+                json=htmlsafe_dumps(tree_data),
+                names={m.metric_id: m.name for m in metrics},
+            )
+        return _tree_cache["json"], _tree_cache["names"]
+
+
+def _metric_name(metric):
+    """
+    Return the name of a metric given either its name or its metric_id.
+    """
+    try:
+        metric_id = int(metric)
+        return orm.Metric.get(orm.Metric.metric_id == metric_id).name
+    except ValueError:
+        # We couldn't parse as an int, so it's a metric name instead.
+        return metric
+
+
 @pages.route("/", methods=['GET'])
 @pages.route("/plot/<metric>", methods=["GET"])
 def index(metric=None):
@@ -77,26 +692,126 @@ def index(metric=None):
     metric : str or int, optional
         The metric_id or metric name to plot.
     """
-    metric_name = None
-    if metric is not None:
-        # Support both metric_id and metric_name
-        try:
-            metric_id = int(metric)
-            metric_name = orm.Metric.get(orm.Metric.metric_id == metric_id).name
-        except ValueError:
-            # We couldn't parse as an int, so it's a metric name instead.
-            metric_name = metric
-
-    metric_list = db.get_metrics()
-    tree_data = utils.build_jstree_data(metric_list)
-
-    return render_template('trendlines/index.html',
-                           tree_data=tree_data,
+    revision = db.get_revision()
+    # The page differs depending on whether the plots use server-sent events.
+    variant = "sse" if current_app.config['SSE'] else None
+    validators = _validators(*revision, variant=variant)
+    not_modified = _not_modified(validators)
+    if not_modified is not None:
+        return not_modified
+
+    tree_json, names = _metric_tree(revision)
+
+    metric_name = metric
+    if metric is not None and metric.isdigit():
+        # Unknown IDs are passed on as is, like unknown names.
+        metric_name = names.get(int(metric), metric)
+
+    page = render_template('trendlines/index.html',
+                           tree_json=tree_json,
                            metric_id=metric_name)
+    return _add_validators(make_response(page), validators)
 
 
 @api.route("/api/v1/data")
 class Data(MethodView):
+    def get(self):
+        """
+        Return the data of many metrics as JSON.
+
+        This is much faster than a request per metric: the metrics are
+        looked up in a single query and, unless the data is reduced from
+        rollups, all of their data is read in a single query too.
+
+        Other Parameters
+        ----------------
+        These are given in the query string.
+
+        metric : str or int
+            A metric name or metric internal id (int). Repeat it for each
+            metric, up to ``DATA_MAX_METRICS`` of them.
+        points, method, start, end, since, since_id :
+            See :meth:`DataByName.get`. With ``since`` or ``since_id``,
+            the single ``since_id`` in the response is the continuation
+            token for all of the metrics.
+        format : str, optional
+            ``rows`` (the default) or ``columnar``. See
+            :meth:`DataByName.get`. Binary formats are not supported.
+
+        The response has a ``metrics`` key, which maps each metric name to
+        its data as returned by :meth:`DataByName.get`. Metrics without
+        data are included with no points.
+        """
+        keys = request.args.getlist("metric")
+        logger.debug("GET /api/v1/data for %s metrics" % len(keys))
+
+        max_metrics = current_app.config['DATA_MAX_METRICS']
+        if not keys or len(keys) > max_metrics:
+            reason = "between 1 and {} must be given".format(max_metrics)
+            return ErrorResponse.invalid_query_parameter(
+                "metric", ",".join(keys), reason)
+
+        try:
+            time_range = _parse_time_range()
+            since = _parse_since()
+            points, method = _parse_points(since)
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+
+        data_format = request.args.get("format", DATA_FORMATS[0])
+        if data_format not in DATA_FORMATS:
+            reason = "must be one of {}".format(DATA_FORMATS)
+            return ErrorResponse.invalid_query_parameter(
+                "format", data_format, reason)
+        columnar = data_format == "columnar"
+
+        names = [key for key in keys if not key.isdigit()]
+        metric_ids = [int(key) for key in keys if key.isdigit()]
+        found = list(db.get_metrics(names, metric_ids)
+                     .order_by(orm.Metric.metric_id))
+        by_key = {m.name: m for m in found}
+        by_key.update((str(m.metric_id), m) for m in found)
+        for key in keys:
+            if key not in by_key:
+                return ErrorResponse.metric_not_found(key)
+
+        metric_ids = [m.metric_id for m in found]
+        validators = _validators_many(db.get_revisions(metric_ids))
+        not_modified = _not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        if points is None:
+            raw_data = db.get_raw_data_many(metric_ids, **time_range,
+                                            **since)
+            metrics = [(m.metric_id, m.name, m.units) for m in found]
+            token = {}
+            if since:
+                token["since_id"] = since.get("since_id")
+            chunks = utils.stream_many(raw_data.iterator(), metrics,
+                                       columnar=columnar, **token)
+            response = Response(
+                stream_with_context(chunks),
+                mimetype=current_app.config['JSONIFY_MIMETYPE'],
+            )
+            return _add_validators(response, validators)
+
+        resolutions = {m.metric_id: db.choose_rollup(m.name, points,
+                                                     **time_range)
+                       for m in found}
+        raw_ids = [key for key, value in resolutions.items() if value is None]
+        raw_data = db.get_raw_data_many(raw_ids, **time_range).iterator()
+        groups = {key: [row[1:] for row in group] for key, group
+                  in itertools.groupby(raw_data, key=lambda row: row[0])}
+
+        data = {}
+        for metric in found:
+            data[metric.name] = _reduce(
+                metric, resolutions[metric.metric_id],
+                groups.get(metric.metric_id, []), points, method, columnar,
+                time_range)
+        return _add_validators(jsonify({"metrics": data}), validators)
+
     def post(self):
         """
         Add a new value and possibly a metric if needed.
@@ -106,26 +821,71 @@ class Data(MethodView):
           metric: string
           value: numeric
           time: integer or missing
+
+        Many values can be added at once by sending a JSON array of such
+        objects, or by sending newline-delimited JSON (one object per line)
+        with a ``Content-Type`` of ``application/x-ndjson``. All valid items
+        are written in a single transaction and the response lists the
+        result of each item.
         """
+        if request.mimetype in NDJSON_MIMETYPES:
+            return self._post_many(_parse_ndjson(request.get_data()))
+
         data = request.get_json()
+        if isinstance(data, list):
+            return self._post_many(data)
+
         logger.debug("Received POST /api/v1/data: {}".format(data))
 
         try:
-            metric = data['metric']
-            value = data['value']
-        except KeyError:
-            logger.warning("Missing JSON keys 'metric' or 'value'.")
-            return "Missing required key. Required keys are:", 400
-
-        time = data.get('time', None)
+            metric, value, time = _parse_data_item(data)
+        except ValueError as err:
+            logger.warning("Invalid data: %s" % err)
+            return str(err), 400
 
-        db.add_metric(metric)
-        new = db.insert_datapoint(metric, value, time)
+        # Go through the bulk path: with a warm metric cache, this is a
+        # single INSERT.
+        db.write_datapoints([(metric, value, time)])
 
-        msg = "Added DataPoint to Metric {}\n".format(new.metric)
+        msg = "Added DataPoint to Metric '{}'\n".format(metric)
         logger.info("Added value %s to metric '%s'" % (value, metric))
         return msg, 201
 
+    def _post_many(self, items):
+        """
+        Add many values at once.
+
+        Returns ``201`` if every item was added, ``207`` if only some of
+        them were, and ``400`` if none were.
+        """
+        logger.debug("Received POST /api/v1/data with %s items" % len(items))
+
+        results = []
+        points = []
+        for index, item in enumerate(items):
+            try:
+                points.append(_parse_data_item(item))
+            except ValueError as err:
+                results.append({"index": index, "status": 400,
+                                "detail": str(err)})
+            else:
+                results.append({"index": index, "status": 201})
+
+        db.write_datapoints(points)
+        logger.info("Added %s of %s values" % (len(points), len(items)))
+
+        if len(points) == len(items):
+            status = 201
+        elif points:
+            status = 207
+        else:
+            status = 400
+
+        return jsonify({"count": len(items),
+                        "added": len(points),
+                        "failed": len(items) - len(points),
+                        "results": results}), status
+
 
 @api.route("/api/v1/data/<metric>")
 class DataByName(MethodView):
@@ -137,29 +897,244 @@ class DataByName(MethodView):
         ----------
         metric : str or int
             The metric name or the metric internal id (int) to get data for.
+
+        Other Parameters
+        ----------------
+        These are given in the query string.
+
+        points : int, optional
+            Reduce the data to roughly this many points. Points that are
+            outside of the metric's limits are always included (except for
+            ``method=avg``).
+        method : str, optional
+            How to reduce the data when ``points`` is given. One of
+            ``lttb`` (the default), ``minmax`` or ``avg``. See
+            :mod:`trendlines.downsample`.
+        start : int or str, optional
+            Only return data at or after this time. Either a POSIX timestamp
+            or an ISO 8601 string (assumed to be UTC if no timezone is
+            given).
+        end : int or str, optional
+            Only return data before this time.
+        format : str, optional
+            ``rows`` (the default) returns a list of ``{timestamp, value,
+            id, n}`` objects. ``columnar`` returns ``timestamps``,
+            ``values`` and ``ids`` lists instead, with integer POSIX
+            timestamps, plus an ``n`` list if the data was downsampled.
+            ``arrow``, ``npy``, ``npz`` and ``msgpack`` return ``timestamp``,
+            ``value`` and ``id`` (and ``n``) columns in a binary format.
+            See :mod:`trendlines.export`. Binary formats can also be
+            requested with the ``Accept`` header.
+        since : int or str, optional
+            Only return data after this time (exclusive).
+        since_id : int, optional
+            Only return datapoints that were added after the datapoint with
+            this ID. If either ``since`` or ``since_id`` is given, the
+            response has a ``since_id`` key with the value to use for the
+            next request. Neither can be combined with ``points``.
+
+        When ``points`` is given and the time range is long enough, the
+        data is reduced from the minute, hour or day rollups instead of
+        the raw data. ``downsampled.resolution`` gives the bucket size in
+        seconds, or is ``null`` if the raw data was used.
         """
         logger.debug("GET /api/v1/data/%s" % metric)
 
-        # Support both metric_id and metric_name
         try:
-            metric_id = int(metric)
-            metric_name = orm.Metric.get(orm.Metric.metric_id == metric_id).name
-        except ValueError:
-            # We couldn't parse as an int, so it's a metric name instead.
-            metric_name = metric
+            time_range = _parse_time_range()
+            since = _parse_since()
+            points, method = _parse_points(since)
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+
+        try:
+            data_format = _negotiate_format(DATA_FORMATS)
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+        except LookupError as err:
+            return ErrorResponse.format_not_available(*err.args)
+        binary = data_format in export.MIMETYPES
+        columnar = binary or data_format == "columnar"
 
         try:
-            raw_data = db.get_data(metric_name)
+            metric_name = _metric_name(metric)
+            variant = data_format if binary else None
+            validators = _validators(*db.get_revision(metric_name),
+                                     variant=variant)
+        except DoesNotExist:
+            return ErrorResponse.metric_not_found(metric)
+        not_modified = _not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            raw_data = db.get_raw_data(metric_name, **time_range, **since)
             units = db.get_units(metric_name)
         except DoesNotExist:
             return ErrorResponse.metric_not_found(metric_name)
 
-        if len(raw_data) == 0:
+        # An empty time range, or no new data, is not an error.
+        if not time_range and not since and not raw_data.exists():
             return ErrorResponse.metric_has_no_data(metric_name)
 
-        data = utils.format_data(raw_data, units)
+        # The continuation token, if asked for.
+        token = {}
+        if since:
+            token["since_id"] = since.get("since_id")
+
+        if points is None and binary:
+            ids, timestamps, values = utils.collect_columns(
+                raw_data.iterator())
+            columns = {"timestamp": np.frombuffer(timestamps, np.int64),
+                       "value": np.frombuffer(values, np.float64),
+                       "id": np.frombuffer(ids, np.int64)}
+            metadata = {"units": units}
+            if since:
+                metadata["since_id"] = utils.last_id(ids, **token)
+            response = _export_response(data_format, columns, metadata)
+            return _add_validators(response, validators)
+
+        if points is None:
+            # Stream the rows straight from the cursor so that memory use
+            # doesn't grow with the length of the series.
+            stream = utils.stream_columns if columnar else utils.stream_data
+            chunks = stream(raw_data.iterator(), units, **token)
+            response = Response(
+                stream_with_context(chunks),
+                mimetype=current_app.config['JSONIFY_MIMETYPE'],
+            )
+            return _add_validators(response, validators)
+
+        found = orm.Metric.get(orm.Metric.name == metric_name)
+        resolution = db.choose_rollup(metric_name, points, **time_range)
+        data = _reduce(found, resolution, raw_data.iterator(), points,
+                       method, columnar, time_range)
+
+        if binary:
+            # Points that aren't datapoints, such as averages, have an ID
+            # of 0.
+            ids = [0 if i is None else i for i in data["ids"]]
+            columns = {"timestamp": np.array(data["timestamps"], np.int64),
+                       "value": np.array(data["values"], np.float64),
+                       "id": np.array(ids, np.int64),
+                       "n": np.array(data["n"], np.int64)}
+            metadata = {key: data[key] for key in ("units", "downsampled")}
+            response = _export_response(data_format, columns, metadata)
+        else:
+            response = jsonify(data)
+        return _add_validators(response, validators)
 
-        return jsonify(data)
+
+@api.route("/api/v1/stream")
+class Stream(MethodView):
+    def get(self):
+        """
+        Stream new datapoints as server-sent events.
+
+        Each event's ``data`` is a JSON list with an object per metric,
+        with ``metric``, ``timestamps``, ``values`` and ``ids`` keys. Its
+        ``id`` is the largest ``datapoint_id`` sent so far.
+
+        Only datapoints written by this process are streamed.
+
+        Other Parameters
+        ----------------
+        These are given in the query string.
+
+        prefix : str, optional
+            Only stream this metric and its children, such as ``foo`` and
+            ``foo.bar`` for ``prefix=foo``. Defaults to all metrics.
+        since, since_id : optional
+            First send the datapoints after this time or datapoint. See
+            :meth:`DataByName.get`.
+        """
+        prefix = request.args.get("prefix", "")
+        logger.debug("GET /api/v1/stream?prefix=%s" % prefix)
+        return _event_stream(prefix=prefix)
+
+
+@api.route("/api/v1/stream/<metric>")
+class StreamByName(MethodView):
+    def get(self, metric):
+        """
+        Stream new datapoints of a metric as server-sent events.
+
+        See :meth:`Stream.get`.
+
+        Parameters
+        ----------
+        metric : str or int
+            The metric name or the metric internal id (int).
+        """
+        logger.debug("GET /api/v1/stream/%s" % metric)
+        try:
+            metric_name = _metric_name(metric)
+            orm.Metric.get(orm.Metric.name == metric_name)
+        except DoesNotExist:
+            return ErrorResponse.metric_not_found(metric)
+        return _event_stream(metric=metric_name)
+
+
+@api.route("/api/v1/stats/<metric>")
+class Stats(MethodView):
+    def get(self, metric):
+        """
+        Return summary statistics for a given metric as JSON.
+
+        Parameters
+        ----------
+        metric : str or int
+            The metric name or the metric internal id (int).
+
+        Other Parameters
+        ----------------
+        These are given in the query string.
+
+        start, end : int or str, optional
+            Only use data in this time range. See :meth:`DataByName.get`.
+        percentiles : str, optional
+            Comma-separated percentiles to compute, from 0 to 100. Defaults
+            to :data:`DEFAULT_PERCENTILES`. Give an empty string to skip
+            them, which saves reading the metric's values.
+        """
+        logger.debug("GET /api/v1/stats/%s" % metric)
+
+        try:
+            time_range = _parse_time_range()
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+
+        value = request.args.get("percentiles", DEFAULT_PERCENTILES)
+        try:
+            percentiles = [float(p) for p in value.split(",") if p.strip()]
+            if not all(0 <= p <= 100 for p in percentiles):
+                raise ValueError
+        except ValueError:
+            reason = "must be comma-separated numbers from 0 to 100"
+            return ErrorResponse.invalid_query_parameter("percentiles",
+                                                         value, reason)
+
+        try:
+            metric_name = _metric_name(metric)
+            stats = db.get_stats(metric_name, percentiles=percentiles,
+                                 **time_range)
+            units = db.get_units(metric_name)
+        except DoesNotExist:
+            return ErrorResponse.metric_not_found(metric)
+
+        # An empty time range is not an error.
+        if stats["count"] == 0 and not time_range:
+            return ErrorResponse.metric_has_no_data(metric_name)
+
+        for key in ("first_timestamp", "last_timestamp"):
+            stats[key] = utils.format_timestamp(stats[key])
+        stats["percentiles"] = {
+            "{:g}".format(p): v
+            for p, v in zip(percentiles, stats["percentiles"])
+        }
+        stats["metric"] = metric_name
+        stats["units"] = units
+        return jsonify(stats)
 
 
 @api_datapoint.route("/api/v1/datapoint")
@@ -167,21 +1142,30 @@ class DataPoint(MethodView):
     @api_datapoint.response(DataPointSchema(many=True))
     def get(self):
         """
-        Return all of the data for all metrics.
+        Return the data for all metrics, one page at a time.
+
+        Other Parameters
+        ----------------
+        These are given in the query string.
+
+        limit : int, optional
+            The number of datapoints per page. Defaults to the
+            ``PAGE_SIZE`` config value.
+        after : int, optional
+            Return the datapoints just after this ``datapoint_id``.
+        before : int, optional
+            Return the datapoints just before this ``datapoint_id``.
+        count : bool, optional
+            If ``true``, include the total number of datapoints in
+            ``count``. Otherwise ``count`` is ``null``.
+        format : str, optional
+            ``json`` (the default), or one of the binary formats of
+            :mod:`trendlines.export`, which return ``datapoint_id``,
+            ``metric_id``, ``timestamp`` and ``value`` columns.
         """
         logger.debug("api: GET all datapoints")
-        raw_data = db.get_datapoints()
-        if len(raw_data) == 0:
-            # do a thing.
-            return ErrorResponse.no_data()
-
-        data = [model_to_dict(m) for m in raw_data]
-
-        # For now, fill in dummy values.
-        return jsonify({"count": len(data),
-                        "prev": None,
-                        "next": None,
-                        "results": data})
+        return _paginate(db.get_datapoints(), orm.DataPoint.datapoint_id,
+                         columns=_datapoint_columns)
 
     @api_datapoint.response(DataPointSchema, code=201)
     def post(self):
@@ -284,7 +1268,7 @@ class DataPointById(MethodView):
 
         try:
             found = db.DataPoint.get(db.DataPoint.datapoint_id == datapoint_id)
-            found.delete_instance()
+            db.delete_datapoint(found)
         except DoesNotExist:
             return ErrorResponse.datapoint_not_found(datapoint_id)
         else:
@@ -296,21 +1280,22 @@ class Metric(MethodView):
     @api_metric.response(MetricSchema(many=True))
     def get(self):
         """
-        Return a list of all metrics in the database.
+        Return a list of all metrics in the database, one page at a time.
+
+        Takes the same query parameters as :meth:`DataPoint.get`, with
+        ``metric_id`` as the cursor.
         """
         logger.debug("api: GET all metrics")
-        raw_data = db.get_metrics()
-        if len(raw_data) == 0:
-            # do a thing.
-            return ErrorResponse.no_data()
+        validators = _validators(*db.get_revision())
+        not_modified = _not_modified(validators)
+        if not_modified is not None:
+            return not_modified
 
-        data = [model_to_dict(m) for m in raw_data]
-
-        # For now, fill in dummy values.
-        return jsonify({"count": len(data),
-                        "prev": None,
-                        "next": None,
-                        "results": data})
+        response = _paginate(db.get_metrics(), orm.Metric.metric_id)
+        if isinstance(response, tuple):
+            # An error response
+            return response
+        return _add_validators(response, validators)
 
     @api_metric.response(MetricSchema, code=201)
     def post(self):
@@ -448,6 +1433,8 @@ class MetricById(MethodView):
             # Failed the unique constraint on Metric.name
             return ErrorResponse.unique_metric_name_required(old['name'], name)
 
+        db.invalidate_metric(old['name'])
+        db.touch([metric.metric_id, db.METRIC_LIST])
         return 204
 
     @api_metric.response(code=204)
@@ -503,6 +1490,8 @@ class MetricById(MethodView):
             # Failed the unique constraint on Metric.name
             return ErrorResponse.unique_metric_name_required(old['name'], metric.name)
 
+        db.invalidate_metric(old['name'])
+        db.touch([metric.metric_id, db.METRIC_LIST])
         return 204
 
     @api_metric.response(code=204)
@@ -514,3 +1503,6 @@ class MetricById(MethodView):
             found.delete_instance()
         except DoesNotExist:
             return ErrorResponse.metric_not_found(metric_id)
+
+        db.invalidate_metric(found.name)
+        db.touch([db.METRIC_LIST])
@@ -1,3 +1,21 @@
+// How often a plot checks for new data, in milliseconds.
+var REFRESH_INTERVAL = 10000;
+
+// Incremented whenever a different plot is shown, so that requests for the
+// previous plot are ignored.
+var plotGeneration = 0;
+
+// The plotted data: the x values for each type of x-axis, and the y values.
+var plotData = null;
+
+// Whether the server streams new data as server-sent events (the `SSE`
+// config option). Set by the page.
+var USE_SSE = false;
+
+// The server-sent event stream of the current plot, if any.
+var eventSource = null;
+
+
 /**
  * Populate the JSTree tree.
  */
@@ -52,11 +70,16 @@ function treeChanged(e, data, urlPrefix) {
     // with a string, gets cast to the string 'null'. So we get "null/api/..."
     urlPrefix = urlPrefix || ""
 
-    var expected = urlPrefix + "/api/v1/data/" + data.node.original.metric_id;
+    // Have the server downsample large metrics. There's no point in sending
+    // more points than the plot has pixels.
+    // The columnar format is smaller and doesn't need to be unpacked.
+    var expected = urlPrefix + "/api/v1/data/" + data.node.original.metric_id
+      + "?format=columnar&points=" + plotPoints();
     // grab the plot data from the api
     $.getJSON(expected)
       .done(function(jsonData) {
         makePlot(jsonData);
+        followPlot(urlPrefix, data.node.original.metric_id, jsonData);
 
         // This updates the URL to reflect which plot is shown.
         var history_url = urlPrefix + "/plot/" + data.node.original.metric_id;
@@ -72,6 +95,75 @@ function treeChanged(e, data, urlPrefix) {
 }
 
 
+/*
+ * Keep adding new data to the plot until a different plot is shown.
+ *
+ * New data is polled for: the first request asks for everything after the
+ * last plotted timestamp. After that, the `since_id` from the previous
+ * response is used, which never misses or repeats a datapoint.
+ *
+ * If the server has server-sent events enabled (`USE_SSE`) and the browser
+ * supports them, new data is pushed instead.
+ */
+function followPlot(urlPrefix, metricId, data) {
+  var generation = plotGeneration;
+  var last = data.timestamps.length - 1;
+  var query = "since=" + data.timestamps[last];
+
+  if (USE_SSE && window.EventSource) {
+    // The server pushes new data as it arrives. The browser reconnects on
+    // its own, and the server catches up from the last event it sent.
+    var streamUrl = urlPrefix + "/api/v1/stream/" + metricId + "?" + query;
+    eventSource = new EventSource(streamUrl);
+    eventSource.onmessage = function(event) {
+      if (generation !== plotGeneration) {
+        return;
+      }
+      JSON.parse(event.data).forEach(extendPlot);
+    };
+    return;
+  }
+
+  // Otherwise poll for new data.
+  var url = urlPrefix + "/api/v1/data/" + metricId + "?format=columnar&";
+
+  function poll() {
+    if (generation !== plotGeneration) {
+      return;
+    }
+    $.getJSON(url + query)
+      .done(function(newData) {
+        if (generation !== plotGeneration) {
+          return;
+        }
+        if (newData.since_id !== null) {
+          query = "since_id=" + newData.since_id;
+        }
+        extendPlot(newData);
+      })
+      .fail(function(jqXHR, textStatus, errorThrown) {
+        console.log("Request failed: " + errorThrown);
+      })
+      .always(function() {
+        // Only schedule the next request once this one is done, so that
+        // they never overlap.
+        setTimeout(poll, REFRESH_INTERVAL);
+      });
+  }
+
+  setTimeout(poll, REFRESH_INTERVAL);
+}
+
+
+/*
+ * The number of points to request for a plot: two per horizontal pixel, so
+ * that the min and max of each pixel column can be shown.
+ */
+function plotPoints() {
+  return Math.max(1000, 2 * window.innerWidth);
+}
+
+
 /*
  * Select a specific tree element.
  * Called when both:
@@ -96,16 +188,25 @@ function makePlot(data) {
   // Clear the plot before doing anything. Failure to do so results in each
   // trace being appended.
   Plotly.purge(TESTER);
+  plotGeneration += 1;
+  if (eventSource !== null) {
+    eventSource.close();
+    eventSource = null;
+  }
 
-  // I think Plotly only accepts 1D arrays of data, so split things out.
-  var x = data.rows.map(function (obj) {return obj.timestamp});
-  var y = data.rows.map(function (obj) {return obj.value});
-  var n = data.rows.map(function (obj) {return obj.n});
+  // The data is columnar, which is what Plotly wants. Plotly takes dates as
+  // milliseconds since the epoch.
+  var x = data.timestamps.map(function (t) {return t * 1000});
+  var y = data.values;
+  // Only downsampled data has `n`. Otherwise it's just the index.
+  var n = data.n || data.values.map(function (v, i) {return i});
   var units = data.units;
+  plotData = {x: x, n: n, y: y};
 
+  // Plotly gets copies, since `extendPlot` adds to these arrays.
   trace1 = {
-    x: n,
-    y: y,
+    x: n.slice(),
+    y: y.slice(),
     type: 'scatter'
   };
 
@@ -124,15 +225,39 @@ function makePlot(data) {
         function() {
           // Determine which x scale to use.
           if (this.value == "time") {
-            new_x = x;
+            new_x = plotData.x.slice();
+            axis_type = 'date';
           } else if (this.value == "sequential") {
-            new_x = n;
+            new_x = plotData.n.slice();
+            axis_type = 'linear';
           }
 
-          // Adjust the x values of the data.
-          Plotly.restyle(TESTER, 'x', [new_x]);
+          // Adjust the x values of the data. Numbers are only shown as dates
+          // if we say so.
+          Plotly.update(TESTER, {x: [new_x]}, {'xaxis.type': axis_type});
         }
       )
     }
   );
 }
+
+
+/**
+ * Add new data to the end of the plot.
+ */
+function extendPlot(data) {
+  if (data.values.length === 0) {
+    return;
+  }
+
+  // New points come after the last point of the full series.
+  var start = plotData.n[plotData.n.length - 1] + 1;
+  var x = data.timestamps.map(function (t) {return t * 1000});
+  var n = data.values.map(function (v, i) {return start + i});
+  plotData.x = plotData.x.concat(x);
+  plotData.n = plotData.n.concat(n);
+  plotData.y = plotData.y.concat(data.values);
+
+  var new_x = $("#x-axis-type-time").is(":checked") ? x : n;
+  Plotly.extendTraces(TESTER, {x: [new_x], y: [data.values]}, [0]);
+}
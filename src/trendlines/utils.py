@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 """
 """
+import itertools
+import json
+import math
+import re
 import shutil
+from array import array
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from pathlib import Path
 
@@ -55,12 +62,10 @@ def get_metric_parent(metric):
     >>> get_metric_parent("foo.bar.baz.foo")
     "foo.bar.baz"
     """
-    s = metric.split(".")
-    if len(s) == 1:
+    parent, sep, _ = metric.rpartition(".")
+    if not sep:
         # top-level item. parent is "#" (root)
         parent = "#"
-    else:
-        parent = ".".join(s[:-1])
 
     return parent
 
@@ -145,33 +150,107 @@ def build_jstree_data(metrics):
         {"id": "bar.baz.biz", "parent": "bar.baz", "metric_id": 3    },
        ]
     """
-    # First go through and make all of our existing links
-    data = [format_metric_for_jstree(m) for m in metrics]
+    return JsTree(metrics).data()
 
-    # then search through that data and find any missing parents.
-    for m in data:
-        parent = m["parent"]
 
-        # ignore root nodes and parents that already exist.
-        if parent == "#" or parent in (x['id'] for x in data):
-            continue
+class JsTree(object):
+    """
+    The jsTree nodes of a set of metrics, indexed by node ``id``.
 
-        # Create the grandparent
-        new_parent = get_metric_parent(parent)
+    Placeholder parents are added and removed along with the metrics, so
+    adding or removing a metric only touches its own ancestors instead of
+    the whole tree.
 
-        # Add the new, non-linked item to our data. Yes we're intentionally
-        # modifying the array we're looping over so that we make sure to
-        # get all parents no matter how deep.
-        new = {"id": m['parent'],
-               "parent": new_parent,
-               "text": m['parent'],
-               "metric_id": None,
-               }
-        data.append(new)
+    Parameters
+    ----------
+    metrics : iterable of :class:`trendlines.orm.Metric` objects, optional
+        The metrics to start with.
 
-    # Lastly sort things in a predictable fashion.
-    data.sort(key=lambda d: d['id'])
-    return data
+    Examples
+    --------
+    >>> tree = JsTree(db.get_metrics())
+    >>> tree.add(orm.Metric(metric_id=7, name="foo.bar"))
+    >>> tree.remove("foo.bar")
+    >>> data = tree.data()
+    """
+    def __init__(self, metrics=()):
+        # Node id: node dict, as given to jsTree.
+        self.nodes = {}
+        # Node id: the number of nodes whose parent it is.
+        self._children = {}
+        for metric in metrics:
+            self.add(metric)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def add(self, metric):
+        """
+        Add a metric, and any of its parents that are missing.
+
+        Parameters
+        ----------
+        metric : :class:`trendlines.orm.Metric`
+            If its node is already a placeholder parent, it becomes a link
+            to this metric.
+        """
+        node = self.nodes.get(metric.name)
+        if node is not None:
+            node["metric_id"] = metric.metric_id
+            return
+
+        node = format_metric_for_jstree(metric)
+        while True:
+            self.nodes[node["id"]] = node
+            parent = node["parent"]
+            if parent == "#":
+                break
+            self._children[parent] = self._children.get(parent, 0) + 1
+            if parent in self.nodes:
+                break
+            node = {"id": parent,
+                    "parent": get_metric_parent(parent),
+                    "text": parent,
+                    "metric_id": None,
+                    }
+
+    def remove(self, name):
+        """
+        Remove a metric, and any of its parents that are only placeholders
+        for it.
+
+        A metric that still has children stays as a placeholder parent.
+
+        Parameters
+        ----------
+        name : str
+            The full metric name. Nothing happens if it's not in the tree.
+        """
+        node = self.nodes.get(name)
+        if node is None:
+            return
+        node["metric_id"] = None
+
+        while node["metric_id"] is None and not self._children.get(node["id"]):
+            del self.nodes[node["id"]]
+            self._children.pop(node["id"], None)
+            parent = node["parent"]
+            if parent == "#":
+                break
+            self._children[parent] -= 1
+            node = self.nodes[parent]
+
+    def data(self):
+        """
+        Return the nodes sorted by ``id``, as returned by
+        :func:`build_jstree_data`.
+
+        The nodes are not copied: don't change them.
+        """
+        return sorted(self.nodes.values(), key=lambda node: node["id"])
 
 
 def format_data(data, units=None):
@@ -200,6 +279,248 @@ def format_data(data, units=None):
     return {'rows': data, "units": units}
 
 
+_EPOCH = datetime(1970, 1, 1)
+
+# The range of POSIX timestamps that can be stored. The datapoint table
+# holds a 64-bit integer, but datapoints are read back as datetimes, which
+# only go from the year 1 to 9999.
+MIN_TIMESTAMP = -62135596800        # 0001-01-01T00:00:00Z
+MAX_TIMESTAMP = 253402300799        # 9999-12-31T23:59:59Z
+
+
+def is_valid_timestamp(timestamp):
+    """
+    Return True if a POSIX timestamp can be stored.
+
+    Parameters
+    ----------
+    timestamp : int or float
+
+    Returns
+    -------
+    bool
+        False for timestamps outside of :data:`MIN_TIMESTAMP` to
+        :data:`MAX_TIMESTAMP`, NaN and +/-Infinity.
+    """
+    return MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP
+
+
+def format_timestamp(timestamp):
+    """
+    Format a POSIX timestamp like the naive UTC datetimes of the ORM.
+
+    Parameters
+    ----------
+    timestamp : int or None
+
+    Returns
+    -------
+    str or None
+        The ISO 8601 string, without a timezone.
+    """
+    if timestamp is None:
+        return None
+    return (_EPOCH + timedelta(seconds=timestamp)).isoformat()
+
+
+def stream_data(rows, units=None, chunk_size=1000, since_id=False):
+    """
+    Serialize data to JSON a chunk at a time.
+
+    The output is the same as ``jsonify(format_data(...))`` (apart from key
+    order), but only ``chunk_size`` rows are ever held in memory.
+
+    Parameters
+    ----------
+    rows : iterable of ``(datapoint_id, timestamp, value)`` tuples
+        As returned by :func:`db.get_raw_data`. Use ``.iterator()`` so that
+        peewee doesn't cache the rows.
+    units : str, optional
+        The units of the data, if any.
+    chunk_size : int, optional
+        The number of rows in each chunk.
+    since_id : int, None or False, optional
+        If not ``False``, also add a ``since_id`` key: the continuation
+        token for :func:`db.get_raw_data`. This is the largest
+        ``datapoint_id`` in ``rows``, or ``since_id`` itself if there are
+        no rows.
+
+    Yields
+    ------
+    chunk : str
+        Pieces of a JSON document. Joined together, they are a dict with
+        ``units`` and ``rows`` keys.
+    """
+    yield '{"units": %s, "rows": [' % json.dumps(units)
+
+    chunk = []
+    sep = ""
+    max_id = None
+    for n, (datapoint_id, timestamp, value) in enumerate(rows):
+        if max_id is None or datapoint_id > max_id:
+            max_id = datapoint_id
+        chunk.append(json.dumps({'timestamp': format_timestamp(timestamp),
+                                 'value': value,
+                                 'id': datapoint_id,
+                                 'n': n}))
+        if len(chunk) >= chunk_size:
+            yield sep + ",".join(chunk)
+            chunk = []
+            sep = ","
+    if chunk:
+        yield sep + ",".join(chunk)
+
+    if since_id is False:
+        yield "]}"
+    else:
+        token = since_id if max_id is None else max_id
+        yield '], "since_id": %s}' % json.dumps(token)
+
+
+def collect_columns(rows):
+    """
+    Split rows of data into compact, typed arrays.
+
+    Parameters
+    ----------
+    rows : iterable of ``(datapoint_id, timestamp, value)`` tuples
+        As returned by :func:`db.get_raw_data`.
+
+    Returns
+    -------
+    (ids, timestamps, values) : tuple of :class:`array.array`
+        64-bit integers, 64-bit integers and doubles. These support the
+        buffer protocol, so :func:`numpy.frombuffer` can use them without
+        copying.
+    """
+    ids = array("q")
+    timestamps = array("q")
+    values = array("d")
+    for datapoint_id, timestamp, value in rows:
+        ids.append(datapoint_id)
+        timestamps.append(timestamp)
+        values.append(value)
+    return ids, timestamps, values
+
+
+def last_id(ids, since_id=None):
+    """
+    Return the continuation token for :func:`db.get_raw_data`.
+
+    Parameters
+    ----------
+    ids : sequence of int
+        The ``datapoint_id`` values that were returned.
+    since_id : int, optional
+        The ``since_id`` that was asked for.
+
+    Returns
+    -------
+    since_id : int or None
+        The largest of ``ids``, or ``since_id`` if there are none.
+    """
+    if len(ids) == 0:
+        return since_id
+    return max(ids)
+
+
+def stream_columns(rows, units=None, chunk_size=1000, since_id=False):
+    """
+    Serialize data to columnar JSON a chunk at a time.
+
+    The columns are collected into compact arrays first (see
+    :func:`collect_columns`), which take a few dozen bytes per row instead
+    of the few hundred of a list of dicts.
+
+    Parameters
+    ----------
+    rows, units, chunk_size, since_id :
+        See :func:`stream_data`.
+
+    Yields
+    ------
+    chunk : str
+        Pieces of a JSON document. Joined together, they are a dict with
+        ``units``, ``timestamps``, ``values`` and ``ids`` keys. Each of the
+        last three is a list with one item per row. ``timestamps`` are
+        integer POSIX timestamps.
+    """
+    ids, timestamps, values = collect_columns(rows)
+
+    yield '{"units": %s' % json.dumps(units)
+    if since_id is not False:
+        yield ', "since_id": %s' % json.dumps(last_id(ids, since_id))
+    for key, column in (("timestamps", timestamps),
+                        ("values", values),
+                        ("ids", ids)):
+        yield ', "%s": [' % key
+        for start in range(0, len(column), chunk_size):
+            chunk = column[start:start + chunk_size]
+            sep = "," if start else ""
+            yield sep + ",".join(map(json.dumps, chunk))
+        yield "]"
+    yield "}"
+
+
+def stream_many(rows, metrics, columnar=False, chunk_size=1000,
+                since_id=False):
+    """
+    Serialize the data of many metrics to JSON a chunk at a time.
+
+    Parameters
+    ----------
+    rows : iterable of ``(metric_id, datapoint_id, timestamp, value)``
+        As returned by :func:`db.get_raw_data_many`: each metric's rows
+        must be together, in the same order as ``metrics``.
+    metrics : list of ``(metric_id, name, units)`` tuples
+        The metrics to include. Metrics without any rows are included with
+        no data.
+    columnar : bool, optional
+        Use :func:`stream_columns` instead of :func:`stream_data` for each
+        metric.
+    chunk_size : int, optional
+        See :func:`stream_data`.
+    since_id : int, None or False, optional
+        If not ``False``, also add a ``since_id`` key: the largest
+        ``datapoint_id`` of all the rows, or ``since_id`` itself if there
+        are no rows.
+
+    Yields
+    ------
+    chunk : str
+        Pieces of a JSON document. Joined together, they are a dict with a
+        ``metrics`` key, which maps each metric name to the output of
+        :func:`stream_data` or :func:`stream_columns`.
+    """
+    stream = stream_columns if columnar else stream_data
+    max_id = [since_id]
+
+    def track(group):
+        for _, datapoint_id, timestamp, value in group:
+            if max_id[0] is None or datapoint_id > max_id[0]:
+                max_id[0] = datapoint_id
+            yield datapoint_id, timestamp, value
+
+    groups = itertools.groupby(rows, key=lambda row: row[0])
+    current = next(groups, None)
+
+    yield '{"metrics": {'
+    for n, (metric_id, name, units) in enumerate(metrics):
+        group = ()
+        if current is not None and current[0] == metric_id:
+            group = current[1]
+            current = None
+        yield "%s%s: " % ("," if n else "", json.dumps(name))
+        yield from stream(track(group), units, chunk_size)
+        if current is None:
+            current = next(groups, None)
+    yield "}"
+
+    if since_id is not False:
+        yield ', "since_id": %s' % json.dumps(max_id[0])
+    yield "}"
+
+
 def parse_socket_data(data):
     """
     Parse socket data to a dict suitable for sending to ``/api/v1/data``.
@@ -215,6 +536,11 @@ def parse_socket_data(data):
     -------
     dict
         A dict suitable for sending via :module:`requests` as JSON.
+
+    Raises
+    ------
+    ValueError
+        The data could not be parsed, or the value is NaN or infinite.
     """
     try:
         data = data.decode("utf-8")
@@ -227,6 +553,9 @@ def parse_socket_data(data):
         metric, value = s[0], float(s[1])
     except Exception:
         raise ValueError("Failed to parse `%s` % data")
+    if not math.isfinite(value):
+        # NaN and +/-Infinity can't be stored.
+        raise ValueError("Value must be finite: `%s`" % data)
 
     try:
         time = int(s[2])
@@ -238,6 +567,168 @@ def parse_socket_data(data):
     return d
 
 
+class ParsedSocketData(namedtuple("ParsedSocketData",
+                                  "names values timestamps errors")):
+    """
+    Columnar data returned by :func:`parse_socket_buffer`.
+
+    Attributes
+    ----------
+    names : list of str
+        The metric name of each datapoint.
+    values : :class:`array.array` of float
+        The value of each datapoint.
+    timestamps : :class:`array.array` of int
+        The POSIX timestamp of each datapoint.
+    errors : list of ``(line_number, line)`` tuples
+        The lines that could not be parsed. Line numbers start at 1.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self):
+        """
+        Return the datapoints as ``(metric, value, timestamp)`` tuples.
+
+        This is the format that :func:`db.insert_datapoints` accepts, so
+        the rows can be written without any further conversion.
+        """
+        return list(zip(self.names, self.values, self.timestamps))
+
+
+def parse_socket_buffer(data, received=None):
+    """
+    Parse many lines of socket data at once.
+
+    This is the bulk version of :func:`parse_socket_data`. Each line should
+    follow the "metric value [timestamp]" format. Blank lines are ignored.
+    Lines that can't be parsed, including those whose value is NaN or
+    Infinity, are collected in ``errors`` rather than raising an error.
+
+    Parameters
+    ----------
+    data : bytes or str
+        Any number of newline-separated lines.
+    received : int, optional
+        The POSIX timestamp to use for lines without a timestamp. If
+        ``None``, the current time is used.
+
+    Returns
+    -------
+    :class:`ParsedSocketData`
+    """
+    if received is None:
+        received = int(datetime.now(timezone.utc).timestamp())
+
+    # Decoding everything at once is much faster than line by line.
+    replaced = False
+    if isinstance(data, bytes):
+        try:
+            data = data.decode("utf-8")
+        except UnicodeDecodeError:
+            data = data.decode("utf-8", "replace")
+            replaced = True
+
+    names = []
+    values = array("d")
+    timestamps = array("q")
+    errors = []
+
+    for line_number, line in enumerate(data.splitlines(), 1):
+        fields = line.split()
+        try:
+            if len(fields) == 3:
+                name, value, time = fields
+                time = int(time)
+            elif len(fields) == 2:
+                name, value = fields
+                time = received
+            elif not fields:
+                continue
+            else:
+                raise ValueError
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError
+            if replaced and "\ufffd" in name:
+                raise ValueError
+            # Last, since it raises OverflowError for huge timestamps.
+            timestamps.append(time)
+        except (ValueError, OverflowError):
+            errors.append((line_number, line))
+            continue
+        names.append(name)
+        values.append(value)
+
+    return ParsedSocketData(names, values, timestamps, errors)
+
+
+# The ISO 8601 formats accepted by `parse_timestamp`, without the timezone.
+_ISO_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+)
+_ISO_TIMEZONE = re.compile(
+    r"(Z|(?P<sign>[+-])(?P<hours>\d\d):?(?P<minutes>\d\d))$"
+)
+
+
+def parse_timestamp(value):
+    """
+    Parse a POSIX timestamp or an ISO 8601 datetime string.
+
+    Parameters
+    ----------
+    value : str
+        Such as ``"1546532070"``, ``"2019-01-03T16:14:30Z"`` or
+        ``"2019-01-03"``. ISO 8601 strings without a timezone are assumed
+        to be UTC.
+
+    Returns
+    -------
+    timestamp : int
+        The POSIX timestamp, rounded down to the second.
+
+    Raises
+    ------
+    ValueError
+        ``value`` could not be parsed.
+    """
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        pass
+
+    # Not `datetime.fromisoformat`, which needs Python 3.7. Python 3.6's
+    # `%z` doesn't accept a colon in the offset either, so the timezone is
+    # parsed separately.
+    tz = timezone.utc
+    match = _ISO_TIMEZONE.search(value)
+    if match is not None:
+        value = value[:match.start()]
+        if match.group("sign"):
+            offset = timedelta(hours=int(match.group("hours")),
+                               minutes=int(match.group("minutes")))
+            if match.group("sign") == "-":
+                offset = -offset
+            tz = timezone(offset)
+
+    for fmt in _ISO_FORMATS:
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return int(dt.replace(tzinfo=tz).timestamp())
+    raise ValueError("Invalid ISO 8601 string: '%s'" % value)
+
+
 def backup_file(path, ts_format="%Y%m%d_%H%M%S"):
     """
     Backup a file by copying it and appending a timestamp to the name.
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import gzip
+import zlib
+from unittest.mock import MagicMock
+
+import pytest
+
+from trendlines import compress
+
+
+def test_available():
+    assert compress.available(["foo", "gzip"]) == ["gzip"]
+
+
+def test_compress_iter_flushes_every_chunk():
+    chunks = [b"a" * 100, b"", b"b" * 100]
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    result = []
+    for data in compress.compress_iter(iter(chunks), "gzip", 6):
+        result.append(decompressor.decompress(data))
+    # Each chunk can be decompressed as soon as it's received.
+    assert result[:2] == [b"a" * 100, b"b" * 100]
+    assert b"".join(result) == b"".join(chunks)
+
+
+def test_compress_iter_closes():
+    chunks = MagicMock()
+    chunks.__iter__.return_value = iter([b"a"])
+    list(compress.compress_iter(chunks, "gzip", 6))
+    chunks.close.assert_called_once_with()
+
+
+def test_compress_brotli():
+    brotli = pytest.importorskip("brotli")
+    data = b"foo" * 100
+    assert brotli.decompress(compress.compress(data, "br", 4)) == data
+
+
+def test_compress_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    data = b"foo" * 100
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    assert decompressor.decompress(compress.compress(data, "zstd", 3)) == data
+
+
+def test_compress_response(client, populated_db):
+    rv = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert rv.status_code == 200
+    assert rv.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in rv.headers["Vary"]
+    assert int(rv.headers["Content-Length"]) == len(rv.data)
+    assert b"jstree" in gzip.decompress(rv.data)
+
+
+def test_compress_response_not_accepted(client, populated_db):
+    rv = client.get("/")
+    assert "Content-Encoding" not in rv.headers
+    assert "Accept-Encoding" in rv.headers["Vary"]
+
+    rv = client.get("/", headers={"Accept-Encoding": "gzip;q=0, foo"})
+    assert "Content-Encoding" not in rv.headers
+
+
+def test_compress_response_too_small(client, populated_db):
+    rv = client.get("/api/v1/metric/2", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in rv.headers
+    assert rv.get_json()["name"] == "foo"
+
+
+def test_compress_response_disabled(app, client, populated_db):
+    app.config['COMPRESS'] = False
+    rv = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in rv.headers
+
+
+def test_compress_response_streamed(client, populated_db):
+    expected = client.get("/api/v1/data/foo").data
+
+    rv = client.get("/api/v1/data/foo", headers={"Accept-Encoding": "gzip"})
+    assert rv.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in rv.headers
+    assert gzip.decompress(rv.data) == expected
+
+
+def test_compress_response_etag(client, populated_db):
+    headers = {"Accept-Encoding": "gzip"}
+    rv = client.get("/api/v1/data/foo", headers=headers)
+    etag = rv.headers["ETag"]
+    assert etag.startswith("W/")
+
+    rv = client.get("/api/v1/data/foo",
+                    headers={"If-None-Match": etag, **headers})
+    assert rv.status_code == 304
+    assert "Content-Encoding" not in rv.headers
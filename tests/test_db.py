@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """
 """
+import threading
 from copy import deepcopy
 from datetime import datetime
 from datetime import timezone
+from unittest.mock import patch
 
 import pytest
 from freezegun import freeze_time
@@ -89,6 +91,248 @@ def test_insert_datapoint_with_timestamp(populated_db):
     assert new[0].timestamp == expected
 
 
+@freeze_time("2019-01-03T16:14:30Z")        # 1546532070
+def test_insert_datapoints(populated_db):
+    points = [
+        ("foo", 1, None),
+        ("foo", 2, 1545321236),
+        ("new.metric", 3, None),
+    ]
+    rv = db.insert_datapoints(points)
+    assert rv == 3
+
+    new = db.Metric.get(db.Metric.name == "new.metric")
+    data = list(db.DataPoint.select().where(db.DataPoint.metric == new))
+    assert len(data) == 1
+    assert data[0].value == 3
+    assert data[0].timestamp == _naive_utc_dt_from_posix_ts(1546532070)
+
+    foo = db.get_data("foo")
+    assert len(foo) == 6
+    assert foo[0].timestamp == _naive_utc_dt_from_posix_ts(1545321236)
+
+
+def test_insert_datapoints_empty(app):
+    assert db.insert_datapoints([]) == 0
+    assert len(db.Metric.select()) == 0
+
+
+def test_insert_datapoints_many(app):
+    # More rows and metrics than SQLite allows bound variables in a query.
+    points = [("metric.{}".format(i % 1500), i, i + 1) for i in range(3000)]
+    rv = db.insert_datapoints(points)
+    assert rv == 3000
+    assert len(db.Metric.select()) == 1500
+    assert len(db.DataPoint.select()) == 3000
+
+
+def test_metric_cache():
+    cache = db.MetricCache(maxsize=2)
+    cache.update({"a": 1, "b": 2})
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+
+    # "a" was used more recently than "b", so "b" gets evicted.
+    cache.get_many(["a"])
+    cache.update({"c": 3})
+    assert len(cache) == 2
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+
+    cache.discard("a")
+    cache.discard("missing")
+    assert cache.get_many(["a", "c"]) == {"c": 3}
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_insert_datapoints_warm_cache_does_not_read(populated_db):
+    # populated_db used `add_metric`, which warms the cache.
+    with patch.object(orm.db, "execute_sql",
+                      wraps=orm.db.execute_sql) as execute_sql:
+        db.insert_datapoints([("foo", 1, None)])
+
+    statements = [c[0][0] for c in execute_sql.call_args_list]
+    # Rollups are read and merged, but the metric table is never read.
+    assert not any(s.startswith("SELECT") and 'FROM "metric"' in s
+                   for s in statements)
+    inserts = [s for s in statements if s.startswith('INSERT INTO "datapoint"')]
+    assert len(inserts) == 1
+
+
+def test_insert_datapoint_warm_cache_does_not_read(populated_db):
+    with patch.object(orm.db, "execute_sql",
+                      wraps=orm.db.execute_sql) as execute_sql:
+        db.insert_datapoint("foo", 1)
+
+    statements = [c[0][0] for c in execute_sql.call_args_list]
+    # Rollups are read and merged, but the metric table is never read.
+    assert not any(s.startswith("SELECT") and 'FROM "metric"' in s
+                   for s in statements)
+
+
+def test_insert_datapoints_caches_new_metrics(app):
+    db.insert_datapoints([("foo", 1, None)])
+    assert db.metric_cache.get_many(["foo"]) == {"foo": 1}
+
+
+def test_insert_datapoints_stale_cache(populated_db, caplog):
+    # Pretend that another process deleted "foo" and made a new metric.
+    db.Metric.delete().where(db.Metric.name == "foo").execute()
+    db.insert_datapoints([("foo", 1, None)])
+
+    foo = db.Metric.get(db.Metric.name == "foo")
+    assert foo.metric_id == 7
+    assert len(db.get_data("foo")) == 1
+    assert "Retrying with an empty metric cache" in caplog.text
+
+
+def test_insert_datapoints_renamed_elsewhere(populated_db):
+    db.insert_datapoints([("foo", 1, None)])
+    # Pretend that another process renamed "foo". It doesn't share our
+    # cache, but it does change the revision of the list of metrics.
+    db.Metric.update(name="renamed").where(db.Metric.name == "foo").execute()
+    db.touch([db.METRIC_LIST])
+
+    db.insert_datapoints([("foo", 2, None)])
+    assert [p.value for p in db.get_data("foo")] == [2]
+    assert len(db.get_data("renamed")) == 5
+
+    db.Metric.update(name="again").where(db.Metric.name == "foo").execute()
+    db.touch([db.METRIC_LIST])
+    with pytest.raises(db.Metric.DoesNotExist):
+        db.insert_datapoint("foo", 3)
+
+
+def test_metric_cache_revision():
+    cache = db.MetricCache()
+    cache.validate(1)
+    cache.update({"a": 1}, revision=1, new_revision=2)
+    assert cache.revision == 2
+    # Read at an old revision, so not cached.
+    cache.update({"b": 2}, revision=1)
+    assert cache.get_many(["a", "b"]) == {"a": 1}
+
+    cache.validate(3)
+    assert len(cache) == 0
+
+
+def test_invalidate_metric(populated_db):
+    assert db.metric_cache.get_many(["foo", "foo.bar"]) != {}
+    db.invalidate_metric("foo")
+    assert db.metric_cache.get_many(["foo"]) == {}
+    assert db.metric_cache.get_many(["foo.bar"]) == {"foo.bar": 3}
+    db.invalidate_metric()
+    assert len(db.metric_cache) == 0
+
+
+@pytest.fixture
+def write_buffer(app):
+    db.start_write_buffer(max_size=100, max_delay=0.05)
+    yield db.write_buffer
+    db.stop_write_buffer()
+
+
+def test_write_datapoints_without_buffer(app):
+    assert db.write_buffer is None
+    assert db.write_datapoints([("foo", 1, None), ("bar", 2, 1)]) == 2
+    assert len(orm.DataPoint.select()) == 2
+
+
+def test_write_buffer_groups_commits(write_buffer):
+    results = []
+
+    def post(n):
+        points = [("metric.%s" % n, i, 1546532070 + i) for i in range(10)]
+        results.append(db.write_datapoints(points))
+
+    with patch.object(db, "insert_datapoints",
+                      wraps=db.insert_datapoints) as insert:
+        threads = [threading.Thread(target=post, args=(n, ))
+                   for n in range(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    # "commit" mode: everything is in the database once the call returns.
+    assert results == [10] * 30
+    assert len(orm.DataPoint.select()) == 300
+    assert len(orm.Metric.select()) == 30
+    assert insert.call_count < 30
+
+
+@freeze_time("2019-01-25T04:32:28Z")        # 1548390748
+def test_write_buffer_stamps_time_on_submit(write_buffer):
+    db.write_datapoints([("foo", 1, None)])
+    dp = orm.DataPoint.get()
+    assert dp.timestamp == datetime(2019, 1, 25, 4, 32, 28)
+
+
+def test_write_buffer_isolates_failures(app):
+    errors = []
+
+    def post(points):
+        try:
+            db.write_datapoints(points)
+        except IntegrityError as err:
+            errors.append(err)
+
+    # All three submissions are committed together once the third arrives.
+    db.start_write_buffer(max_size=3, max_delay=60)
+    try:
+        with patch.object(db, "insert_datapoints",
+                          wraps=db.insert_datapoints) as insert:
+            threads = [
+                threading.Thread(target=post, args=([("foo", 1, 1)], )),
+                threading.Thread(target=post, args=([("foo", None, 1)], )),
+                threading.Thread(target=post, args=([("bar", 2, 1)], )),
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    finally:
+        db.stop_write_buffer()
+
+    # One group commit, then one retry per submission.
+    assert insert.call_count == 4
+    assert len(errors) == 1
+    assert len(orm.DataPoint.select()) == 2
+
+
+def test_write_buffer_enqueue(app):
+    db.start_write_buffer(max_size=100, max_delay=60, durability="enqueue")
+    try:
+        assert db.write_datapoints([("foo", 1, None)]) == 1
+        # Not committed until the batch is full or the delay is up.
+        assert len(orm.DataPoint.select()) == 0
+    finally:
+        db.stop_write_buffer()
+
+    # Stopping the buffer commits whatever was waiting.
+    assert len(orm.DataPoint.select()) == 1
+
+
+def test_write_buffer_enqueue_logs_errors(app, caplog):
+    db.start_write_buffer(durability="enqueue")
+    db.write_datapoints([("foo", None, 1)])
+    db.stop_write_buffer()
+    assert "Failed to write 1 buffered datapoints" in caplog.text
+
+
+def test_write_buffer_stopped(app):
+    buffer = db.WriteBuffer()
+    buffer.start()
+    buffer.stop()
+    with pytest.raises(RuntimeError):
+        buffer.submit([("foo", 1, 1)])
+
+
+def test_write_buffer_invalid_durability():
+    with pytest.raises(ValueError):
+        db.WriteBuffer(durability="maybe")
+
+
 def test_get_data(populated_db):
     rv = db.get_data("empty_metric")
     assert len(rv) == 0
@@ -99,6 +343,88 @@ def test_get_data(populated_db):
     assert rv[3].value == 9
 
 
+@pytest.mark.parametrize("start, end, expected", [
+    (None, None, [0, 1, 5, 8]),
+    (1545321236, None, [1, 5, 8]),
+    (None, 1546532003, [0, 1]),
+    (1545321236, 1546532067, [1, 5]),
+    (1546532068, None, []),
+])
+def test_get_data_time_range(populated_db, start, end, expected):
+    rv = db.get_data("old_data", start=start, end=end)
+    assert [d.value for d in rv] == expected
+
+
+def test_get_data_ordered_by_time(populated_db):
+    # Backfilled data is returned in time order, not insertion order.
+    db.insert_datapoint("old_data", 3, 1546000000)
+    rv = db.get_data("old_data")
+    assert [d.value for d in rv] == [0, 1, 3, 5, 8]
+
+
+def test_get_data_time_range_uses_index(populated_db):
+    query = db.get_data("old_data", start=1, end=2)
+    sql, params = query.sql()
+    plan = orm.db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    plan = " ".join(row[-1] for row in plan)
+    assert "datapoint_metric_id_timestamp" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_get_raw_data(populated_db):
+    rv = list(db.get_raw_data("old_data"))
+    assert rv[0] == (7, 0, 0)
+    assert rv[1] == (8, 1545321236, 1)
+    assert len(rv) == 4
+
+    rv = list(db.get_raw_data("old_data", start=1, end=1546532067))
+    assert rv == [(8, 1545321236, 1), (9, 1546532003, 5)]
+
+
+def test_get_raw_data_since(populated_db):
+    rv = list(db.get_raw_data("old_data", since=1545321236))
+    assert rv == [(9, 1546532003, 5), (10, 1546532067, 8)]
+
+    # Late data is found by its ID, even though it's older.
+    db.insert_datapoint("old_data", 3, 1)
+    rv = list(db.get_raw_data("old_data", since_id=9))
+    assert rv == [(11, 1, 3), (10, 1546532067, 8)]
+    assert list(db.get_raw_data("old_data", since_id=11)) == []
+
+    # The time range still applies.
+    rv = list(db.get_raw_data("old_data", start=1545321236, since_id=9))
+    assert rv == [(10, 1546532067, 8)]
+
+
+def _query_plan(query):
+    sql, params = query.sql()
+    plan = orm.db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return " ".join(row[-1] for row in plan)
+
+
+@pytest.mark.parametrize("query", [
+    lambda: db.get_raw_data("old_data", since_id=9),
+    lambda: db.get_raw_data("old_data", start=1, since_id=9),
+    lambda: db.get_raw_data_many([5], start=1, end=2, since_id=9),
+    lambda: db.get_new_datapoints(metric="old_data", since_id=9),
+])
+def test_since_id_uses_index(populated_db, query):
+    # Only the new datapoints are read, not the whole metric.
+    plan = _query_plan(query())
+    assert ("datapoint_metric_id_datapoint_id (metric_id=? AND"
+            " datapoint_id>?)") in plan
+
+
+def test_get_raw_data_many(populated_db):
+    rv = list(db.get_raw_data_many([5, 3, 1]))
+    assert [row[:2] for row in rv] == [(3, 5), (3, 6), (5, 7), (5, 8),
+                                       (5, 9), (5, 10)]
+    assert rv[2] == (5, 7, 0, 0)
+
+    rv = db.get_raw_data_many([3, 5], start=1, end=1546532067, since_id=5)
+    assert list(rv) == [(5, 8, 1545321236, 1), (5, 9, 1546532003, 5)]
+
+
 @freeze_time("2019-01-03T16:14:30Z")        # 1546532070
 def test_get_recent_data(populated_db):
     """
@@ -126,6 +452,40 @@ def test_get_recent_data(populated_db):
     assert rv[0].value == 8
 
 
+def test_get_stats(populated_db):
+    rv = db.get_stats("old_data", percentiles=[0, 50, 100])
+    assert rv["count"] == 4
+    assert rv["min"] == 0
+    assert rv["max"] == 8
+    assert rv["mean"] == 3.5
+    assert rv["stddev"] == pytest.approx(3.201562)
+    assert rv["first_timestamp"] == 0
+    assert rv["last_timestamp"] == 1546532067
+    assert rv["percentiles"] == [0, 3, 8]
+
+
+def test_get_stats_time_range(populated_db):
+    rv = db.get_stats("old_data", start=1, end=1546532067)
+    assert rv["count"] == 2
+    assert rv["mean"] == 3
+    assert rv["stddev"] == 2
+    assert rv["percentiles"] == []
+
+
+def test_get_stats_no_data(populated_db):
+    rv = db.get_stats("empty_metric", percentiles=[50])
+    assert rv == {"count": 0, "min": None, "max": None, "mean": None,
+                  "stddev": None, "first_timestamp": None,
+                  "last_timestamp": None, "percentiles": [None]}
+
+
+def test_get_stats_accuracy(app):
+    # The sum of squares would lose all precision here.
+    db.insert_datapoints([("big", 1e9 + i % 2, 1546300800 + i)
+                          for i in range(1000)])
+    assert db.get_stats("big")["stddev"] == 0.5
+
+
 def test_get_metrics(populated_db):
     rv = db.get_metrics()
     assert len(rv) == 6
@@ -135,6 +495,12 @@ def test_get_metrics(populated_db):
     assert rv[3].units == "apples"
 
 
+def test_get_metrics_filtered(populated_db):
+    rv = db.get_metrics(names=["foo", "missing"], metric_ids=[5, 99])
+    assert sorted(m.name for m in rv) == ["foo", "old_data"]
+    assert list(db.get_metrics(names=[])) == []
+
+
 def test_get_units(populated_db):
     rv = db.get_units("metric_with_units")
     assert rv == "apples"
@@ -156,6 +522,59 @@ def test_get_datapoints_no_data(app):
     assert len(rv) == 0
 
 
+def test_paginate(populated_db):
+    query = db.get_datapoints()
+    key = orm.DataPoint.datapoint_id
+
+    rows, has_prev, has_next = db.paginate(query, key, 3)
+    assert [r.datapoint_id for r in rows] == [1, 2, 3]
+    assert (has_prev, has_next) == (False, True)
+
+    rows, has_prev, has_next = db.paginate(query, key, 3, after=3)
+    assert [r.datapoint_id for r in rows] == [4, 5, 6]
+    assert (has_prev, has_next) == (True, True)
+
+    rows, has_prev, has_next = db.paginate(query, key, 3, after=7)
+    assert [r.datapoint_id for r in rows] == [8, 9, 10]
+    assert (has_prev, has_next) == (True, False)
+
+    rows, has_prev, has_next = db.paginate(query, key, 3, before=4)
+    assert [r.datapoint_id for r in rows] == [1, 2, 3]
+    assert (has_prev, has_next) == (False, True)
+
+    rows, has_prev, has_next = db.paginate(query, key, 3, before=9)
+    assert [r.datapoint_id for r in rows] == [6, 7, 8]
+    assert (has_prev, has_next) == (True, True)
+
+
+def test_paginate_past_the_ends(populated_db):
+    query = db.get_datapoints()
+    key = orm.DataPoint.datapoint_id
+
+    # The data can still be found from an empty page.
+    assert db.paginate(query, key, 3, after=10) == ([], True, False)
+    assert db.paginate(query, key, 3, after=50) == ([], True, False)
+    assert db.paginate(query, key, 3, before=1) == ([], False, True)
+    assert db.paginate(query, key, 3, before=-5) == ([], False, True)
+
+    empty = query.where(orm.DataPoint.metric == 1)
+    assert db.paginate(empty, key, 3, after=10) == ([], False, False)
+    assert db.paginate(empty, key, 3, before=1) == ([], False, False)
+
+
+def test_paginate_filtered(populated_db):
+    query = db.get_datapoints().where(orm.DataPoint.metric == 5)
+    key = orm.DataPoint.datapoint_id
+
+    rows, has_prev, has_next = db.paginate(query, key, 2)
+    assert [r.datapoint_id for r in rows] == [7, 8]
+    assert (has_prev, has_next) == (False, True)
+
+    rows, has_prev, has_next = db.paginate(query, key, 2, after=8)
+    assert [r.datapoint_id for r in rows] == [9, 10]
+    assert (has_prev, has_next) == (True, False)
+
+
 def test_get_datapoint(populated_db):
     rv = db.get_datapoint(5)
     assert isinstance(rv, orm.DataPoint)
@@ -299,3 +718,203 @@ def test_delete_datpoint_does_not_exist(populated_db):
     missing = orm.DataPoint(value=50)
     with pytest.raises(DoesNotExist):
         db.delete_datapoint(missing)
+
+
+def _rollups(metric_id, resolution):
+    return list(db.Rollup.select(*db._ROLLUP_FIELDS[2:])
+                .where((db.Rollup.metric == metric_id)
+                       & (db.Rollup.resolution == resolution))
+                .order_by(db.Rollup.bucket)
+                .tuples())
+
+
+def _rebuilt(metric_id, resolution):
+    """
+    The rollups of a metric, computed from scratch from the raw data.
+    """
+    rows = (orm.DataPoint.select(orm.DataPoint.metric,
+                                 orm.DataPoint.value,
+                                 orm.DataPoint.timestamp.cast("INTEGER"))
+            .where(orm.DataPoint.metric == metric_id)
+            .order_by(orm.DataPoint.timestamp, orm.DataPoint.datapoint_id)
+            .tuples())
+    aggregates = db._aggregate(rows)
+    return sorted(tuple([k[2]] + v) for k, v in aggregates.items()
+                  if k[1] == resolution)
+
+
+def test_rollups_insert_datapoints(app):
+    db.insert_datapoints([
+        ("foo", 3, 1546300810),
+        ("foo", 1, 1546300800),
+        ("foo", 7, 1546300859),
+        ("foo", 4, 1546300860),
+        ("foo", 2, 1546387200),
+    ])
+    assert _rollups(1, 60) == [
+        (1546300800, 3, 11, 1, 7, 1546300800, 1, 1546300859, 7),
+        (1546300860, 1, 4, 4, 4, 1546300860, 4, 1546300860, 4),
+        (1546387200, 1, 2, 2, 2, 1546387200, 2, 1546387200, 2),
+    ]
+    assert _rollups(1, 86400) == [
+        (1546300800, 4, 15, 1, 7, 1546300800, 1, 1546300860, 4),
+        (1546387200, 1, 2, 2, 2, 1546387200, 2, 1546387200, 2),
+    ]
+
+
+def test_rollups_merge(app):
+    # Out of order, across many writes, with ties in timestamp.
+    db.insert_datapoints([("foo", 5, 1546300830), ("foo", 6, 1546300830)])
+    db.insert_datapoint("foo", 1, 1546300800)
+    db.insert_datapoints([("foo", 9, 1546300859), ("foo", 8, 1546300830)])
+    db.insert_datapoint("foo", 2, 1546300859)
+    db.insert_datapoints([("foo", 0, 1546300800)])
+
+    for resolution in db.ROLLUP_RESOLUTIONS:
+        assert _rollups(1, resolution) == _rebuilt(1, resolution)
+    assert _rollups(1, 60) == [
+        (1546300800, 7, 31, 0, 9, 1546300800, 1, 1546300859, 2),
+    ]
+
+
+def test_rollups_update_datapoint(populated_db):
+    # Move the max of "old_data" into the previous day.
+    db.update_datapoint(10, value=-1, timestamp=1545321237)
+    for resolution in db.ROLLUP_RESOLUTIONS:
+        assert _rollups(5, resolution) == _rebuilt(5, resolution)
+
+    # Change metrics.
+    db.update_datapoint(9, metric=2)
+    for metric_id in (2, 5):
+        for resolution in db.ROLLUP_RESOLUTIONS:
+            assert _rollups(metric_id, resolution) == _rebuilt(metric_id,
+                                                               resolution)
+
+
+def test_rollups_delete_datapoint(populated_db):
+    db.delete_datapoint(10)
+    db.delete_datapoint(7)
+    for resolution in db.ROLLUP_RESOLUTIONS:
+        assert _rollups(5, resolution) == _rebuilt(5, resolution)
+    assert [r[1] for r in _rollups(5, 86400)] == [1, 1]
+
+
+def test_rollups_deleted_with_metric(populated_db):
+    assert len(_rollups(5, 60)) == 4
+    orm.Metric.get_by_id(5).delete_instance()
+    assert _rollups(5, 60) == []
+
+
+@pytest.mark.parametrize("points, start, end, expected", [
+    # 3000 points, one per hour, over 125 days.
+    (100, None, None, 86400),
+    (200, None, None, 3600),
+    (5000, None, None, None),
+    (2000, None, None, 3600),
+    (3000, None, None, None),
+    (100, 1546300800, 1546300800 + 3600 * 200, 3600),
+    (100, 1546300800, 1546300800 + 3600 * 50, None),
+])
+def test_choose_rollup(app, points, start, end, expected):
+    db.insert_datapoints([("foo", 1, 1546300800 + 3600 * i)
+                          for i in range(3000)])
+    assert db.choose_rollup("foo", points, start, end) == expected
+
+
+def test_choose_rollup_no_data(populated_db):
+    assert db.choose_rollup("empty_metric", 100) is None
+
+
+def test_get_rollups(app):
+    db.insert_datapoints([("foo", i, 1546300800 + 3600 * i)
+                          for i in range(48)])
+    rv = list(db.get_rollups("foo", 86400))
+    assert [r[:3] for r in rv] == [(1546300800, 24, 276),
+                                   (1546387200, 24, 852)]
+
+    # Buckets that overlap the range are included.
+    rv = db.get_rollups("foo", 86400, start=1546387199, end=1546387200)
+    assert [r[0] for r in rv] == [1546300800]
+    rv = db.get_rollups("foo", 3600, start=1546300800 + 1800, end=1546308000)
+    assert [r[0] for r in rv] == [1546300800, 1546304400]
+
+
+def test_rollups_merge_uses_index(populated_db):
+    with patch.object(orm.db, "execute_sql",
+                      wraps=orm.db.execute_sql) as execute_sql:
+        db.insert_datapoints([("foo", 1, 1546300800)])
+
+    (sql, params), = [c[0] for c in execute_sql.call_args_list
+                      if c[0][0].startswith("SELECT")
+                      and 'FROM "rollup"' in c[0][0]]
+    plan = orm.db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    plan = " ".join(row[-1] for row in plan)
+    assert "SEARCH" in plan
+    assert "SCAN t1" not in plan
+
+
+def test_rollups_merge_many_metrics(populated_db):
+    # More keys than fit in one query, each in its own OR'ed term.
+    rows = [("many.%d" % i, i, 1546532070) for i in range(400)]
+    db.insert_datapoints(rows)
+    db.insert_datapoints(rows)
+
+    metric_id = orm.Metric.get(orm.Metric.name == "many.399").metric_id
+    counts = (orm.Rollup.select(orm.Rollup.count)
+              .where(orm.Rollup.metric == metric_id)
+              .tuples())
+    assert [c for c, in counts] == [2] * len(db.ROLLUP_RESOLUTIONS)
+
+
+def test_get_revision(populated_db):
+    key, revision, modified = db.get_revision("foo")
+    assert key == 2
+    assert revision > 0
+    assert modified is not None
+    other = db.get_revision("foo.bar")
+
+    db.insert_datapoint("foo", 1)
+    assert db.get_revision("foo")[1] == revision + 1
+    assert db.get_revision("foo.bar") == other
+
+
+def test_get_revisions(populated_db):
+    rv = db.get_revisions([3, 2, 99])
+    assert rv == [db.get_revision("foo"), db.get_revision("foo.bar")]
+
+
+def test_get_revision_metric_list(populated_db):
+    key, revision, _ = db.get_revision()
+    assert key == db.METRIC_LIST
+
+    db.insert_datapoint("foo", 1)
+    assert db.get_revision()[1] == revision
+
+    db.insert_datapoints([("new_metric", 1, None)])
+    assert db.get_revision()[1] == revision + 1
+    assert db.get_revision("new_metric")[1] == 1
+
+
+def test_get_revision_update_and_delete(populated_db):
+    revision = db.get_revision("old_data")[1]
+    db.update_datapoint(8, value=3)
+    assert db.get_revision("old_data")[1] == revision + 1
+    db.delete_datapoint(8)
+    assert db.get_revision("old_data")[1] == revision + 2
+
+
+def test_get_revision_missing(app):
+    orm.Revision.delete().execute()
+    assert db.get_revision() == (db.METRIC_LIST, 0, None)
+    db.add_metric("foo")
+    assert db.get_revision()[1] == 1
+    with pytest.raises(orm.Metric.DoesNotExist):
+        db.get_revision("missing")
+
+
+def test_touch(app):
+    orm.Revision.delete().execute()
+    db.touch([1, 1, 2])
+    db.touch([2])
+    rv = orm.Revision.select(orm.Revision.key, orm.Revision.revision).tuples()
+    assert sorted(rv) == [(1, 1), (2, 2)]
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import numpy as np
+import pytest
+
+from trendlines import downsample
+
+
+@pytest.fixture
+def values():
+    rng = np.random.RandomState(0)
+    values = rng.normal(size=10000)
+    values[1234] = 50
+    values[8765] = -50
+    return values
+
+
+def test_lttb(values):
+    rv = downsample.lttb(values, 100)
+    assert len(rv) == 100
+    assert rv[0] == 0
+    assert rv[-1] == len(values) - 1
+    assert (np.diff(rv) > 0).all()
+    # Spikes are kept.
+    assert 1234 in rv
+    assert 8765 in rv
+
+
+def test_lttb_straight_line():
+    # Any point on a line is as good as any other, but there must be one
+    # from each bucket.
+    values = np.arange(100, dtype=np.float64)
+    rv = downsample.lttb(values, 10)
+    assert len(rv) == 10
+    assert len(np.unique(rv)) == 10
+
+
+def test_minmax(values):
+    rv = downsample.minmax(values, 100)
+    assert len(rv) <= 100
+    assert (np.diff(rv) > 0).all()
+    assert rv[0] == 0
+    assert rv[-1] == len(values) - 1
+    assert 1234 in rv
+    assert 8765 in rv
+
+
+def test_avg(values):
+    timestamps = np.arange(len(values), dtype=np.float64) * 60
+    position, ts, rv = downsample.avg(values, timestamps, 100)
+    assert len(position) == len(ts) == len(rv) == 100
+    assert (position[0], ts[0], rv[0]) == (0, 0, values[0])
+    assert rv[-1] == values[-1]
+    assert np.allclose(ts, position * 60)
+    # Spikes are averaged out.
+    assert rv.max() < 50
+
+
+@pytest.mark.parametrize("method", [downsample.lttb, downsample.minmax])
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 10])
+def test_fewer_points_than_requested(method, length):
+    values = np.arange(length, dtype=np.float64)
+    rv = method(values, 10)
+    assert rv.tolist() == list(range(length))
+
+
+@pytest.mark.parametrize("length", [4, 5, 6, 7, 100])
+@pytest.mark.parametrize("n", [3, 4, 5])
+def test_small_series(length, n):
+    values = np.arange(length, dtype=np.float64)
+    assert len(downsample.lttb(values, n)) == min(length, n)
+    assert len(downsample.avg(values, values, n)[0]) == min(length, n)
+    rv = downsample.minmax(values, n)
+    assert (np.diff(rv) > 0).all()
+
+
+def test_keep_violations():
+    values = np.zeros(1000)
+    values[[15, 16, 500]] = 5
+    values[700] = -5
+    selected = np.array([0, 999])
+
+    rv = downsample.keep_violations(values, selected, -1, 1, n=100)
+    # 15 and 16 are in the same bucket.
+    assert rv.tolist() == [0, 15, 500, 700, 999]
+
+    rv = downsample.keep_violations(values, selected, upper_limit=1, n=100)
+    assert rv.tolist() == [0, 15, 500, 999]
+
+    rv = downsample.keep_violations(values, selected)
+    assert rv is selected
+
+
+def test_downsample_rows():
+    rows = [(i + 1, 1546532070 + i, float(i % 7)) for i in range(1000)]
+    rows[300] = (301, 1546532370, 100.0)
+    rv = downsample.downsample_rows(rows, 50, "lttb", upper_limit=10)
+    assert len(rv) == 50
+    assert rv[0] == {"timestamp": "2019-01-03T16:14:30", "value": 0,
+                     "id": 1, "n": 0}
+    assert {"timestamp": "2019-01-03T16:19:30", "value": 100,
+            "id": 301, "n": 300} in rv
+
+
+def test_downsample_rows_avg():
+    rows = [(i + 1, 1546532070 + i, 1.0) for i in range(1000)]
+    rv = downsample.downsample_rows(rows, 10, "avg")
+    assert len(rv) == 10
+    assert all(r['id'] is None for r in rv)
+    assert all(r['value'] == 1 for r in rv)
+    assert isinstance(rv[1]['n'], int)
+
+
+def test_downsample_rows_columnar():
+    rows = [(i + 1, 1546532070 + i, float(i % 7)) for i in range(1000)]
+    expected = downsample.downsample_rows(rows, 50, "minmax")
+    rv = downsample.downsample_rows(rows, 50, "minmax", columnar=True)
+    assert rv["ids"] == [r["id"] for r in expected]
+    assert rv["values"] == [r["value"] for r in expected]
+    assert rv["n"] == [r["n"] for r in expected]
+    assert rv["timestamps"][:2] == [1546532070, 1546532076]
+
+
+def test_downsample_rows_invalid_method():
+    with pytest.raises(ValueError):
+        downsample.downsample_rows([], 10, "median")
+
+
+def test_downsample_rollups():
+    rollups = [
+        # bucket, count, sum, min, max, first_ts, first, last_ts, last
+        (1546300800, 3, 6, 1, 3, 1546300800, 1, 1546300850, 3),
+        (1546300860, 1, 5, 5, 5, 1546300870, 5, 1546300870, 5),
+        (1546300920, 2, 4, 0, 4, 1546300920, 4, 1546300979, 0),
+    ]
+    rv, total = downsample.downsample_rollups(rollups, 100, "minmax")
+    assert total == 6
+    assert [(r['value'], r['n']) for r in rv] == [
+        (1, 0), (3, 2), (5, 3), (4, 4), (0, 5),
+    ]
+    assert rv[1]['timestamp'] == "2019-01-01T00:00:50"
+    assert all(r['id'] is None for r in rv)
+
+
+def test_downsample_rollups_columnar():
+    rollups = [
+        (1546300800, 3, 6, 1, 3, 1546300800, 1, 1546300850, 3),
+        (1546300860, 1, 5, 5, 5, 1546300870, 5, 1546300870, 5),
+    ]
+    rv, total = downsample.downsample_rollups(rollups, 100, "avg",
+                                              columnar=True)
+    assert total == 4
+    assert rv == {"timestamps": [1546300825, 1546300870], "values": [2, 5],
+                  "ids": [None, None], "n": [1, 3]}
+
+
+def test_downsample_rollups_avg():
+    rollups = [
+        (1546300800, 3, 6, 1, 3, 1546300800, 1, 1546300850, 3),
+        (1546300860, 1, 5, 5, 5, 1546300870, 5, 1546300870, 5),
+    ]
+    rv, total = downsample.downsample_rollups(rollups, 100, "avg")
+    assert total == 4
+    assert rv == [
+        {"timestamp": "2019-01-01T00:00:25", "value": 2, "id": None,
+         "n": 1},
+        {"timestamp": "2019-01-01T00:01:10", "value": 5, "id": None,
+         "n": 3},
+    ]
+
+
+def test_downsample_rollups_empty():
+    rv, total = downsample.downsample_rollups([], 100, "lttb")
+    assert (rv, total) == ([], 0)
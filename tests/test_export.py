@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import io
+import json
+
+import numpy as np
+import pytest
+
+from trendlines import export
+
+
+@pytest.fixture
+def columns():
+    return {
+        "timestamp": np.array([0, 1546532003, 1546532067], dtype=np.int64),
+        "value": np.array([1.5, 2, -3.25]),
+        "id": np.array([1, 2, 3], dtype=np.int64),
+    }
+
+
+def test_write_npy(columns):
+    rv = np.load(io.BytesIO(export.write("npy", columns)))
+    assert rv.dtype.names == ("timestamp", "value", "id")
+    for name, column in columns.items():
+        np.testing.assert_array_equal(rv[name], column)
+
+
+def test_write_npy_empty():
+    columns = {"value": np.array([], dtype=np.float64)}
+    rv = np.load(io.BytesIO(export.write("npy", columns)))
+    assert len(rv) == 0
+
+
+def test_write_npz(columns):
+    rv = np.load(io.BytesIO(export.write("npz", columns, {"units": "m"})))
+    assert sorted(rv.files) == ["id", "timestamp", "value"]
+    for name, column in columns.items():
+        np.testing.assert_array_equal(rv[name], column)
+        assert rv[name].dtype == column.dtype
+
+
+def test_write_msgpack(columns):
+    msgpack = pytest.importorskip("msgpack")
+    rv = msgpack.unpackb(export.write("msgpack", columns, {"units": "m"}),
+                         raw=False)
+    assert rv["units"] == "m"
+    for name, column in columns.items():
+        data = np.frombuffer(rv[name], dtype=rv["dtypes"][name])
+        np.testing.assert_array_equal(data, column)
+
+
+def test_write_arrow(columns):
+    pyarrow = pytest.importorskip("pyarrow")
+    data = export.write("arrow", columns, {"units": "m"})
+    table = pyarrow.ipc.open_stream(data).read_all()
+    assert table.column_names == ["timestamp", "value", "id"]
+    assert str(table.schema.field("timestamp").type) == "timestamp[s, tz=UTC]"
+    assert json.loads(table.schema.metadata[b"trendlines"]) == {"units": "m"}
+    assert table.column("value").to_pylist() == [1.5, 2, -3.25]
+
+
+def test_write_not_available(columns, monkeypatch):
+    monkeypatch.delitem(export.WRITERS, "npz")
+    with pytest.raises(KeyError):
+        export.write("npz", columns)
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import json
+import os
+import pickle
+import select
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from io import BytesIO
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+from freezegun import freeze_time
+from peewee import IntegrityError
+
+from trendlines import ingest
+from trendlines import orm
+
+
+@pytest.fixture
+def points():
+    return [
+        ("foo", 15, 1546532070),
+        ("foo.bar", -2.5, 1546532071),
+    ]
+
+
+def test_write_direct(app, points):
+    rv = ingest.write_direct(points)
+    assert rv == 2
+    assert len(orm.Metric.select()) == 2
+    data = orm.DataPoint.select().order_by(orm.DataPoint.datapoint_id)
+    assert [d.value for d in data] == [15, -2.5]
+
+
+class FakeApi(object):
+    """
+    A minimal ``/api/v1/data`` server that records what it receives.
+
+    Responds with each status in ``statuses`` in turn, then with ``201``.
+    """
+    def __init__(self):
+        self.requests = []
+        self.clients = set()
+        self.statuses = []
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                items = json.loads(self.rfile.read(length))
+                api.requests.append(items)
+                api.clients.add(self.client_address)
+
+                status = api.statuses.pop(0) if api.statuses else 201
+                body = json.dumps({"added": len(items)}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://%s:%s/api/v1/data" % self.server.server_address
+
+
+@pytest.fixture
+def fake_api():
+    api = FakeApi()
+    thread = threading.Thread(target=api.server.serve_forever)
+    thread.start()
+    yield api
+    api.server.shutdown()
+    api.server.server_close()
+    thread.join(5)
+
+
+def test_forwarder_sends_batches(fake_api, points):
+    forwarder = ingest.Forwarder(fake_api.url)
+    try:
+        assert forwarder(points) == 2
+        assert forwarder(points) == 2
+        assert forwarder([]) == 0
+    finally:
+        forwarder.close()
+
+    # One request per batch, over a single kept-alive connection.
+    expected = [
+        {"metric": "foo", "value": 15, "time": 1546532070},
+        {"metric": "foo.bar", "value": -2.5, "time": 1546532071},
+    ]
+    assert fake_api.requests == [expected, expected]
+    assert len(fake_api.clients) == 1
+
+
+def test_forwarder_retries(fake_api, points, caplog):
+    fake_api.statuses = [503, 502]
+    forwarder = ingest.Forwarder(fake_api.url, retries=2, backoff=0)
+    assert forwarder(points) == 2
+    assert len(fake_api.requests) == 3
+
+    fake_api.statuses = [503, 503, 503]
+    assert forwarder(points) == 0
+    assert "HTTP 503" in caplog.text
+
+    fake_api.statuses = [400]
+    assert forwarder(points) == 0
+    assert len(fake_api.requests) == 7
+
+
+def test_forwarder_connection_error(caplog):
+    # Nothing is listening on port 1.
+    forwarder = ingest.Forwarder("http://127.0.0.1:1/api/v1/data", retries=0)
+    assert forwarder([("foo", 1, None)]) == 0
+    assert "Failed to forward 1 datapoints" in caplog.text
+
+
+@patch("trendlines.ingest.orm.create_db")
+def test_make_writer_direct(mock_create_db):
+    config = {"SOCKET_INGEST_MODE": "direct", "DATABASE": "foo.db"}
+    rv = ingest.make_writer(config)
+    assert isinstance(rv, ingest.DirectWriter)
+    # The database isn't opened until the first write.
+    mock_create_db.assert_not_called()
+
+
+@patch("trendlines.ingest.orm.create_db")
+def test_direct_writer_opens_db_once(mock_create_db, app, points):
+    write = ingest.DirectWriter("foo.db")
+    assert write(points) == len(points)
+    assert write(points) == len(points)
+    mock_create_db.assert_called_once_with("foo.db")
+
+
+def test_make_writer_forward():
+    config = {"SOCKET_INGEST_MODE": "forward",
+              "TRENDLINES_API_URL": "http://foo/api/v1/data",
+              "FORWARD_POOL_SIZE": 2,
+              "FORWARD_RETRIES": 5,
+              "FORWARD_BACKOFF": 0.1,
+              "FORWARD_TIMEOUT": 3}
+    rv = ingest.make_writer(config)
+    assert isinstance(rv, ingest.Forwarder)
+    assert rv.url == "http://foo/api/v1/data"
+    assert rv.timeout == 3
+    adapter = rv.session.get_adapter(rv.url)
+    assert adapter.max_retries.total == 5
+    assert adapter._pool_maxsize == 2
+
+
+def test_make_writer_invalid_mode():
+    with pytest.raises(ValueError):
+        ingest.make_writer({"SOCKET_INGEST_MODE": "foo"})
+
+
+def test_batcher_flushes_when_full():
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write, max_size=3, max_delay=60)
+    for i in range(7):
+        batcher.add(i)
+    assert write.call_count == 2
+    assert write.call_args_list[0][0][0] == [0, 1, 2]
+    assert write.call_args_list[1][0][0] == [3, 4, 5]
+    assert len(batcher) == 1
+
+    assert batcher.flush() == 1
+    write.assert_called_with([6])
+    assert len(batcher) == 0
+
+    # Nothing left to write.
+    assert batcher.flush() == 0
+    assert write.call_count == 3
+
+
+def test_batcher_extend():
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write, max_size=3, max_delay=60)
+    batcher.add(0)
+    batcher.extend(list(range(1, 8)))
+    batcher.extend([])
+    assert write.call_count == 2
+    assert write.call_args_list[0][0][0] == [0, 1, 2]
+    assert write.call_args_list[1][0][0] == [3, 4, 5]
+    assert len(batcher) == 2
+
+
+def test_batcher_flushes_when_old():
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write, max_size=100, max_delay=5)
+    assert batcher.time_remaining() is None
+
+    with freeze_time("2019-01-25T04:32:28Z") as frozen:
+        batcher.add(1)
+        assert batcher.time_remaining() == 5
+        frozen.tick(3)
+        batcher.add(2)
+        batcher.flush_if_due()
+        assert write.call_count == 0
+
+        frozen.tick(2)
+        assert batcher.time_remaining() == 0
+        batcher.add(3)
+        write.assert_called_once_with([1, 2, 3])
+
+
+@freeze_time("2019-01-25T04:32:28Z")        # 1548390748
+def test_read_lines(caplog):
+    lines = [b"foo.bar 1 1546532070"] * 10000
+    lines += [b"", b"baz 2", b"bad line here", b"  spaced 3  "]
+    stream = BytesIO(b"\n".join(lines))
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write, max_size=1000, max_delay=60)
+
+    rv = ingest.read_lines(stream, batcher)
+    batcher.flush()
+    assert rv == (10002, 1)
+    assert write.call_count == 11
+    assert "Failed to parse `bad line here`" in caplog.text
+
+    last = write.call_args[0][0]
+    assert last[0] == ("baz", 2, 1548390748)
+    assert last[1] == ("spaced", 3, 1548390748)
+
+
+def test_read_lines_write_error(caplog):
+    lines = [b"foo %d 1546532070" % i for i in range(10)]
+    lines[3] = b"m nan 2000"
+    write = MagicMock(side_effect=[IntegrityError("oops"), 3, 3])
+    batcher = ingest.Batcher(write, max_size=3, max_delay=60)
+
+    rv = ingest.read_lines(BytesIO(b"\n".join(lines)), batcher)
+    batcher.flush()
+    assert rv == (9, 1)
+    # The first batch failed, but the connection kept being read.
+    assert write.call_count == 3
+    assert "Failed to write batch of 3 datapoints" in caplog.text
+    assert "Failed to parse `m nan 2000`" in caplog.text
+
+
+def test_read_lines_direct_not_finite(app):
+    lines = [b"foo %d 1546532070" % i for i in range(10)]
+    lines[3] = b"m nan 2000"
+    batcher = ingest.Batcher(ingest.write_direct, max_size=3, max_delay=60)
+    ingest.read_lines(BytesIO(b"\n".join(lines)), batcher)
+    batcher.flush()
+    assert len(orm.DataPoint.select()) == 9
+
+
+def test_read_lines_long_line(caplog):
+    long_line = b"foo " + b"1" * (ingest.READ_SIZE * 2)
+    stream = BytesIO(long_line + b"\nfoo 1 1546532070\n")
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write)
+
+    rv = ingest.read_lines(stream, batcher)
+    assert rv == (1, 1)
+    assert "Discarded a line longer than" in caplog.text
+
+
+def test_line_buffer():
+    buffer = ingest.LineBuffer()
+    assert buffer.feed(b"foo 1\nfo") == b"foo 1\n"
+    assert buffer.feed(b"o 2") == b""
+    assert buffer.feed(b"\nfoo 3\nfoo") == b"foo 2\nfoo 3\n"
+    assert buffer.close() == b"foo"
+
+    # Unfinished lines are only buffered up to MAX_LINE_LENGTH.
+    assert buffer.feed(b"a" * (ingest.MAX_LINE_LENGTH + 1)) == b""
+    assert buffer.feed(b"aaa") == b""
+    assert buffer.feed(b"a\nfoo 4\nfoo 5") == b"foo 4\n"
+    assert buffer.discarded == 1
+    assert buffer.close() == b"foo 5"
+
+
+def _pickle_message(items, protocol=2):
+    data = pickle.dumps(items, protocol=protocol)
+    return struct.pack("!L", len(data)) + data
+
+
+@pytest.mark.parametrize("protocol", [0, 2, pickle.HIGHEST_PROTOCOL])
+def test_parse_pickle_data(protocol):
+    items = [
+        ("foo", (1546532070, 15)),
+        ("foo.bar", (1546532071.5, -2.5)),
+        ("bad", (1546532072, "apple")),
+        ("also.bad", 3),
+    ]
+    points, rejected = ingest.parse_pickle_data(pickle.dumps(items, protocol))
+    assert rejected == 2
+    assert points == [
+        ("foo", 15, 1546532070),
+        ("foo.bar", -2.5, 1546532071),
+    ]
+
+
+def test_parse_pickle_data_not_finite():
+    items = [
+        ("inf.time", (float("inf"), 1)),
+        ("nan.time", (float("nan"), 1)),
+        ("nan.value", (1546532070, float("nan"))),
+        ("inf.value", (1546532070, "-inf")),
+        ("huge.time", (1e20, 1)),
+        ("negative.time", (-2 ** 63, 1)),
+        ("good", (1546532070, 1)),
+    ]
+    points, rejected = ingest.parse_pickle_data(pickle.dumps(items))
+    assert rejected == 6
+    assert [p[0] for p in points] == ["good"]
+
+
+def test_parse_pickle_data_bytes_metric():
+    data = pickle.dumps([(b"foo", (1546532070, 1))], protocol=3)
+    points, rejected = ingest.parse_pickle_data(data)
+    assert points[0][0] == "foo"
+
+
+class Evil(object):
+    def __reduce__(self):
+        return (os.system, ("echo pwned", ))
+
+
+@pytest.mark.parametrize("obj", [
+    [("foo", (1546532070, Evil()))],
+    Evil(),
+    {"foo": 1},
+])
+def test_parse_pickle_data_refuses_unsafe_data(obj):
+    with pytest.raises(pickle.UnpicklingError):
+        ingest.parse_pickle_data(pickle.dumps(obj))
+
+
+def test_parse_pickle_data_invalid():
+    with pytest.raises(pickle.UnpicklingError):
+        ingest.parse_pickle_data(b"not a pickle")
+
+
+def test_read_pickle(caplog):
+    stream = BytesIO(
+        _pickle_message([("foo", (1546532070, 1)), ("bar", (1546532070, 2))])
+        + _pickle_message([("foo", (1546532071, 3))])
+        + _pickle_message([("bad", (1546532071, None))])
+        + _pickle_message(Evil())
+        + _pickle_message([("foo", (1546532072, 4))])
+    )
+    write = MagicMock(side_effect=len)
+    assert ingest.read_pickle(stream, write) == (4, 1)
+
+    # One write per message.
+    assert write.call_count == 3
+    assert [p[1] for p in write.call_args_list[0][0][0]] == [1, 2]
+    assert "Refusing to unpickle" in caplog.text
+
+
+def test_read_pickle_time_out_of_range(app, caplog):
+    stream = BytesIO(_pickle_message([("foo", (1e20, 1)),
+                                      ("foo", (1546532070, 2))]))
+    assert ingest.read_pickle(stream, ingest.write_direct) == (1, 1)
+    assert "Invalid item" in caplog.text
+    assert [d.value for d in orm.DataPoint.select()] == [2]
+
+
+def test_read_pickle_write_error(caplog):
+    stream = BytesIO(
+        _pickle_message([("foo", (1546532070, 1))])
+        + _pickle_message([("foo", (1546532071, 2))])
+    )
+    write = MagicMock(side_effect=[IntegrityError("oops"), 1])
+    assert ingest.read_pickle(stream, write) == (1, 0)
+    assert write.call_count == 2
+    assert "Pickle: Failed to write 1 datapoints" in caplog.text
+
+
+def test_read_pickle_too_long(caplog):
+    stream = BytesIO(struct.pack("!L", ingest.MAX_PICKLE_LENGTH + 1)
+                     + b"a" * 10)
+    write = MagicMock()
+    assert ingest.read_pickle(stream, write) == (0, 0)
+    assert not write.called
+    assert "Closing the connection" in caplog.text
+
+
+def test_read_pickle_truncated(caplog):
+    stream = BytesIO(_pickle_message([("foo", (1546532070, 1))])[:-3])
+    write = MagicMock()
+    assert ingest.read_pickle(stream, write) == (0, 0)
+    assert "Connection closed mid-message" in caplog.text
+
+
+@pytest.fixture
+def udp_socket():
+    sock = ingest.bind_udp("127.0.0.1", 0)
+    yield sock
+    sock.close()
+
+
+def _send_udp(address, *datagrams):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        for datagram in datagrams:
+            client.sendto(datagram, address)
+
+
+def test_read_datagrams(udp_socket):
+    _send_udp(udp_socket.getsockname(),
+              b"foo 1 1546532070",
+              b"foo 2 1546532071\nbar 3 1546532072\n",
+              b"not valid")
+    write = MagicMock(side_effect=len)
+    batcher = ingest.Batcher(write)
+
+    # Wait for the datagrams to arrive.
+    select.select([udp_socket], [], [], 2)
+
+    total = (0, 0)
+    for _ in range(20):
+        accepted, rejected = ingest.read_datagrams(udp_socket, batcher)
+        total = (total[0] + accepted, total[1] + rejected)
+        if sum(total) == 4:
+            break
+        select.select([udp_socket], [], [], 0.1)
+
+    assert total == (3, 1)
+    batcher.flush()
+    written = write.call_args[0][0]
+    assert [p[1] for p in written] == [1, 2, 3]
+
+
+def test_read_datagrams_nothing_waiting(udp_socket):
+    batcher = ingest.Batcher(MagicMock())
+    assert ingest.read_datagrams(udp_socket, batcher) == (0, 0)
+
+
+def test_serve_udp(udp_socket):
+    written = []
+    flushed = threading.Event()
+
+    def write(points):
+        written.extend(points)
+        flushed.set()
+        return len(points)
+
+    batcher = ingest.Batcher(write, max_size=1000, max_delay=0.05)
+    stop = threading.Event()
+    thread = threading.Thread(target=ingest.serve_udp,
+                              args=(udp_socket, batcher, stop, 0.01))
+    thread.start()
+    try:
+        _send_udp(udp_socket.getsockname(), b"foo 1 1546532070\nfoo 2")
+        # Written because of max_delay, not because the batch is full.
+        assert flushed.wait(5)
+    finally:
+        stop.set()
+        thread.join(5)
+
+    assert not thread.is_alive()
+    assert [p[1] for p in written] == [1, 2]
+
+
+def test_serve_udp_survives_write_errors(udp_socket, caplog):
+    write = MagicMock(side_effect=Exception("database is locked"))
+    batcher = ingest.Batcher(write, max_size=1, max_delay=60)
+    stop = threading.Event()
+    thread = threading.Thread(target=ingest.serve_udp,
+                              args=(udp_socket, batcher, stop, 0.01))
+    thread.start()
+    try:
+        _send_udp(udp_socket.getsockname(), b"foo 1")
+        for _ in range(500):
+            if write.called:
+                break
+            stop.wait(0.01)
+    finally:
+        stop.set()
+        thread.join(5)
+
+    assert write.called
+    assert not thread.is_alive()
+    assert "Failed to write batch" in caplog.text
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import asyncio
+import socket
+
+from trendlines import ingest
+from trendlines import ingest_server
+
+
+class Recorder(object):
+    """
+    A writer that records each batch it's given.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, points):
+        self.batches.append(points)
+        return len(points)
+
+    @property
+    def points(self):
+        return [p for batch in self.batches for p in batch]
+
+
+def _run(coro):
+    # Not `asyncio.run`, which needs Python 3.7.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def _make_server(write, **kwargs):
+    return ingest_server.IngestServer(write, "127.0.0.1", 0, 0, **kwargs)
+
+
+async def _send_tcp(address, data):
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(data)
+    writer.write_eof()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def test_load_config(monkeypatch, tmp_path):
+    path = tmp_path / "foo.cfg"
+    path.write_text("TCP_PORT = 1234\n")
+    monkeypatch.setenv(ingest_server.CFG_VAR, str(path))
+    config = ingest_server.load_config()
+    assert config['TCP_PORT'] == 1234
+    assert config['SOCKET_INGEST_MODE'] == "direct"
+
+
+def test_load_config_no_file(monkeypatch, caplog):
+    monkeypatch.delenv(ingest_server.CFG_VAR, raising=False)
+    config = ingest_server.load_config()
+    assert config['TCP_PORT'] == 2003
+    assert "No config file loaded" in caplog.text
+
+
+def test_tcp():
+    write = Recorder()
+
+    async def main():
+        server = _make_server(write, batch_size=10)
+        await server.start()
+        lines = b"".join(b"foo %d 1546532070\n" % i for i in range(25))
+        response = await _send_tcp(server.tcp_address, lines + b"bar 99")
+        await server.stop()
+        return response
+
+    assert _run(main()) == b"accepted"
+    assert len(write.points) == 26
+    assert write.points[-1][0] == "bar"
+    assert max(len(b) for b in write.batches) <= 10
+
+
+def test_tcp_many_concurrent_connections():
+    write = Recorder()
+
+    async def main():
+        server = _make_server(write)
+        await server.start()
+        # One slow client must not block the others.
+        slow_reader, slow_writer = await asyncio.open_connection(
+            *server.tcp_address)
+        slow_writer.write(b"slow 1")
+        await slow_writer.drain()
+
+        sends = [_send_tcp(server.tcp_address, b"foo.%d %d\n" % (i, i))
+                 for i in range(200)]
+        responses = await asyncio.gather(*sends)
+
+        slow_writer.write_eof()
+        await slow_reader.read()
+        slow_writer.close()
+        await server.stop()
+        return responses
+
+    responses = _run(main())
+    assert all(r == b"accepted" for r in responses)
+    assert len(write.points) == 201
+    assert write.points[-1][0] == "slow"
+
+
+def test_tcp_invalid_and_long_lines(caplog):
+    write = Recorder()
+
+    async def main():
+        server = _make_server(write)
+        await server.start()
+        data = (b"foo 1\n"
+                + b"bad\n"
+                + b"foo " + b"1" * (ingest.READ_SIZE * 3) + b"\n"
+                + b"\n"
+                + b"foo 2\n")
+        await _send_tcp(server.tcp_address, data)
+        await server.stop()
+
+    _run(main())
+    assert [p[1] for p in write.points] == [1, 2]
+    assert "Failed to parse `bad`" in caplog.text
+    assert "Discarded a line longer than" in caplog.text
+
+
+def test_udp():
+    write = Recorder()
+
+    async def main():
+        server = _make_server(write, batch_delay=0.01)
+        await server.start()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            client.sendto(b"foo 1\nfoo 2\nbad", server.udp_address)
+            client.sendto(b"bar 3", server.udp_address)
+
+        for _ in range(500):
+            if len(write.points) == 3:
+                break
+            await asyncio.sleep(0.01)
+        await server.stop()
+
+    _run(main())
+    assert [p[1] for p in write.points] == [1, 2, 3]
+
+
+def test_udp_queue_full(caplog):
+    write = Recorder()
+
+    async def main():
+        server = _make_server(write, queue_size=2)
+        await server.start()
+        # Don't give the writer a chance to drain the queue.
+        server.add_datagram(b"foo 1\nfoo 2\nfoo 3\nfoo 4")
+        dropped = server.dropped
+        await server.stop()
+        return dropped
+
+    assert _run(main()) == 2
+    assert len(write.points) == 2
+    assert "Queue full" in caplog.text
+
+
+def test_write_errors_are_logged(caplog):
+    def write(points):
+        raise Exception("database is locked")
+
+    async def main():
+        server = _make_server(write)
+        await server.start()
+        server.add_datagram(b"foo 1")
+        await server.stop()
+
+    _run(main())
+    assert "Failed to write batch of 1 datapoints" in caplog.text
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import json
+import threading
+
+import pytest
+
+from trendlines import db
+from trendlines import live
+
+
+@pytest.mark.parametrize("name, prefix, expected", [
+    ("foo", "foo", True),
+    ("foo.bar", "foo", True),
+    ("foobar", "foo", False),
+    ("bar.foo", "foo", False),
+    ("foo", "", True),
+])
+def test_matches(name, prefix, expected):
+    assert live.matches(name, prefix=prefix) is expected
+
+
+def test_hub_publish():
+    hub = live.Hub()
+    foo = hub.subscribe(metric="foo")
+    prefix = hub.subscribe(prefix="foo")
+    everything = hub.subscribe(prefix="")
+    assert len(hub) == 3
+
+    hub.publish([("foo.bar", 2, 0, 1.5), ("foo", 1, 0, 1), ("bar", 3, 0, 0)])
+    assert foo.get(0) == [("foo", 1, 0, 1)]
+    assert prefix.get(0) == [("foo", 1, 0, 1), ("foo.bar", 2, 0, 1.5)]
+    assert len(everything.get(0)) == 3
+    assert foo.get(0) == []
+
+    foo.close()
+    prefix.close()
+    assert len(hub) == 1
+
+
+def test_subscription_requires_one_filter():
+    with pytest.raises(ValueError):
+        live.Hub().subscribe()
+    with pytest.raises(ValueError):
+        live.Hub().subscribe(metric="foo", prefix="foo")
+
+
+def test_subscription_coalesces():
+    hub = live.Hub()
+    sub = hub.subscribe(metric="foo")
+
+    def publish_later():
+        hub.publish([("foo", 2, 0, 0)])
+
+    hub.publish([("foo", 1, 0, 0)])
+    timer = threading.Timer(0.01, publish_later)
+    timer.start()
+    rows = sub.get(1, delay=0.2)
+    timer.join()
+    assert [row[1] for row in rows] == [1, 2]
+
+
+def test_subscription_overflow():
+    sub = live.Hub().subscribe(metric="foo", max_size=2)
+    sub.put([("foo", 1, 0, 0)])
+    sub.put([("foo", 2, 0, 0), ("foo", 3, 0, 0)])
+    assert sub.overflowed
+    assert list(live.stream_events(sub)) == ["retry: 1000\n\n"]
+
+
+def test_format_event():
+    rv = live.format_event([("foo", 1, 10, 1.5), ("bar", 3, 11, 2),
+                            ("foo", 2, 12, 3)])
+    lines = rv.split("\n")
+    assert lines[0] == "id: 3"
+    assert json.loads(lines[1][len("data: "):]) == [
+        {"metric": "foo", "timestamps": [10, 12], "values": [1.5, 3],
+         "ids": [1, 2]},
+        {"metric": "bar", "timestamps": [11], "values": [2], "ids": [3]},
+    ]
+    assert rv.endswith("\n\n")
+
+
+def test_stream_events():
+    hub = live.Hub()
+    sub = hub.subscribe(metric="foo")
+    backfill = [("foo", 1, 10, 0)]
+    events = live.stream_events(sub, backfill, heartbeat=0.01, delay=0)
+
+    assert next(events) == "retry: 1000\n\n"
+    assert next(events).startswith("id: 1\n")
+    assert next(events) == ": keepalive\n\n"
+
+    # Datapoints that were already sent are skipped.
+    hub.publish([("foo", 1, 10, 0), ("foo", 2, 11, 0)])
+    assert next(events).startswith("id: 2\n")
+
+    events.close()
+    assert len(hub) == 0
+
+
+def test_insert_publishes(app):
+    db.add_metric("foo")
+    with live.hub.subscribe(prefix="") as sub:
+        db.insert_datapoint("foo", 1, 1546532070)
+        db.insert_datapoints([("bar", 2, 1546532071.4), ("foo", 3, None)])
+        rows = sub.get(0)
+    assert [row[:3] for row in rows[:3]] == [
+        ("foo", 1, 1546532070),
+        ("bar", 2, 1546532071),
+        ("foo", 3, rows[2][2]),
+    ]
+    assert [row[3] for row in rows] == [1, 2, 3]
+    assert list(db.get_new_datapoints(prefix="")) == rows
+
+
+def test_get_new_datapoints(populated_db):
+    rv = db.get_new_datapoints(prefix="foo", since_id=3)
+    assert [row[:2] for row in rv] == [("foo", 4), ("foo.bar", 5),
+                                       ("foo.bar", 6)]
+    rv = db.get_new_datapoints(metric="old_data", since=1545321236,
+                               limit=1)
+    assert list(rv) == [("old_data", 9, 1546532003, 5)]
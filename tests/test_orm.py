@@ -69,6 +69,7 @@ def broken_db(outdated_db):
     conn = sqlite3.connect(str(path))
     c = conn.cursor()
     c.execute('DROP TABLE datapoint;')
+    c.execute('DROP TABLE metric;')
     conn.commit()
     conn.close()
     yield path
@@ -8,6 +8,7 @@ import pytest
 from peewee import SqliteDatabase
 from peewee_moves import DatabaseManager
 
+from trendlines import db
 from trendlines import routes
 from trendlines import orm
 
@@ -145,3 +146,52 @@ def test_migration_0006_to_0005(db_0006_with_data):
     assert metric_0005 == metric_0006
     assert len(data_0005) != 0
     assert data_0005 == data_0006
+
+
+def test_migration_0007_downgrade(db_0006):
+    manager = DatabaseManager(SqliteDatabase(str(db_0006)))
+    manager.upgrade()
+    manager.downgrade("0007")
+
+    with SqliteDatabase(str(db_0006)) as db:
+        indexes = [i.name for i in db.get_indexes("datapoint")]
+    assert indexes == ["datapoint_metric_id"]
+
+
+def test_migration_0008_backfills_rollups(db_0006_with_data):
+    with orm.db:
+        orm.DataPoint.create(metric=1, value=7, timestamp=1557860570)
+        orm.DataPoint.create(metric=1, value=-2, timestamp=-30)
+
+    manager = DatabaseManager(SqliteDatabase(str(db_0006_with_data)))
+    manager.upgrade("0008")
+
+    with orm.db:
+        rows = (orm.DataPoint.select(orm.DataPoint.metric,
+                                     orm.DataPoint.value,
+                                     orm.DataPoint.timestamp.cast("INTEGER"))
+                .order_by(orm.DataPoint.timestamp,
+                          orm.DataPoint.datapoint_id)
+                .tuples())
+        expected = sorted(k + tuple(v) for k, v in db._aggregate(rows).items())
+        rollups = sorted(orm.Rollup.select().tuples())
+    assert rollups == expected
+    assert (1, 60, -60, 1, -2, -2, -2, -30, -2, -30, -2) in rollups
+
+    manager.downgrade("0008")
+    with SqliteDatabase(str(db_0006_with_data)) as sqlite:
+        assert "rollup" not in sqlite.get_tables()
+
+
+def test_migration_0009_seeds_revisions(db_0006_with_data):
+    manager = DatabaseManager(SqliteDatabase(str(db_0006_with_data)))
+    manager.upgrade("0009")
+
+    with orm.db:
+        rv = orm.Revision.select(orm.Revision.key, orm.Revision.revision)
+        assert sorted(rv.tuples()) == [(0, 1), (1, 1), (2, 1)]
+        assert db.get_revision("foo")[1] == 1
+
+    manager.downgrade("0009")
+    with SqliteDatabase(str(db_0006_with_data)) as sqlite:
+        assert "revision" not in sqlite.get_tables()
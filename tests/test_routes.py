@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 """
 """
+import io
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import numpy as np
 import pytest
 
+from trendlines import db
+from trendlines import export
+from trendlines import live
 from trendlines import routes
 from trendlines import orm
+from trendlines import utils
 
 
 API_BASE = "/api/v1"
@@ -100,6 +106,34 @@ def test_api_add(client):
     assert b"Added DataPoint to Metric" in rv.data
 
 
+def test_api_add_after_metric_renamed(client, populated_db):
+    # "foo" is in the metric cache. Rename it, then add data to the old name.
+    rv = client.patch(metric_url(2), json={"name": "renamed"})
+    assert rv.status_code == 204
+
+    rv = client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    assert rv.status_code == 201
+    new = orm.Metric.get(orm.Metric.name == "foo")
+    assert new.metric_id == 7
+    assert len(new.datapoints) == 1
+
+
+def test_api_add_after_metric_deleted(client, populated_db):
+    rv = client.delete(metric_url(2))
+    assert rv.status_code == 204
+
+    rv = client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    assert rv.status_code == 201
+    assert orm.Metric.get(orm.Metric.name == "foo").metric_id == 7
+
+
+def test_api_add_with_invalid_value(client):
+    data = {"metric": "test", "value": "ten"}
+    rv = client.post("/api/v1/data", json=data)
+    assert rv.status_code == 400
+    assert b"'value' must be numeric" in rv.data
+
+
 def test_api_add_with_missing_key(client):
     data = {"value": 10}
     rv = client.post("/api/v1/data", json=data)
@@ -107,6 +141,121 @@ def test_api_add_with_missing_key(client):
     assert b"Missing required key. Required keys are:" in rv.data
 
 
+def test_api_add_batch(client, populated_db):
+    data = [
+        {"metric": "foo", "value": 1},
+        {"metric": "foo", "value": 2, "time": 1546532070},
+        {"metric": "brand.new", "value": 3},
+    ]
+    rv = client.post("/api/v1/data", json=data)
+    assert rv.status_code == 201
+    assert rv.is_json
+    d = rv.get_json()
+    assert d['count'] == 3
+    assert d['added'] == 3
+    assert d['failed'] == 0
+    assert all(r['status'] == 201 for r in d['results'])
+
+    assert len(orm.DataPoint.select()) == 13
+    assert orm.Metric.get(orm.Metric.name == "brand.new") is not None
+
+
+def test_api_add_batch_partial_failure(client, populated_db):
+    data = [
+        {"metric": "foo", "value": 1},
+        {"value": 2},
+        {"metric": "foo", "value": "apple"},
+        "not an object",
+    ]
+    rv = client.post("/api/v1/data", json=data)
+    assert rv.status_code == 207
+    d = rv.get_json()
+    assert d['added'] == 1
+    assert d['failed'] == 3
+    assert [r['status'] for r in d['results']] == [201, 400, 400, 400]
+    assert "Missing required key" in d['results'][1]['detail']
+    assert len(orm.DataPoint.select()) == 11
+
+
+def test_api_add_batch_not_finite(client, populated_db):
+    body = ('[{"metric": "foo", "value": NaN},'
+            ' {"metric": "foo", "value": Infinity},'
+            ' {"metric": "foo", "value": 1, "time": -Infinity},'
+            ' {"metric": "foo", "value": 1e999},'
+            ' {"metric": "foo", "value": 3}]')
+    rv = client.post("/api/v1/data", data=body,
+                     content_type="application/json")
+    assert rv.status_code == 207
+    d = rv.get_json()
+    assert [r['status'] for r in d['results']] == [400, 400, 400, 400, 201]
+    assert "finite" in d['results'][0]['detail']
+    assert len(orm.DataPoint.select()) == 11
+
+
+def test_api_add_batch_time_out_of_range(client, populated_db):
+    body = [{"metric": "foo", "value": 1, "time": 1e20},
+            {"metric": "foo", "value": 1, "time": 2 ** 63},
+            {"metric": "foo", "value": 1, "time": -1e12},
+            {"metric": "foo", "value": 2, "time": 253402300799}]
+    rv = client.post("/api/v1/data", json=body)
+    assert rv.status_code == 207
+    d = rv.get_json()
+    assert [r['status'] for r in d['results']] == [400, 400, 400, 201]
+    assert "year" in d['results'][0]['detail']
+    assert len(orm.DataPoint.select()) == 11
+
+    # And the data can still be read.
+    rv = client.get("/api/v1/data/foo")
+    assert rv.get_json()['rows'][-1]['timestamp'] == "9999-12-31T23:59:59"
+
+
+def test_api_add_time_out_of_range(client, populated_db):
+    rv = client.post("/api/v1/data",
+                     json={"metric": "foo", "value": 1, "time": 1e20})
+    assert rv.status_code == 400
+    assert len(orm.DataPoint.select()) == 10
+
+
+def test_api_add_not_finite(client, populated_db):
+    rv = client.post("/api/v1/data", data='{"metric": "foo", "value": NaN}',
+                     content_type="application/json")
+    assert rv.status_code == 400
+    assert len(orm.DataPoint.select()) == 10
+
+
+def test_api_add_batch_all_failed(client, populated_db):
+    rv = client.post("/api/v1/data", json=[{"value": 2}])
+    assert rv.status_code == 400
+    d = rv.get_json()
+    assert d['added'] == 0
+    assert len(orm.DataPoint.select()) == 10
+
+
+def test_api_add_ndjson(client, populated_db):
+    body = ('{"metric": "foo", "value": 1}\n'
+            '\n'
+            'this is not json\n'
+            '{"metric": "bar", "value": 2, "time": 1546532070}\n')
+    rv = client.post("/api/v1/data", data=body,
+                     content_type="application/x-ndjson")
+    assert rv.status_code == 207
+    d = rv.get_json()
+    assert d['count'] == 3
+    assert d['added'] == 2
+    assert d['results'][1]['status'] == 400
+
+
+def test_api_add_batch_with_write_buffer(client, populated_db):
+    db.start_write_buffer()
+    try:
+        data = [{"metric": "foo", "value": 1}, {"metric": "bar", "value": 2}]
+        rv = client.post("/api/v1/data", json=data)
+    finally:
+        db.stop_write_buffer()
+    assert rv.status_code == 201
+    assert len(orm.DataPoint.select()) == 12
+
+
 def test_api_get_data_as_json(client, populated_db):
     rv = client.get("/api/v1/data/foo")
     assert rv.status_code == 200
@@ -119,6 +268,17 @@ def test_api_get_data_as_json(client, populated_db):
     assert d[3]['value'] == 9
 
 
+def test_api_get_data_as_json_is_streamed(client, populated_db):
+    rv = client.get("/api/v1/data/old_data")
+    assert rv.status_code == 200
+    assert rv.is_streamed
+    assert rv.is_json
+    d = rv.get_json()
+    assert [x['value'] for x in d['rows']] == [0, 1, 5, 8]
+    assert d['rows'][0]['timestamp'] == "1970-01-01T00:00:00"
+    assert d['rows'][3]['timestamp'] == "2019-01-03T16:14:27"
+
+
 def test_api_get_data_by_id(client, populated_db):
     rv = client.get("/api/v1/data/2")
     assert rv.status_code == 200
@@ -131,6 +291,354 @@ def test_api_get_data_by_id(client, populated_db):
     assert d[3]['value'] == 9
 
 
+def test_api_get_data_by_id_not_found(client, populated_db):
+    rv = client.get("/api/v1/data/999")
+    assert rv.status_code == 404
+    assert "999" in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax", "avg"])
+def test_api_get_data_downsampled(client, populated_db, method):
+    db.insert_datapoints([("foo", i % 5, 1546532070 + i) for i in range(1000)])
+    # Only the backfilled data, which is too short a range for rollups.
+    query = "?points=100&end=1546533070&method=" + method
+    rv = client.get("/api/v1/data/foo" + query)
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d['downsampled']['method'] == method
+    assert d['downsampled']['total'] == 1000
+    assert d['downsampled']['points'] == len(d['rows'])
+    assert d['downsampled']['resolution'] is None
+    assert len(d['rows']) <= 100
+    assert d['rows'][0]['timestamp'] == "2019-01-03T16:14:30"
+    assert d['rows'][-1]['value'] == 4
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax", "avg"])
+def test_api_get_data_downsampled_from_rollups(client, app, method):
+    db.add_metric("hourly", upper_limit=100)
+    # One datapoint per hour for 125 days, with a single spike.
+    start = 1546300800
+    points = [("hourly", i % 24, start + 3600 * i) for i in range(3000)]
+    points[1234] = ("hourly", 500, start + 3600 * 1234)
+    db.insert_datapoints(points)
+
+    rv = client.get("/api/v1/data/hourly?points=100&method=" + method)
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d['downsampled']['resolution'] == 86400
+    assert d['downsampled']['total'] == 3000
+    assert d['downsampled']['points'] == len(d['rows'])
+    assert all(r['id'] is None for r in d['rows'])
+    if method == "avg":
+        assert len(d['rows']) <= 100
+        # The mean of the first day.
+        assert d['rows'][0]['timestamp'] == "2019-01-01T11:30:00"
+        assert d['rows'][0]['value'] == 11.5
+    else:
+        assert d['rows'][0]['timestamp'] == "2019-01-01T00:00:00"
+        assert 500 in [r['value'] for r in d['rows']]
+
+
+def test_api_get_data_downsampled_keeps_limit_violations(client, app):
+    db.add_metric("limited", upper_limit=10)
+    points = [("limited", 1, 1546532070 + i) for i in range(1000)]
+    points[567] = ("limited", 11, 1546532070 + 567)
+    db.insert_datapoints(points)
+
+    rv = client.get("/api/v1/data/limited?points=10")
+    d = rv.get_json()
+    assert 11 in [r['value'] for r in d['rows']]
+
+
+def test_api_get_data_not_downsampled(client, populated_db):
+    rv = client.get("/api/v1/data/foo?points=1000")
+    d = rv.get_json()
+    assert [r['value'] for r in d['rows']] == [15, 17, 25, 9]
+
+
+def test_api_get_data_columnar(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?format=columnar")
+    assert rv.status_code == 200
+    assert rv.get_json() == {
+        "units": None,
+        "timestamps": [0, 1545321236, 1546532003, 1546532067],
+        "values": [0, 1, 5, 8],
+        "ids": [7, 8, 9, 10],
+    }
+
+
+def test_api_get_data_columnar_downsampled(client, populated_db):
+    db.insert_datapoints([("foo", i % 5, 1546532070 + i) for i in range(1000)])
+    query = "?points=100&end=1546533070&format=columnar"
+    rv = client.get("/api/v1/data/foo" + query)
+    d = rv.get_json()
+    assert d['downsampled']['total'] == 1000
+    assert d['downsampled']['points'] == len(d['values'])
+    assert len(d['timestamps']) == len(d['ids']) == len(d['n'])
+    assert d['timestamps'][0] == 1546532070
+    assert d['n'][0] == 0
+
+
+def test_api_get_data_since(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?since=1545321236")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert [r['value'] for r in d['rows']] == [5, 8]
+    assert d['since_id'] == 10
+
+    rv = client.get("/api/v1/data/old_data?format=columnar&since_id=10")
+    assert rv.get_json() == {"units": None, "since_id": 10,
+                             "timestamps": [], "values": [], "ids": []}
+
+    db.insert_datapoint("old_data", 3, 1546532070)
+    rv = client.get("/api/v1/data/old_data?format=columnar&since_id=10")
+    d = rv.get_json()
+    assert d['values'] == [3]
+    assert d['since_id'] == 11
+
+
+def test_api_get_data_since_npz(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?format=npz&since_id=8")
+    d = np.load(io.BytesIO(rv.data))
+    assert d["id"].tolist() == [9, 10]
+
+
+@pytest.mark.parametrize("query", [
+    "since=yesterday",
+    "since_id=apple",
+    "since_id=3&points=10",
+    "since=1&points=10",
+])
+def test_api_get_data_since_invalid(client, populated_db, query):
+    rv = client.get("/api/v1/data/old_data?" + query)
+    assert rv.status_code == 400
+    assert "since" in rv.get_json()['detail']
+
+
+def test_api_get_data_many(client, populated_db):
+    rv = client.get("/api/v1/data?metric=old_data&metric=3&metric=foo.bar"
+                    "&metric=empty_metric&start=1")
+    assert rv.status_code == 200
+    d = rv.get_json()["metrics"]
+    assert sorted(d) == ["empty_metric", "foo.bar", "old_data"]
+    assert d["empty_metric"] == {"units": "units", "rows": []}
+    single = client.get("/api/v1/data/old_data?start=1").get_json()
+    assert d["old_data"] == single
+
+
+def test_api_get_data_many_since(client, populated_db):
+    query = "/api/v1/data?metric=foo&metric=old_data&format=columnar"
+    d = client.get(query + "&since_id=8").get_json()
+    assert d["metrics"]["foo"]["values"] == []
+    assert d["metrics"]["old_data"]["ids"] == [9, 10]
+    assert d["since_id"] == 10
+
+    d = client.get(query + "&since_id=10").get_json()
+    assert d["since_id"] == 10
+
+
+def test_api_get_data_many_downsampled(client, populated_db):
+    # An hour apart, so that "hourly" is reduced from the hourly rollups.
+    db.insert_datapoints([("hourly", i % 5, 1546532070 + 3600 * i)
+                          for i in range(1000)])
+    query = "points=100&format=columnar"
+    rv = client.get("/api/v1/data?metric=hourly&metric=old_data&" + query)
+    d = rv.get_json()["metrics"]
+    assert d["hourly"]["downsampled"]["resolution"] == 3600
+    assert d["old_data"]["downsampled"]["resolution"] is None
+    for name in d:
+        single = client.get("/api/v1/data/%s?%s" % (name, query))
+        assert d[name] == single.get_json()
+
+
+def test_api_get_data_many_not_modified(client, populated_db):
+    url = "/api/v1/data?metric=foo&metric=old_data"
+    etag = client.get(url).headers["ETag"]
+    rv = client.get(url, headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    db.insert_datapoint("old_data", 3, 1546532070)
+    rv = client.get(url, headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+
+
+@pytest.mark.parametrize("query, code", [
+    ("", 400),
+    ("metric=foo&metric=missing", 404),
+    ("metric=foo&metric=99", 404),
+    ("metric=foo&format=npz", 400),
+    ("metric=foo&points=2", 400),
+    ("metric=foo&since_id=3&points=10", 400),
+])
+def test_api_get_data_many_errors(client, populated_db, query, code):
+    rv = client.get("/api/v1/data?" + query)
+    assert rv.status_code == code
+
+
+def test_api_get_data_many_too_many(app, client, populated_db):
+    app.config['DATA_MAX_METRICS'] = 1
+    rv = client.get("/api/v1/data?metric=foo&metric=old_data")
+    assert rv.status_code == 400
+
+
+@pytest.fixture
+def sse_app(app):
+    app.config['SSE'] = True
+    app.config['SSE_HEARTBEAT'] = 0.01
+    app.config['SSE_COALESCE_DELAY'] = 0
+    return app
+
+
+def _events(rv, count):
+    """Read ``count`` events from a streamed response, then close it."""
+    chunks = iter(rv.response)
+    events = [next(chunks).decode() for _ in range(count)]
+    rv.close()
+    return events
+
+
+def test_api_stream_metric(sse_app, client, populated_db):
+    rv = client.get("/api/v1/stream/foo", buffered=False)
+    assert rv.status_code == 200
+    assert rv.mimetype == "text/event-stream"
+    assert rv.headers["Cache-Control"] == "no-cache"
+
+    db.insert_datapoint("foo.bar", 1, 1546532070)
+    db.insert_datapoint("foo", 2, 1546532070)
+    retry, event = _events(rv, 2)
+    assert retry.startswith("retry:")
+    assert event.startswith("id: 12\n")
+    assert '"values": [2]' in event
+    assert len(live.hub) == 0
+
+
+def test_api_stream_prefix_catches_up(sse_app, client, populated_db):
+    rv = client.get("/api/v1/stream?prefix=foo",
+                    headers={"Last-Event-ID": "4"}, buffered=False)
+    _, event, keepalive = _events(rv, 3)
+    assert event.startswith("id: 6\n")
+    assert '"foo.bar"' in event
+    assert keepalive == ": keepalive\n\n"
+
+
+def test_api_stream_catch_up_limit(sse_app, client, populated_db):
+    sse_app.config['SSE_QUEUE_SIZE'] = 2
+    rv = client.get("/api/v1/stream?since_id=0")
+    assert rv.data.decode().count("id: 2\n") == 1
+    assert len(live.hub) == 0
+
+
+@pytest.mark.parametrize("url, code", [
+    ("/api/v1/stream/missing", 404),
+    ("/api/v1/stream/99", 404),
+    ("/api/v1/stream/foo?since_id=x", 400),
+])
+def test_api_stream_errors(sse_app, client, populated_db, url, code):
+    rv = client.get(url)
+    assert rv.status_code == code
+    assert len(live.hub) == 0
+
+
+def test_api_stream_disabled(client, populated_db):
+    rv = client.get("/api/v1/stream/foo")
+    assert rv.status_code == 404
+    assert "since_id" in rv.get_json()["detail"]
+    assert b"USE_SSE = false;" in client.get("/").data
+
+
+def test_index_sse_enabled(sse_app, client, populated_db):
+    rv = client.get("/")
+    assert b"USE_SSE = true;" in rv.data
+    etag = rv.headers["ETag"]
+    sse_app.config['SSE'] = False
+    rv = client.get("/", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert b"USE_SSE = false;" in rv.data
+
+
+def test_api_get_data_npy(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?format=npy")
+    assert rv.status_code == 200
+    assert rv.mimetype == "application/x-npy"
+    d = np.load(io.BytesIO(rv.data))
+    assert d["timestamp"].tolist() == [0, 1545321236, 1546532003, 1546532067]
+    assert d["value"].tolist() == [0, 1, 5, 8]
+    assert d["id"].tolist() == [7, 8, 9, 10]
+
+
+def test_api_get_data_accept_npz(client, populated_db):
+    headers = {"Accept": "application/x-npz"}
+    rv = client.get("/api/v1/data/old_data", headers=headers)
+    assert rv.mimetype == "application/x-npz"
+    assert "Accept" in rv.headers["Vary"]
+    assert np.load(io.BytesIO(rv.data))["value"].tolist() == [0, 1, 5, 8]
+
+    # Each format has its own ETag.
+    json_etag = client.get("/api/v1/data/old_data").headers["ETag"]
+    assert rv.headers["ETag"] != json_etag
+
+
+def test_api_get_data_npz_downsampled(client, app):
+    db.add_metric("hourly")
+    start = 1546300800
+    db.insert_datapoints([("hourly", i % 24, start + 3600 * i)
+                          for i in range(3000)])
+    rv = client.get("/api/v1/data/hourly?points=100&method=avg&format=npz")
+    d = np.load(io.BytesIO(rv.data))
+    assert d["timestamp"][0] == start + 11.5 * 3600
+    assert d["value"][0] == 11.5
+    assert (d["id"] == 0).all()
+    assert d["n"].dtype == np.int64
+
+
+def test_api_get_data_format_not_available(client, populated_db,
+                                           monkeypatch):
+    monkeypatch.delitem(export.WRITERS, "npz")
+    rv = client.get("/api/v1/data/foo?format=npz")
+    assert rv.status_code == 406
+
+    rv = client.get("/api/v1/data/foo",
+                    headers={"Accept": "application/x-npz"})
+    assert rv.status_code == 406
+
+    # Anything else falls back to JSON.
+    rv = client.get("/api/v1/data/foo",
+                    headers={"Accept": "application/x-npz, */*;q=0.1"})
+    assert rv.status_code == 200
+    assert rv.is_json
+
+
+@pytest.mark.parametrize("query", [
+    "points=apple",
+    "points=2",
+    "points=100&method=median",
+    "format=csv",
+])
+def test_api_get_data_downsampled_invalid(client, populated_db, query):
+    rv = client.get("/api/v1/data/foo?" + query)
+    assert rv.status_code == 400
+    assert "Invalid value" in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("start=1545321236", [1, 5, 8]),
+    ("start=1&end=2019-01-03T16:13:23Z", [1]),
+    ("start=2018-12-20T15:53:56&end=1546532067", [1, 5]),
+    ("start=2019-01-03T16:14:30Z&points=10", []),
+])
+def test_api_get_data_time_range(client, populated_db, query, expected):
+    rv = client.get("/api/v1/data/old_data?" + query)
+    assert rv.status_code == 200
+    assert [r['value'] for r in rv.get_json()['rows']] == expected
+
+
+def test_api_get_data_time_range_invalid(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?start=yesterday")
+    assert rv.status_code == 400
+    assert "'start'" in rv.get_json()['detail']
+
+
 def test_api_get_data_as_json_metric_not_found(client):
     rv = client.get("/api/v1/data/missing")
     assert rv.status_code == 404
@@ -151,6 +659,152 @@ def test_api_get_data_as_json_no_data_for_metric(client, populated_db):
     assert 'No data exists for metric' in d['detail']
 
 
+def test_api_get_stats(client, populated_db):
+    rv = client.get("/api/v1/stats/old_data?percentiles=50,99.5")
+    assert rv.status_code == 200
+    assert rv.get_json() == {
+        "metric": "old_data",
+        "units": None,
+        "count": 4,
+        "min": 0,
+        "max": 8,
+        "mean": 3.5,
+        "stddev": pytest.approx(3.201562),
+        "first_timestamp": "1970-01-01T00:00:00",
+        "last_timestamp": "2019-01-03T16:14:27",
+        "percentiles": {"50": 3, "99.5": pytest.approx(7.955)},
+    }
+
+
+def test_api_get_stats_by_id_and_time_range(client, populated_db):
+    rv = client.get("/api/v1/stats/5?start=1&end=1546532067")
+    d = rv.get_json()
+    assert d["metric"] == "old_data"
+    assert d["count"] == 2
+    assert set(d["percentiles"]) == {"50", "90", "95", "99"}
+
+
+def test_api_get_stats_empty_range(client, populated_db):
+    rv = client.get("/api/v1/stats/old_data?start=2000000000&percentiles=")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d["count"] == 0
+    assert d["mean"] is None
+    assert d["percentiles"] == {}
+
+
+@pytest.mark.parametrize("url, code", [
+    ("/api/v1/stats/missing", 404),
+    ("/api/v1/stats/999", 404),
+    ("/api/v1/stats/empty_metric", 404),
+    ("/api/v1/stats/foo?percentiles=50,101", 400),
+    ("/api/v1/stats/foo?percentiles=median", 400),
+    ("/api/v1/stats/foo?start=yesterday", 400),
+])
+def test_api_get_stats_errors(client, populated_db, url, code):
+    rv = client.get(url)
+    assert rv.status_code == code
+
+
+def test_api_get_data_not_modified(client, populated_db):
+    rv = client.get("/api/v1/data/foo")
+    etag = rv.headers["ETag"]
+    assert rv.headers["Last-Modified"]
+    assert "no-cache" in rv.headers["Cache-Control"]
+
+    rv = client.get("/api/v1/data/foo", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+    assert rv.data == b""
+    assert rv.headers["ETag"] == etag
+
+    # Other metrics don't change foo's ETag.
+    client.post("/api/v1/data", json={"metric": "foo.bar", "value": 1})
+    rv = client.get("/api/v1/data/foo", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    rv = client.get("/api/v1/data/foo", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert rv.headers["ETag"] != etag
+
+
+def test_api_get_data_if_modified_since(client, populated_db):
+    rv = client.get("/api/v1/data/foo?points=3")
+    last_modified = rv.headers["Last-Modified"]
+    assert rv.headers["ETag"]
+
+    rv = client.get("/api/v1/data/foo?points=3",
+                    headers={"If-Modified-Since": last_modified})
+    assert rv.status_code == 304
+
+    rv = client.get("/api/v1/data/foo",
+                    headers={"If-Modified-Since": "Thu, 01 Jan 2015 00:00:00 GMT"})
+    assert rv.status_code == 200
+
+
+def test_api_get_data_not_modified_missing_metric(client, populated_db):
+    rv = client.get("/api/v1/data/missing", headers={"If-None-Match": "*"})
+    assert rv.status_code == 404
+
+
+def test_api_get_metrics_not_modified(client, populated_db):
+    etag = client.get(metric_url()).headers["ETag"]
+    rv = client.get(metric_url(), headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    client.patch(metric_url(2), json={"units": "m"})
+    rv = client.get(metric_url(), headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+
+
+def test_index_not_modified(client, populated_db):
+    etag = client.get("/").headers["ETag"]
+    rv = client.get("/", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    client.post("/api/v1/data", json={"metric": "new", "value": 1})
+    rv = client.get("/", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+
+
+def test_index_tree_cached(client, populated_db, monkeypatch):
+    assert b"foo.bar" in client.get("/").data
+
+    # The tree isn't rebuilt while the list of metrics doesn't change.
+    calls = []
+    monkeypatch.setattr(utils, "build_jstree_data",
+                        lambda *args: calls.append(args) or [])
+    client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    rv = client.get("/plot/2")
+    assert b"foo.bar" in rv.data
+    assert b'var metricId = "foo";' in rv.data
+    assert calls == []
+
+    client.post("/api/v1/data", json={"metric": "new", "value": 1})
+    client.get("/")
+    assert len(calls) == 1
+
+
+def test_index_tree_invalidated(client, populated_db):
+    client.get("/")
+    client.patch("/api/v1/metric/3", json={"name": "foo.renamed"})
+    rv = client.get("/plot/3")
+    assert b"foo.renamed" in rv.data
+    assert b"foo.bar" not in rv.data
+
+    client.delete("/api/v1/metric/3")
+    rv = client.get("/plot/3")
+    assert b"foo.renamed" not in rv.data
+    assert b'var metricId = "3";' in rv.data
+
+
+def test_index_tree_html_safe(client):
+    client.post("/api/v1/data", json={"metric": "</script>", "value": 1})
+    rv = client.get("/")
+    assert b"</script>\"" not in rv.data
+    assert b"\\u003c/script\\u003e" in rv.data
+
+
 @pytest.mark.usefixtures('populated_db')
 class TestDataPoint(object):
     def test_get(self, client):
@@ -161,6 +815,91 @@ class TestDataPoint(object):
         assert set(d.keys()) == {'count', 'next', 'prev', 'results'}
         assert len(d['results']) == 10
         assert d['results'][0]['value'] == 15
+        assert d['count'] is None
+        assert d['prev'] is None
+        assert d['next'] is None
+
+    def test_get_paginated(self, client):
+        rv = client.get(datapoint_url() + "?limit=4")
+        assert rv.status_code == 200
+        d = rv.get_json()
+        assert [x['datapoint_id'] for x in d['results']] == [1, 2, 3, 4]
+        assert d['results'][0]['metric']['name'] == "foo"
+        assert d['prev'] is None
+        assert d['next'] == datapoint_url() + "?after=4&limit=4"
+
+        ids = [x['datapoint_id'] for x in d['results']]
+        while d['next'] is not None:
+            d = client.get(d['next']).get_json()
+            ids.extend(x['datapoint_id'] for x in d['results'])
+        assert ids == list(range(1, 11))
+        assert d['prev'] == datapoint_url() + "?before=9&limit=4"
+
+        d = client.get(d['prev']).get_json()
+        assert [x['datapoint_id'] for x in d['results']] == [5, 6, 7, 8]
+        assert d['prev'] == datapoint_url() + "?before=5&limit=4"
+        assert d['next'] == datapoint_url() + "?after=8&limit=4"
+
+    def test_get_paginated_past_the_ends(self, client):
+        # An empty page links back to the nearest page of data.
+        rv = client.get(datapoint_url() + "?limit=4&after=50")
+        assert rv.status_code == 200
+        d = rv.get_json()
+        assert d['results'] == []
+        assert d['next'] is None
+        assert d['prev'] == datapoint_url() + "?before=51&limit=4"
+        d = client.get(d['prev']).get_json()
+        assert [x['datapoint_id'] for x in d['results']] == [7, 8, 9, 10]
+
+        d = client.get(datapoint_url() + "?limit=4&before=1").get_json()
+        assert d['results'] == []
+        assert d['prev'] is None
+        assert d['next'] == datapoint_url() + "?after=0&limit=4"
+        d = client.get(d['next']).get_json()
+        assert [x['datapoint_id'] for x in d['results']] == [1, 2, 3, 4]
+
+    def test_get_npy(self, client):
+        rv = client.get(datapoint_url() + "?limit=4&after=5&format=npy")
+        assert rv.status_code == 200
+        d = np.load(io.BytesIO(rv.data))
+        assert d["datapoint_id"].tolist() == [6, 7, 8, 9]
+        assert d["metric_id"].tolist() == [3, 5, 5, 5]
+        assert d["timestamp"].tolist()[1:] == [0, 1545321236, 1546532003]
+        assert rv.headers["Link"] == (
+            '<{0}?before=6&limit=4&format=npy>; rel="prev", '
+            '<{0}?after=9&limit=4&format=npy>; rel="next"'
+        ).format(datapoint_url())
+
+    def test_get_invalid_format(self, client):
+        rv = client.get(datapoint_url() + "?format=columnar")
+        assert rv.status_code == 400
+
+    def test_get_count(self, client):
+        rv = client.get(datapoint_url() + "?limit=4&count=true")
+        d = rv.get_json()
+        assert d['count'] == 10
+        assert len(d['results']) == 4
+        assert d['next'] == datapoint_url() + "?after=4&limit=4&count=true"
+
+    def test_get_past_the_end(self, client):
+        rv = client.get(datapoint_url() + "?after=10")
+        assert rv.status_code == 200
+        d = rv.get_json()
+        assert d['results'] == []
+        assert d['prev'] == datapoint_url() + "?before=11&limit=100"
+        assert d['next'] is None
+
+    @pytest.mark.parametrize("query", [
+        "limit=0",
+        "limit=1001",
+        "limit=abc",
+        "after=abc",
+        "after=1&before=5",
+    ])
+    def test_get_invalid_query(self, client, query):
+        rv = client.get(datapoint_url() + "?" + query)
+        assert rv.status_code == 400
+        assert "Invalid value" in rv.get_json()['detail']
 
     def test_post(self, client):
         value = 15
@@ -592,6 +1331,16 @@ def test_api_get_metrics(client, populated_db):
     assert results[0]['name'] == "empty_metric"
 
 
+def test_api_get_metrics_paginated(client, populated_db):
+    rv = client.get(metric_url() + "?limit=4&after=1")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert [x['metric_id'] for x in d['results']] == [2, 3, 4, 5]
+    assert d['count'] is None
+    assert d['prev'] == metric_url() + "?before=2&limit=4"
+    assert d['next'] == metric_url() + "?after=5&limit=4"
+
+
 def test_api_get_metrics_no_data(client):
     rv = client.get(metric_url())
     assert rv.status_code == 404
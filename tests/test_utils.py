@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 """
+import json
 from datetime import datetime
 
 import pytest
@@ -8,6 +9,7 @@ from flask import current_app
 from flask import Response
 from freezegun import freeze_time
 
+from trendlines import db
 from trendlines import orm
 from trendlines import utils
 from .test_orm import _hash_file
@@ -89,6 +91,42 @@ def test_build_jstree_data(test_request_context, metrics, expected):
     assert rv == expected
 
 
+def test_jstree_add_remove():
+    tree = utils.JsTree([orm.Metric(metric_id=1, name="foo.bar.baz")])
+    assert len(tree) == 3
+
+    # A placeholder becomes a metric, and back.
+    tree.add(orm.Metric(metric_id=2, name="foo.bar"))
+    assert tree.nodes["foo.bar"]["metric_id"] == 2
+    tree.remove("foo.bar")
+    assert tree.nodes["foo.bar"]["metric_id"] is None
+
+    tree.add(orm.Metric(metric_id=3, name="foo.qux"))
+    tree.remove("foo.bar.baz")
+    assert tree.data() == utils.build_jstree_data(
+        [orm.Metric(metric_id=3, name="foo.qux")])
+
+    tree.remove("foo.qux")
+    tree.remove("missing")
+    assert len(tree) == 0
+    assert tree._children == {}
+
+
+def test_jstree_incremental_matches_rebuild():
+    names = ["a.b.c.%s" % (i % 7) if i % 3 else "a.%s.x" % i
+             for i in range(200)]
+    metrics = [orm.Metric(metric_id=i, name=name)
+               for i, name in enumerate(dict.fromkeys(names))]
+    tree = utils.JsTree()
+    for metric in metrics:
+        tree.add(metric)
+    assert tree.data() == utils.build_jstree_data(metrics)
+
+    for metric in metrics[::2]:
+        tree.remove(metric.name)
+    assert tree.data() == utils.build_jstree_data(metrics[1::2])
+
+
 def test_format_data(raw_data):
     rv = utils.format_data(raw_data)
     assert isinstance(rv, dict)
@@ -114,6 +152,98 @@ def test_format_data(raw_data):
         pytest.fail("data['timestamp'] is not the correct format")
 
 
+def test_stream_data(raw_data):
+    rows = db.get_raw_data("foo").iterator()
+    rv = "".join(utils.stream_data(rows, "apples"))
+    assert json.loads(rv) == utils.format_data(raw_data, "apples")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_stream_data_chunks(chunk_size):
+    rows = [(1, 0, 1.5), (2, 1546532003, 2), (3, 1546532067, -3.25)]
+    chunks = list(utils.stream_data(rows, chunk_size=chunk_size))
+    # Header, chunks of rows, and footer.
+    assert len(chunks) == 2 + -(-len(rows) // chunk_size)
+    rv = json.loads("".join(chunks))
+    assert rv == {
+        "units": None,
+        "rows": [
+            {"timestamp": "1970-01-01T00:00:00", "value": 1.5, "id": 1,
+             "n": 0},
+            {"timestamp": "2019-01-03T16:13:23", "value": 2, "id": 2,
+             "n": 1},
+            {"timestamp": "2019-01-03T16:14:27", "value": -3.25, "id": 3,
+             "n": 2},
+        ],
+    }
+
+
+@pytest.mark.parametrize("since_id, expected", [
+    (None, 3),
+    (1, 3),
+])
+def test_stream_data_since_id(since_id, expected):
+    rows = [(3, 0, 1.5), (2, 1546532003, 2)]
+    rv = json.loads("".join(utils.stream_data(rows, since_id=since_id)))
+    assert rv["since_id"] == expected
+    rv = json.loads("".join(utils.stream_columns(rows, since_id=since_id)))
+    assert rv["since_id"] == expected
+
+
+def test_stream_data_since_id_empty():
+    rv = json.loads("".join(utils.stream_data([], since_id=None)))
+    assert rv == {"units": None, "rows": [], "since_id": None}
+    rv = json.loads("".join(utils.stream_data([], since_id=5)))
+    assert rv["since_id"] == 5
+
+
+def test_stream_data_empty():
+    rv = "".join(utils.stream_data([]))
+    assert json.loads(rv) == {"units": None, "rows": []}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 1000])
+def test_stream_columns(chunk_size):
+    rows = [(1, 0, 1.5), (2, 1546532003, 2), (3, 1546532067, -3.25)]
+    rv = "".join(utils.stream_columns(rows, "apples", chunk_size=chunk_size))
+    assert json.loads(rv) == {
+        "units": "apples",
+        "timestamps": [0, 1546532003, 1546532067],
+        "values": [1.5, 2, -3.25],
+        "ids": [1, 2, 3],
+    }
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_stream_many(columnar):
+    rows = [(2, 3, 0, 1.5), (2, 4, 1, 2), (5, 1, 1546532003, -3.25)]
+    metrics = [(1, "empty", None), (2, "foo", "m"), (5, "bar", None)]
+    rv = "".join(utils.stream_many(rows, metrics, columnar=columnar,
+                                   since_id=None))
+    rv = json.loads(rv)
+    assert list(rv["metrics"]) == ["empty", "foo", "bar"]
+    assert rv["since_id"] == 4
+
+    stream = utils.stream_columns if columnar else utils.stream_data
+    expected = json.loads("".join(stream([(3, 0, 1.5), (4, 1, 2)], "m")))
+    assert rv["metrics"]["foo"] == expected
+    assert rv["metrics"]["empty"] == json.loads("".join(stream([])))
+
+
+def test_stream_many_empty():
+    metrics = [(1, "foo", None)]
+    rv = json.loads("".join(utils.stream_many([], metrics, since_id=5)))
+    assert rv == {"metrics": {"foo": {"units": None, "rows": []}},
+                  "since_id": 5}
+    assert "since_id" not in json.loads("".join(utils.stream_many([], [])))
+
+
+def test_stream_columns_empty():
+    rv = "".join(utils.stream_columns([]))
+    assert json.loads(rv) == {"units": None, "timestamps": [], "values": [],
+                              "ids": []}
+
+
 @freeze_time("2019-01-25T04:32:28Z")        # 1548390748
 @pytest.mark.parametrize("value, expected", [
     ("metric 15",
@@ -134,12 +264,76 @@ def test_parse_socket_data(value, expected):
     "metric 15 apple",
     "foo bar 16",
     "aasdas 24.4523 ",
+    "metric nan 1546532070",
+    "metric -inf",
+    "metric 1e999",
 ])
 def test_parse_socket_data_raises_value_error(value):
     with pytest.raises(ValueError):
         utils.parse_socket_data(value)
 
 
+def test_parse_socket_buffer():
+    data = (b"foo.bar 123.78 1546532070\n"
+            b"foo 15\r\n"
+            b"\n"
+            b"  spaced   -2.5  1546532071  \n"
+            b"metric 15 apple\n"
+            b"foo bar 16\n"
+            b"too many fields 1 2\n"
+            b"\xff\xfe 1\n"
+            b"big 1 99999999999999999999999\n"
+            b"nan nan 1546532070\n"
+            b"inf -Infinity\n"
+            b"last 1e3")
+    rv = utils.parse_socket_buffer(data, received=1548390748)
+    assert rv.names == ["foo.bar", "foo", "spaced", "last"]
+    assert list(rv.values) == [123.78, 15, -2.5, 1000]
+    assert list(rv.timestamps) == [1546532070, 1548390748, 1546532071,
+                                   1548390748]
+    assert [n for n, _ in rv.errors] == [5, 6, 7, 8, 9, 10, 11]
+    assert rv.errors[0] == (5, "metric 15 apple")
+    assert len(rv) == 4
+    assert rv.rows()[1] == ("foo", 15, 1548390748)
+
+
+@freeze_time("2019-01-25T04:32:28Z")
+def test_parse_socket_buffer_str():
+    rv = utils.parse_socket_buffer("foo 1\nbar 2")
+    assert rv.names == ["foo", "bar"]
+    assert list(rv.timestamps) == [1548390748] * 2
+    assert rv.errors == []
+
+
+def test_parse_socket_buffer_empty():
+    rv = utils.parse_socket_buffer(b"")
+    assert len(rv) == 0
+    assert rv.rows() == []
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1546532070", 1546532070),
+    ("1546532070.9", 1546532070),
+    ("2019-01-03T16:14:30Z", 1546532070),
+    ("2019-01-03T16:14:30", 1546532070),
+    ("2019-01-03T10:14:30-06:00", 1546532070),
+    ("2019-01-03T21:44:30.25+0530", 1546532070),
+    ("2019-01-03 16:14:30", 1546532070),
+    ("2019-01-03T16:14Z", 1546532040),
+    ("2019-01-03", 1546473600),
+])
+def test_parse_timestamp(value, expected):
+    assert utils.parse_timestamp(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "", "yesterday", "2019-13-01", "inf", "nan", "Z", "2019-01-03T16:14:30+6",
+])
+def test_parse_timestamp_invalid(value):
+    with pytest.raises(ValueError):
+        utils.parse_timestamp(value)
+
+
 @freeze_time("2019-01-25T04:32:28Z")
 def test_backup_file(tmp_path):
     path = tmp_path / "foo.bar"
@@ -148,3 +342,19 @@ def test_backup_file(tmp_path):
     assert rv.exists()
     assert rv.name == "foo.bar.20190125_043228"
     assert _hash_file(path) == _hash_file(rv)
+
+
+@pytest.mark.parametrize("timestamp, expected", [
+    (0, True),
+    (1546532070.5, True),
+    (utils.MIN_TIMESTAMP, True),
+    (utils.MAX_TIMESTAMP, True),
+    (utils.MAX_TIMESTAMP + 1, False),
+    (utils.MIN_TIMESTAMP - 1, False),
+    (1e20, False),
+    (2 ** 64, False),
+    (float("nan"), False),
+    (float("-inf"), False),
+])
+def test_is_valid_timestamp(timestamp, expected):
+    assert utils.is_valid_timestamp(timestamp) is expected